@@ -10,9 +10,15 @@ from flask import request, jsonify, make_response, g
 from google.cloud import firestore
 
 from openapi_server.controllers.export_controller import ExportProcessor
+from openapi_server.controllers.trip_fields import select_trip_fields
 
 logging.basicConfig(level=logging.INFO)
 
+# Fields of the open trips that are listed
+OPEN_TRIP_FIELDS = ['license', 'started_at', 'ended_at', 'driver_info.driver_first_name',
+                    'driver_info.driver_last_name', 'department.department_name', 'department.department_id',
+                    'checking_info.trip_kind', 'checking_info.description', 'exported.exported_at']
+
 
 def export_trips(ended_after, ended_before):  # noqa: E501
     """Exports all trip entities to a file
@@ -87,6 +93,7 @@ def check_open_trips(ended_after, ended_before):
 def get_open_trips(db_client, ended_after, ended_before):
     query_trips = db_client.collection(config.COLLECTION_NAME)
 
+    query_trips = select_trip_fields(query_trips, OPEN_TRIP_FIELDS)
     query_trips = query_trips.where('ended_at', '>=', datetime.strptime(ended_after, "%Y-%m-%dT%H:%M:%SZ"))
     query_trips = query_trips.where('ended_at', '<=', datetime.strptime(ended_before, "%Y-%m-%dT%H:%M:%SZ"))
     query_trips = query_trips.where('outside_time_window', '==', True)
@@ -96,19 +103,20 @@ def get_open_trips(db_client, ended_after, ended_before):
     if docs_trips:
         response_open_trips = []
         for doc in docs_trips:
-            if not get_from_dict(doc, ['exported', 'exported_at']):
-                trip_kind = get_from_dict(doc, ['checking_info', 'trip_kind'])
+            doc_dict = doc.to_dict()
+            if not get_from_dict(doc_dict, ['exported', 'exported_at']):
+                trip_kind = get_from_dict(doc_dict, ['checking_info', 'trip_kind'])
 
                 trip_dict = {
-                    'kenteken': get_from_dict(doc, ['license']),
-                    'begon_op': get_from_dict(doc, ['started_at']),
-                    'eindigde_op': get_from_dict(doc, ['ended_at']),
-                    'voornaam': get_from_dict(doc, ['driver_info', 'driver_first_name']),
-                    'achternaam': get_from_dict(doc, ['driver_info', 'driver_last_name']),
-                    'afdeling_naam': get_from_dict(doc, ['department', 'department_name']),
-                    'afdeling_nummer': get_from_dict(doc, ['department', 'department_id']),
+                    'kenteken': get_from_dict(doc_dict, ['license']),
+                    'begon_op': get_from_dict(doc_dict, ['started_at']),
+                    'eindigde_op': get_from_dict(doc_dict, ['ended_at']),
+                    'voornaam': get_from_dict(doc_dict, ['driver_info', 'driver_first_name']),
+                    'achternaam': get_from_dict(doc_dict, ['driver_info', 'driver_last_name']),
+                    'afdeling_naam': get_from_dict(doc_dict, ['department', 'department_name']),
+                    'afdeling_nummer': get_from_dict(doc_dict, ['department', 'department_id']),
                     'rit_soort': 'werk' if trip_kind == 'work' else ('privé' if trip_kind == 'personal' else None),
-                    'rit_beschrijving': get_from_dict(doc, ['checking_info', 'description'])
+                    'rit_beschrijving': get_from_dict(doc_dict, ['checking_info', 'description'])
                 }
                 response_open_trips.append(trip_dict)
 
@@ -10,6 +10,11 @@ from gobits import Gobits
 from hashlib import sha256
 
 from google.cloud import firestore, pubsub_v1
+from openapi_server.controllers.trip_fields import select_trip_fields
+
+# Fields that decide which trips are exported, they are paged on ended_at. Exported trips are
+# published as a whole, so they are read again with their locations.
+EXPORT_SCAN_FIELDS = ['ended_at', 'exported.exported_at', 'checking_info.trip_kind']
 
 
 class ExportProcessor(object):
@@ -35,6 +40,7 @@ class ExportProcessor(object):
         while batch_has_new_entities:
             query = self.db_client.collection(self.collection_trips)
 
+            query = select_trip_fields(query, EXPORT_SCAN_FIELDS)
             query = query.where('ended_at', '>=', self.ended_after)
             query = query.where('ended_at', '<=', self.ended_before)
             query = query.where('outside_time_window', '==', True)
@@ -55,6 +61,7 @@ class ExportProcessor(object):
                 else:
                     batch_last_reference = docs_list[-1]
 
+                docs_to_export = []
                 for doc in docs_list:
                     doc_dict = doc.to_dict()
 
@@ -69,19 +76,39 @@ class ExportProcessor(object):
                         batch_has_new_entities = False
                         break
                     else:  # Append trip to list for export
-                        for loc in doc_dict['locations']:
-                            loc['when'] = loc['when'].strftime('%Y-%m-%dT%H:%M:%SZ')
-
-                        doc_dict['started_at'] = doc_dict['started_at'].strftime('%Y-%m-%dT%H:%M:%SZ')
-                        doc_dict['ended_at'] = doc_dict['ended_at'].strftime('%Y-%m-%dT%H:%M:%SZ')
-                        doc_dict['doc_id'] = doc.id
-                        doc_dict['doc_reference'] = doc.reference
-                        trips_to_export.append(doc_dict)
+                        docs_to_export.append(doc.reference)
+
+                trips_to_export.extend(self.get_trips(docs_to_export))
             else:
                 batch_has_new_entities = False
 
         return trips_to_export, all_trips_marked
 
+    def get_trips(self, references):
+        """Returns the whole trips of document references, in the same order, with one request"""
+        if not references:
+            return []
+
+        docs = {doc.id: doc for doc in self.db_client.get_all(references) if doc.exists}
+
+        trips = []
+        for reference in references:
+            doc = docs.get(reference.id)
+            if doc is None:  # Skip if trip was deleted since it was found
+                continue
+
+            doc_dict = doc.to_dict()
+            for loc in doc_dict['locations']:
+                loc['when'] = loc['when'].strftime('%Y-%m-%dT%H:%M:%SZ')
+
+            doc_dict['started_at'] = doc_dict['started_at'].strftime('%Y-%m-%dT%H:%M:%SZ')
+            doc_dict['ended_at'] = doc_dict['ended_at'].strftime('%Y-%m-%dT%H:%M:%SZ')
+            doc_dict['doc_id'] = doc.id
+            doc_dict['doc_reference'] = doc.reference
+            trips.append(doc_dict)
+
+        return trips
+
     @staticmethod
     def get_new_frequent_offenders(trips_active):
         current_fo = {}
@@ -0,0 +1,191 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import fleet
+import harness
+
+sys.path.insert(0, os.path.join(fleet.FUNCTIONS, "locations_to_stg"))
+
+from batch_pull import BatchPuller  # noqa: E402
+from stg_updater import LocationsAccumulator, merge_locations, process_carsloc_msg  # noqa: E402
+from timestamps import SECONDS_PER_DAY, day_start  # noqa: E402
+
+# Benchmarks locations_to_stg by replaying Pub/Sub messages of a synthetic fleet
+#
+#   python bench_locations_to_stg.py                 replay 1M messages and compare with the stored baseline
+#   python bench_locations_to_stg.py --save          store the measurements as the new baseline
+#   python bench_locations_to_stg.py --check         exit with an error if a stage regressed
+#
+# Messages of all cars are interleaved in order of time, with a few late and redelivered messages,
+# and are decoded from JSON as the subscriber callback does.
+# Batch pulls go to an in-memory subscription with a fixed request latency, to compare them with
+# handling every message in a callback thread.
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "locations_to_stg.json")
+DAY = datetime.date(2021, 6, 1)
+
+
+def make_messages(fleet_config, messages, late_share=0.01, redelivery_share=0.01, locations_per_message=1):
+    """Returns the data of the messages that deliver the locations of a day"""
+    rng = random.Random(fleet_config.seed)
+    pending = []
+    car = 0
+    while len(pending) < messages * locations_per_message:
+        car_license = fleet.car_license(car)
+        license_hash = fleet.license_hash(car_license)
+        for location in fleet.car_locations(fleet_config, DAY, car):
+            location = dict(location, when=location["when"] + "Z", license=car_license, license_hash=license_hash)
+            # A late message arrives up to 10 minutes after its time
+            delay = rng.uniform(0, 600) if rng.random() < late_share else 0
+            when = location["when"]
+            arrival = int(when[11:13]) * 3600 + int(when[14:16]) * 60 + int(when[17:19]) + delay
+            pending.append((arrival, location))
+        car += 1
+    pending.sort(key=lambda item: item[0])
+    pending = pending[:messages * locations_per_message]
+
+    data = []
+    for i in range(0, len(pending), locations_per_message):
+        message = json.dumps({"carlocations": [item[1] for item in pending[i:i + locations_per_message]]})
+        data.append(message.encode("utf-8"))
+        if rng.random() < redelivery_share:
+            data.append(data[rng.randrange(len(data))])
+    return data[:messages], car
+
+
+def replay(messages):
+    car_licenses = {}
+    for data in messages:
+        process_carsloc_msg(json.loads(data.decode()), car_licenses, DAY)
+    return car_licenses
+
+
+def replay_threads(messages, workers):
+    """Replays the messages on a pool of threads, like the callback threads of the subscriber"""
+    accumulator = LocationsAccumulator(DAY)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda data: accumulator.add_message(json.loads(data.decode())), messages):
+            pass
+    return accumulator.car_licenses
+
+
+class MemorySubscriber(object):
+    """The part of the subscriber client that BatchPuller uses, with a request latency"""
+
+    def __init__(self, messages, latency=0.02):
+        self.messages = messages
+        self.latency = latency
+        self.position = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def pull(self, request, timeout=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            start = self.position
+            self.position = min(len(self.messages), start + request["max_messages"])
+        return SimpleNamespace(received_messages=[
+            SimpleNamespace(ack_id=str(i), message=SimpleNamespace(data=self.messages[i]))
+            for i in range(start, self.position)
+        ])
+
+    def modify_ack_deadline(self, request):
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+
+    def acknowledge(self, request):
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+
+
+def replay_batches(messages, pulls_in_flight, latency):
+    """Pulls the messages in batches from an in-memory subscription and acknowledges them"""
+    accumulator = LocationsAccumulator(DAY)
+    subscriber = MemorySubscriber(messages, latency)
+
+    def handle_batch(batch, acknowledge):
+        for message in batch:
+            accumulator.add_message(json.loads(message.data.decode()))
+        accumulator.hold(acknowledge)
+
+    puller = BatchPuller(subscriber, "benchmark", handle_batch, pulls_in_flight=pulls_in_flight)
+    puller.start()
+    while accumulator.messages < len(messages):
+        puller.wait(0.01)
+    puller.stop()
+    car_licenses, acks = accumulator.take()
+    for ack in acks:
+        ack()
+    puller.release()
+    return car_licenses
+
+
+def merge_runs(runs):
+    """Merges the locations of a second pull run into those stored by the first one"""
+    stored, received = runs
+    start = day_start(DAY)
+    return [
+        merge_locations(stored[car_license].locations if car_license in stored else [],
+                        received[car_license].locations, start, start + SECONDS_PER_DAY)
+        for car_license in received
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks locations_to_stg on replayed messages")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--points-per-day", type=int, default=1440)
+    parser.add_argument("--locations-per-message", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--callback-workers", type=int, default=10)
+    parser.add_argument("--pulls-in-flight", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="Pub/Sub request latency in seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    fleet_config = fleet.FleetConfig(points_per_day=args.points_per_day, seed=args.seed)
+    messages, cars = make_messages(fleet_config, args.messages, locations_per_message=args.locations_per_message)
+    stages = [
+        harness.Stage("replay", replay, lambda: messages, items=len(messages), unit="messages"),
+        harness.Stage(f"replay_threads_{args.callback_workers}",
+                      lambda data: replay_threads(data, args.callback_workers), lambda: messages,
+                      items=len(messages), unit="messages"),
+        harness.Stage(f"batch_pull_{args.pulls_in_flight}",
+                      lambda data: replay_batches(data, args.pulls_in_flight, args.latency), lambda: messages,
+                      items=len(messages), unit="messages"),
+        # The day blob is stored by a first pull run and updated by a second one
+        harness.Stage("merge", merge_runs,
+                      lambda: (replay(messages[:len(messages) // 2]), replay(messages[len(messages) // 2:])),
+                      items=len(messages), unit="messages"),
+    ]
+    results = harness.run_stages(stages, args.repeat, not args.no_memory)
+
+    key = f"messages={args.messages},points_per_day={args.points_per_day},seed={args.seed}"
+    baseline = harness.load_baselines(BASELINES).get(key)
+    harness.report(results, baseline)
+
+    if args.save:
+        config = dict(fleet_config.as_dict(), cars=cars, messages=args.messages,
+                      locations_per_message=args.locations_per_message)
+        harness.save_baseline(BASELINES, key, results, config)
+    elif args.check and baseline:
+        regressions = harness.compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,189 @@
+import argparse
+import datetime
+import gzip
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+import fleet
+import harness
+
+sys.path.insert(0, os.path.join(fleet.FUNCTIONS, "update_car_trips"))
+
+from day_locations import DayLocations, collect_trailing_locations, read_day_data  # noqa: E402
+from firestore import upload_to_firestore  # noqa: E402
+from trips import make_trips, patch_trip, patch_trips  # noqa: E402
+
+# Benchmarks trip detection of update_car_trips on a synthetic fleet
+#
+#   python bench_update_car_trips.py                 measure and compare with the stored baseline
+#   python bench_update_car_trips.py --save          store the measurements as the new baseline
+#   python bench_update_car_trips.py --check         exit with an error if a stage or a size regressed
+#
+# Uploads go to an in-memory Firestore with a fixed commit latency, they are bounded by the
+# 500 writes per second ramp-up limit, so only a part of the fleet is uploaded.
+# Trip detection is measured with 1, 2, 4 and 8 worker processes, every count is a stage of its own.
+# The chunks of these stages are small enough that the fleet has two chunks for every worker of the
+# largest count, otherwise the cars would be processed serially instead of by a pool of processes.
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "update_car_trips.json")
+DAY = datetime.date(2021, 6, 1)
+
+
+class MemoryDocument(object):
+    def __init__(self, document_id):
+        self.id = document_id
+
+
+class MemoryCollection(object):
+    def __init__(self, ids):
+        self.ids = ids
+
+    def document(self):
+        return MemoryDocument(f"doc-{next(self.ids)}")
+
+
+class MemoryBatch(object):
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data):
+        self.writes.append((doc_ref, data))
+
+    def commit(self):
+        time.sleep(self.db.latency)
+        with self.db.lock:
+            for doc_ref, data in self.writes:
+                self.db.documents[doc_ref.id] = data
+
+
+class MemoryFirestore(object):
+    """The part of the Firestore client that upload_to_firestore uses, with a commit latency"""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+
+    def collection(self, name):
+        return MemoryCollection(self.ids)
+
+    def batch(self):
+        return MemoryBatch(self)
+
+
+def read_cars(data, storage_format="json"):
+    # Keeps every car, as make_trips does, stream_json shows the memory of reading one car at a time
+    return list(read_day_data(data, storage_format))
+
+
+def trailing_of(data):
+    trailing = {}
+    for _ in collect_trailing_locations(read_day_data(data), trailing):
+        pass
+    return trailing
+
+
+def overnight_trips(data, previous_day):
+    """Returns the first trips that started the day before, as arguments of patch_trip"""
+    return [
+        (car["trips"][0], car["license_hash"], previous_day)
+        for car in make_trips(read_cars(data))
+        if car["trips"] and car["trips"][0][0]["what"] == "Moving"
+    ]
+
+
+def make_stages(fleet_config, worker_counts, upload_cars, latency):
+    previous = fleet.generate_day(fleet_config, DAY - datetime.timedelta(1))
+    today = fleet.generate_day(fleet_config, DAY)
+    points = fleet.count_points(today)
+    data = fleet.encode_day(today)
+    columnar_data = fleet.encode_day(today, "columnar")
+    compact_data = fleet.encode_day(today, "compact")
+    previous_day = DayLocations.preloaded("previous", trailing_of(fleet.encode_day(previous)))
+    uploaded = dict(itertools.islice(today.items(), upload_cars))
+    upload_data = fleet.encode_day(uploaded)
+    upload_trips = sum(len(car["trips"]) for car in patch_trips(make_trips(read_cars(upload_data)), previous_day))
+    overnight = len(overnight_trips(data, previous_day))
+
+    stages = [
+        harness.Stage("json_loads", lambda _: json.loads(data), items=points),
+        harness.Stage("read_json", lambda _: read_cars(data), items=points),
+        harness.Stage("stream_json", lambda _: all(True for _ in read_day_data(data)), items=points),
+        harness.Stage("read_columnar", lambda _: read_cars(columnar_data, "columnar"), items=points),
+        harness.Stage("read_compact", lambda _: read_cars(compact_data, "compact"), items=points),
+        harness.Stage("write_compact", lambda _: fleet.encode_day(today, "compact"), items=points),
+        harness.Stage("make_trips", lambda cars: make_trips(cars), lambda: read_cars(data), items=points),
+        harness.Stage("patch_trips", lambda car_trips: patch_trips(car_trips, previous_day),
+                      lambda: make_trips(read_cars(data)), items=points),
+        harness.Stage("patch_trip", lambda calls: [patch_trip(*call) for call in calls],
+                      lambda: overnight_trips(data, previous_day), items=overnight, unit="trips"),
+        harness.Stage("end_to_end", lambda _: patch_trips(make_trips(read_cars(data)), previous_day), items=points),
+        harness.Stage("upload", lambda car_trips: upload_to_firestore(car_trips, db_client=MemoryFirestore(latency)),
+                      lambda: patch_trips(make_trips(read_cars(upload_data)), previous_day),
+                      items=upload_trips, unit="trips"),
+    ]
+
+    # Scaling of trip detection with the size of the fleet and the number of worker processes
+    for share in (4, 2):
+        part = fleet.encode_day(dict(itertools.islice(today.items(), fleet_config.cars // share)))
+        stages.append(harness.Stage(
+            f"make_trips_cars_{fleet_config.cars // share}", lambda cars: make_trips(cars),
+            lambda part=part: read_cars(part), items=fleet.count_points(json.loads(part))
+        ))
+    chunk_size = max(1, fleet_config.cars // (2 * max(worker_counts)))
+    for workers in worker_counts:
+        stages.append(harness.Stage(
+            f"make_trips_workers_{workers}", lambda cars, workers=workers: make_trips(cars, workers, chunk_size),
+            lambda: read_cars(data), items=points
+        ))
+
+    sizes = {
+        "json_bytes": len(data),
+        "columnar_bytes": len(columnar_data),
+        "compact_bytes": len(compact_data),
+        "json_gzip_bytes": len(gzip.compress(data)),
+        "columnar_gzip_bytes": len(gzip.compress(columnar_data)),
+    }
+    return stages, sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks trip detection on a synthetic fleet")
+    parser.add_argument("--cars", type=int, default=200)
+    parser.add_argument("--points-per-day", type=int, default=1440)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Numbers of worker processes trip detection is measured with")
+    parser.add_argument("--upload-cars", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="Firestore commit latency in seconds")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    fleet_config = fleet.FleetConfig(cars=args.cars, points_per_day=args.points_per_day, seed=args.seed)
+    stages, sizes = make_stages(fleet_config, args.workers, args.upload_cars, args.latency)
+    results = harness.run_stages(stages, args.repeat, not args.no_memory)
+
+    key = f"cars={args.cars},points_per_day={args.points_per_day},seed={args.seed}"
+    baseline = harness.load_baselines(BASELINES).get(key)
+    harness.report(results, baseline)
+    print(json.dumps(sizes, indent=2))
+
+    if args.save:
+        harness.save_baseline(BASELINES, key, results, dict(fleet_config.as_dict(), sizes=sizes))
+    elif args.check and baseline:
+        regressions = harness.compare(results, baseline, args.tolerance) + \
+            harness.compare_sizes(sizes, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
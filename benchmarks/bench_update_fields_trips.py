@@ -0,0 +1,245 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+import fleet
+import harness
+from pytz import timezone as py_timezone
+
+sys.path.insert(0, os.path.join(fleet.FUNCTIONS, "update_fields_trips"))
+
+# The function reads its settings from a config module that is deployed with it
+sys.modules.setdefault("config", types.ModuleType("config"))
+sys.modules["config"].collection = "Trips"
+
+from add_fields_firestore_entities import MARK_FIELDS, AddFieldsToFirestoreEntities, DriverIntervals  # noqa: E402
+from time_window import TimeWindow  # noqa: E402
+
+# Benchmarks update_fields_trips on synthetic trips
+#
+#   python bench_update_fields_trips.py              measure and compare with the stored baseline
+#   python bench_update_fields_trips.py --save       store the measurements as the new baseline
+#   python bench_update_fields_trips.py --check      exit with an error if a stage or a size regressed
+#
+# Marking the trips of a day runs against an in-memory Firestore with a fixed request latency,
+# to compare the pipelined pages and commits with fetching and committing one page at a time.
+# The in-memory Firestore counts the bytes of the documents it returns, with and without projection.
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "update_fields_trips.json")
+AMSTERDAM = py_timezone("Europe/Amsterdam")
+# Time window of a working day
+WINDOW = (7, 0, 18, 0)
+
+
+def outside_per_trip(value, start_hour, start_minutes, end_hour, end_minutes):
+    """Classifies one trip by converting it to local time with pytz"""
+    started_at = value.astimezone(AMSTERDAM).time()
+    return started_at < datetime.time(start_hour, start_minutes) or started_at > datetime.time(end_hour, end_minutes)
+
+
+def make_started_at(trips, seed):
+    """Returns start times of trips spread over two years"""
+    rng = random.Random(seed)
+    start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    return [start + datetime.timedelta(seconds=rng.randrange(2 * 365 * 24 * 60 * 60)) for _ in range(trips)]
+
+
+class MemorySnapshot(object):
+    def __init__(self, reference, data):
+        self.reference = reference
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+def project(data, field_paths):
+    """Returns the fields of a document that a projection on field paths returns"""
+    projected = {}
+    for field_path in field_paths:
+        value = data
+        keys = field_path.split(".")
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projected
+
+
+class MemoryQuery(object):
+    """The part of a Firestore query that mark_trips_time_window uses, trips are ordered on ended_at"""
+
+    def __init__(self, firestore, start=0, count=None, field_paths=None):
+        self.firestore = firestore
+        self.start = start
+        self.count = count
+        self.field_paths = field_paths
+
+    def select(self, field_paths):
+        return MemoryQuery(self.firestore, self.start, self.count, field_paths)
+
+    def where(self, field, op, value):
+        return self
+
+    def order_by(self, field, direction=None):
+        return self
+
+    def start_after(self, snapshot):
+        return MemoryQuery(self.firestore, snapshot.reference + 1, self.count, self.field_paths)
+
+    def limit(self, count):
+        return MemoryQuery(self.firestore, self.start, count, self.field_paths)
+
+    def stream(self):
+        time.sleep(self.firestore.latency)
+        with self.firestore.lock:
+            trips = self.firestore.trips[self.start:self.start + self.count]
+            if self.field_paths is not None:
+                trips = [project(trip, self.field_paths) for trip in trips]
+            self.firestore.bytes_read += sum(len(json.dumps(trip, default=str)) for trip in trips)
+        return iter([MemorySnapshot(self.start + i, trip) for i, trip in enumerate(trips)])
+
+
+class MemoryBatch(object):
+    def __init__(self, firestore):
+        self.firestore = firestore
+        self.updates = []
+
+    def update(self, reference, fields):
+        self.updates.append((reference, fields))
+
+    def commit(self):
+        time.sleep(self.firestore.latency)
+        with self.firestore.lock:
+            for reference, fields in self.updates:
+                self.firestore.trips[reference].update(fields)
+
+
+class MemoryFirestore(object):
+    """The part of the Firestore client that mark_trips_time_window uses, with a request latency"""
+
+    def __init__(self, trips, latency=0.05):
+        self.trips = trips
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+
+    def collection(self, name):
+        return MemoryQuery(self)
+
+    def batch(self):
+        return MemoryBatch(self)
+
+
+def make_trips(started_at, licenses=500, locations=60):
+    """Returns trips of an hour of the cars of a fleet, ordered on ended_at, with a location every minute"""
+    trips = [
+        {"license": f"car-{i % licenses}", "started_at": value, "ended_at": value + datetime.timedelta(hours=1),
+         "locations": [{"when": value + datetime.timedelta(minutes=minute), "what": "Moving",
+                        "geometry": {"type": "Point", "coordinates": [5.1 + minute / 1000, 52.1]}}
+                       for minute in range(locations)]}
+        for i, value in enumerate(started_at)
+    ]
+    return sorted(trips, key=lambda trip: trip["ended_at"])
+
+
+def scan_bytes(trips, field_paths):
+    """Returns the bytes of the documents of a scan over every trip"""
+    firestore = MemoryFirestore(trips, latency=0)
+    query = firestore.collection("Trips")
+    if field_paths is not None:
+        query = query.select(field_paths)
+    list(query.limit(len(trips)).stream())
+    return firestore.bytes_read
+
+
+def make_drivers(licenses=500):
+    """Returns the driver assignments of the cars of a fleet, with a second driver for every other car"""
+    drivers = {}
+    for i in range(licenses):
+        car_license = f"car-{i}"
+        drivers[car_license] = [{"license": car_license, "driver_start_date": "2020-01-01T00:00:00Z",
+                                 "driver_end_date": None, "department_id": None}]
+        if i % 2:
+            drivers[car_license].append({"license": car_license, "driver_start_date": "2021-07-01T00:00:00Z",
+                                         "driver_end_date": None, "department_id": None})
+    return drivers
+
+
+def mark_trips(trips, drivers, latency, pipelined):
+    entities = AddFieldsToFirestoreEntities.__new__(AddFieldsToFirestoreEntities)
+    entities.db_client = MemoryFirestore(trips, latency)
+    entities.trip_information = {"drivers": drivers, "business_units": None}
+    entities.time_window = TimeWindow(*WINDOW)
+    entities.start_date = None
+    entities.end_date = None
+    entities.prefetch_pages = pipelined
+    entities.commits_in_flight = 2 if pipelined else 0
+    return entities.mark_trips_time_window()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks update_fields_trips on synthetic trips")
+    parser.add_argument("--trips", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--day-trips", type=int, default=10000, help="Trips of the day that are marked")
+    parser.add_argument("--latency", type=float, default=0.05, help="Firestore request latency in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    started_at = make_started_at(args.trips, args.seed)
+    pages = [started_at[i:i + args.page_size] for i in range(0, len(started_at), args.page_size)]
+    time_window = TimeWindow(*WINDOW)
+    stages = [
+        harness.Stage("time_window_per_trip", lambda _: [outside_per_trip(value, *WINDOW) for value in started_at],
+                      items=len(started_at), unit="trips"),
+        harness.Stage("time_window_pages", lambda _: [time_window.outside(page) for page in pages],
+                      items=len(started_at), unit="trips"),
+    ]
+    drivers = {car_license: DriverIntervals(drivers_list) for car_license, drivers_list in make_drivers().items()}
+    for name, pipelined in (("mark_sequential", False), ("mark_pipelined", True)):
+        stages.append(harness.Stage(
+            name, lambda trips, pipelined=pipelined: mark_trips(trips, drivers, args.latency, pipelined),
+            lambda: make_trips(started_at[:args.day_trips]), items=min(args.day_trips, args.trips), unit="trips"
+        ))
+    results = harness.run_stages(stages, args.repeat, not args.no_memory)
+
+    day_trips = make_trips(started_at[:args.day_trips])
+    sizes = {
+        "scan_bytes": scan_bytes(day_trips, None),
+        "mark_scan_bytes": scan_bytes(day_trips, MARK_FIELDS),
+    }
+
+    key = f"trips={args.trips},page_size={args.page_size},day_trips={args.day_trips},latency={args.latency}," \
+          f"seed={args.seed}"
+    baseline = harness.load_baselines(BASELINES).get(key)
+    harness.report(results, baseline)
+    print(json.dumps(sizes, indent=2))
+
+    if args.save:
+        harness.save_baseline(BASELINES, key, results, {"trips": args.trips, "page_size": args.page_size,
+                                                        "day_trips": args.day_trips, "latency": args.latency,
+                                                        "seed": args.seed, "sizes": sizes})
+    elif args.check and baseline:
+        regressions = harness.compare(results, baseline, args.tolerance) + \
+            harness.compare_sizes(sizes, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
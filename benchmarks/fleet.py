@@ -0,0 +1,156 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import sys
+
+# Seeded generator of synthetic car locations, in the format of the daily locations blobs
+#
+# Every car alternates between stops, with Stationary pings, and trips, with Moving pings.
+# A stop can start with an ExternalPowerChange event and stationary pings can be repeated
+# exactly, as the car trackers do. A car that is still moving at midnight continues its
+# trip the next day, so consecutive days fit together like real data.
+
+FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions")
+
+
+class FleetConfig(object):
+    """Shape of a synthetic fleet"""
+
+    def __init__(self, cars=500, points_per_day=1440, stops_per_day=6, overnight_share=0.05,
+                 duplicate_share=0.05, power_change_share=0.2, seed=0):
+        self.cars = cars
+        self.points_per_day = points_per_day
+        self.stops_per_day = stops_per_day
+        self.overnight_share = overnight_share
+        self.duplicate_share = duplicate_share
+        self.power_change_share = power_change_share
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def car_license(car):
+    return "BM-{:03d}-{:02d}".format(car // 100, car % 100)
+
+
+def license_hash(car_license):
+    return hashlib.sha256(car_license.encode("utf-8")).hexdigest()
+
+
+def ends_moving(fleet_config, date, car):
+    """Returns whether the car is still driving at the end of the day"""
+    rng = random.Random(f"{fleet_config.seed}-{date.isoformat()}-{car}-overnight")
+    return rng.random() < fleet_config.overnight_share
+
+
+def car_locations(fleet_config, date, car):
+    """Returns the ordered locations of one car of one day"""
+    rng = random.Random(f"{fleet_config.seed}-{date.isoformat()}-{car}")
+    points = max(2, int(rng.gauss(fleet_config.points_per_day, fleet_config.points_per_day / 10)))
+    interval = 86400 / points
+    # Stops and trips alternate, a segment has on average the same number of points
+    mean_segment = max(1.0, points / (2 * fleet_config.stops_per_day + 1))
+
+    moving = ends_moving(fleet_config, date - datetime.timedelta(1), car)
+    last_moving = ends_moving(fleet_config, date, car)
+    midnight = datetime.datetime.combine(date, datetime.time())
+    lon = round(rng.uniform(4.0, 6.5), 6)
+    lat = round(rng.uniform(51.5, 53.0), 6)
+
+    locations = []
+    seconds = 0.0
+    while True:
+        length = max(1, int(rng.expovariate(1 / mean_segment)))
+        remaining = max(1, points - len(locations))
+        last_segment = length >= remaining and moving == last_moving
+        if length >= remaining:
+            # The last segment has to match whether the car drives through midnight
+            length = remaining if last_segment else max(1, remaining // 2)
+        for j in range(length):
+            seconds = min(seconds + rng.uniform(0.5, 1.5) * interval, 86399)
+            if moving:
+                lon = round(lon + rng.uniform(-0.002, 0.002), 6)
+                lat = round(lat + rng.uniform(-0.002, 0.002), 6)
+                what = "Moving"
+            elif j == 0 and rng.random() < fleet_config.power_change_share:
+                what = "ExternalPowerChange"
+            else:
+                what = "Stationary"
+            location = {
+                "when": (midnight + datetime.timedelta(seconds=int(seconds))).strftime("%Y-%m-%dT%H:%M:%S"),
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "what": what
+            }
+            locations.append(location)
+            if not moving and rng.random() < fleet_config.duplicate_share:
+                locations.append(json.loads(json.dumps(location)))
+        if last_segment:
+            break
+        moving = not moving
+    return locations
+
+
+def generate_day(fleet_config, date):
+    """Returns the locations of every car of a day, like the contents of a locations blob"""
+    fleet = {}
+    for car in range(fleet_config.cars):
+        name = car_license(car)
+        fleet[license_hash(name)] = {"license": name, "locations": car_locations(fleet_config, date, car)}
+    return fleet
+
+
+def encode_day(fleet, storage_format="json"):
+    """Returns a day of locations as the bytes of a locations blob"""
+    if storage_format == "columnar":
+        sys.path.insert(0, os.path.join(FUNCTIONS, "update_car_trips"))
+        from columnar import json_to_columnar
+        return json_to_columnar(fleet)
+    if storage_format == "compact":
+        sys.path.insert(0, os.path.join(FUNCTIONS, "update_car_trips"))
+        from compact import json_to_compact
+        return json_to_compact(fleet)
+    # Written as stg_updater writes the day blobs
+    return json.dumps(fleet, indent=2).encode("utf-8")
+
+
+def count_points(fleet):
+    return sum(len(car["locations"]) for car in fleet.values())
+
+
+# Writes days of locations in the blob layout: python fleet.py <directory> --start 2021-06-01 --days 3
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic daily locations files")
+    parser.add_argument("directory")
+    parser.add_argument("--start", default="2021-06-01")
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--file-name", default="locations.json")
+    parser.add_argument("--format", default="json", choices=["json", "columnar", "compact"])
+    parser.add_argument("--cars", type=int, default=500)
+    parser.add_argument("--points-per-day", type=int, default=1440)
+    parser.add_argument("--stops-per-day", type=int, default=6)
+    parser.add_argument("--overnight-share", type=float, default=0.05)
+    parser.add_argument("--duplicate-share", type=float, default=0.05)
+    parser.add_argument("--power-change-share", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fleet_config = FleetConfig(args.cars, args.points_per_day, args.stops_per_day, args.overnight_share,
+                               args.duplicate_share, args.power_change_share, args.seed)
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d").date()
+    file_name = args.file_name
+    if args.format == "columnar":
+        file_name = os.path.splitext(file_name)[0] + ".loc"
+    elif args.format == "compact":
+        file_name = os.path.splitext(file_name)[0] + ".json.gz"
+    for i in range(args.days):
+        date = start + datetime.timedelta(i)
+        fleet = generate_day(fleet_config, date)
+        path = os.path.join(args.directory, "{}/{:02d}/{:02d}".format(date.year, date.month, date.day), file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as day_file:
+            day_file.write(encode_day(fleet, args.format))
+        print(f"Wrote {count_points(fleet)} locations of {len(fleet)} cars to {path}")
@@ -0,0 +1,125 @@
+import gc
+import json
+import logging
+import os
+import platform
+import time
+import tracemalloc
+
+logging.basicConfig(level=logging.INFO)
+
+# A stage is measured as the best time of a number of runs, its peak memory is measured in a
+# separate run since tracing allocations slows the stage down. Setup is never measured.
+
+
+class Stage(object):
+    """Benchmarked step, setup returns the input of run and items is the amount of work of one run"""
+
+    def __init__(self, name, run, setup=None, items=0, unit="points"):
+        self.name = name
+        self.run = run
+        self.setup = setup if setup else (lambda: None)
+        self.items = items
+        self.unit = unit
+
+
+def measure(stage, repeat=3, memory=True):
+    best = None
+    for _ in range(repeat):
+        prepared = stage.setup()
+        gc.collect()
+        start = time.perf_counter()
+        stage.run(prepared)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    result = {
+        "seconds": round(best, 4),
+        "items": stage.items,
+        "unit": stage.unit,
+        "per_second": round(stage.items / best) if best > 0 else None,
+    }
+    if memory:
+        prepared = stage.setup()
+        gc.collect()
+        tracemalloc.start()
+        stage.run(prepared)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mib"] = round(peak / (1 << 20), 2)
+    return result
+
+
+def run_stages(stages, repeat=3, memory=True):
+    results = {}
+    for stage in stages:
+        results[stage.name] = measure(stage, repeat, memory)
+        logging.info(f"{stage.name}: {format_result(results[stage.name])}")
+    return results
+
+
+def format_result(result):
+    text = f"{result['seconds']:.4f}s"
+    if result.get("per_second"):
+        text += f", {result['per_second']:,} {result['unit']}/s"
+    if "peak_mib" in result:
+        text += f", peak {result['peak_mib']:.2f} MiB"
+    return text
+
+
+def machine():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baselines_file:
+        return json.load(baselines_file)
+
+
+def save_baseline(path, key, results, config):
+    baselines = load_baselines(path)
+    baselines[key] = {"config": config, "machine": machine(), "stages": results}
+    with open(path, "w") as baselines_file:
+        json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+        baselines_file.write("\n")
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Returns a description of every stage that is slower or uses more memory than its baseline"""
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get("stages", {}).get(name)
+        if not expected:
+            continue
+        for metric in ("seconds", "peak_mib"):
+            if metric in result and expected.get(metric) and result[metric] > expected[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric} {result[metric]} > baseline {expected[metric]}")
+    return regressions
+
+
+def compare_sizes(sizes, baseline, tolerance=0.25):
+    """Returns a description of every size that is larger than its baseline"""
+    regressions = []
+    for name, size in sizes.items():
+        expected = baseline.get("config", {}).get("sizes", {}).get(name)
+        if expected and size > expected * (1 + tolerance):
+            regressions.append(f"{name} {size} > baseline {expected}")
+    return regressions
+
+
+def report(results, baseline=None):
+    """Prints a table of the results, relative to the baseline if there is one"""
+    stages = baseline.get("stages", {}) if baseline else {}
+    print(f"{'stage':<28}{'seconds':>10}{'per second':>16}{'peak MiB':>10}{'vs baseline':>13}")
+    for name, result in results.items():
+        expected = stages.get(name)
+        relative = f"{result['seconds'] / expected['seconds']:.2f}x" if expected and expected["seconds"] else "-"
+        per_second = f"{result['per_second']:,}" if result.get("per_second") else "-"
+        peak = f"{result['peak_mib']:.2f}" if "peak_mib" in result else "-"
+        print(f"{name:<28}{result['seconds']:>10.4f}{per_second:>16}{peak:>10}{relative:>13}")
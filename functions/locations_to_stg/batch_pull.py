@@ -0,0 +1,110 @@
+import logging
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from google.api_core import exceptions as gcp_exceptions
+
+logging.basicConfig(level=logging.INFO)
+
+# Pub/Sub returns at most 1000 messages in one pull
+BATCH_SIZE = 1000
+
+
+class BatchPuller(object):
+    """Pulls messages in batches with synchronous pull requests, several pulls are in flight at a time
+
+    Every batch is handled as a whole by handle_batch, which gets the messages and a function that
+    acknowledges the batch with one request, to call once its locations are stored. Until then the
+    ack deadline of pulled messages is extended, so they are not redelivered while the pull or the
+    storage write is still running.
+    """
+
+    def __init__(self, subscriber, subscription_path, handle_batch, batch_size=BATCH_SIZE, pulls_in_flight=4,
+                 ack_deadline_seconds=60, pull_timeout=10):
+        self.subscriber = subscriber
+        self.subscription_path = subscription_path
+        self.handle_batch = handle_batch
+        self.batch_size = batch_size
+        self.pulls_in_flight = pulls_in_flight
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self.pull_timeout = pull_timeout
+
+        self.batches = 0
+        self._leased = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._released = threading.Event()
+        self._executor = None
+        self._pulls = []
+        self._lease = None
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.pulls_in_flight)
+        self._pulls = [self._executor.submit(self.pull) for _ in range(self.pulls_in_flight)]
+        self._lease = threading.Thread(target=self.lease, daemon=True)
+        self._lease.start()
+
+    def pull(self):
+        while not self._stopped.is_set():
+            try:
+                response = self.subscriber.pull(
+                    request={"subscription": self.subscription_path, "max_messages": self.batch_size},
+                    timeout=self.pull_timeout
+                )
+            except gcp_exceptions.DeadlineExceeded:
+                continue
+            if not response.received_messages:
+                continue
+            ack_ids = [received.ack_id for received in response.received_messages]
+            # The deadline of the subscription can be shorter than the time until the batch is stored
+            self.subscriber.modify_ack_deadline(request={
+                "subscription": self.subscription_path,
+                "ack_ids": ack_ids,
+                "ack_deadline_seconds": self.ack_deadline_seconds
+            })
+            with self._lock:
+                self.batches += 1
+                batch = self.batches
+                self._leased[batch] = ack_ids
+            self.handle_batch([received.message for received in response.received_messages],
+                              lambda batch=batch: self.acknowledge(batch))
+
+    def wait(self, timeout):
+        """Waits at most timeout seconds, returns True if every pull ended, raises the error of a failed pull"""
+        done, _ = wait(self._pulls, timeout, return_when=FIRST_EXCEPTION)
+        for pull in done:
+            pull.result()
+        return len(done) == len(self._pulls)
+
+    def stop(self):
+        """Stops pulling, waits for the pulls in flight to be handled"""
+        self._stopped.set()
+        self._executor.shutdown(wait=True)
+
+    def lease(self):
+        # Extend the deadlines halfway through, every batch with one request
+        while not self._released.wait(self.ack_deadline_seconds / 2):
+            self.modify_ack_deadlines(self.ack_deadline_seconds)
+
+    def modify_ack_deadlines(self, ack_deadline_seconds):
+        with self._lock:
+            batches = list(self._leased.values())
+        for ack_ids in batches:
+            self.subscriber.modify_ack_deadline(request={
+                "subscription": self.subscription_path,
+                "ack_ids": ack_ids,
+                "ack_deadline_seconds": ack_deadline_seconds
+            })
+
+    def acknowledge(self, batch):
+        with self._lock:
+            ack_ids = self._leased.pop(batch, None)
+        if ack_ids:
+            self.subscriber.acknowledge(request={"subscription": self.subscription_path, "ack_ids": ack_ids})
+
+    def release(self):
+        """Stops extending deadlines, batches that are not acknowledged become available for redelivery"""
+        self._released.set()
+        self.modify_ack_deadlines(0)
+        with self._lock:
+            self._leased = {}
@@ -1,8 +1,15 @@
 import json
-from datetime import datetime, timezone
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as PullTimeoutError
+from datetime import datetime, timedelta, timezone
 from google.cloud import storage, pubsub_v1, exceptions as gcp_exceptions
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 import config
-from stg_updater import process_carsloc_msg, locations_to_stg
+from batch_pull import BatchPuller
+from columnar import columnar_blob_name
+from compact import compact_blob_name
+from stg_updater import LocationsAccumulator, compact_segments, locations_to_stg
 import os
 import logging
 
@@ -11,39 +18,198 @@ logging.basicConfig(level=logging.INFO)
 storage_client = storage.Client()
 storage_bucket = storage_client.get_bucket(config.GCP_BUCKET_CAR_LOCATIONS)
 
-car_licenses = {}
-analyze_date = None
+accumulator = None
+flusher = None
+gate = None
 
 
 def callback_handle_message(carsloc_msg):
-    global analyze_date
-    global car_licenses
-    carsloc_json = json.loads(carsloc_msg.data.decode())
-    process_carsloc_msg(carsloc_json, car_licenses, analyze_date)
-    carsloc_msg.ack()
+    # Runs on the callback threads of the subscriber, the accumulator is safe to share between them
+    if not gate.enter():
+        # The pull is stopping, the message is redelivered to the next run
+        carsloc_msg.nack()
+        return
+    try:
+        carsloc_json = json.loads(carsloc_msg.data.decode())
+        if flusher.flushing:
+            # The message is acknowledged once its locations are flushed
+            accumulator.add_message(carsloc_json, carsloc_msg.ack)
+        else:
+            accumulator.add_message(carsloc_json)
+            carsloc_msg.ack()
+    finally:
+        gate.exit()
 
 
-def retrieve_and_parse_carsloc_msgs(request):
-    global analyze_date
-    global car_licenses
-    # Get analyze date in utc
-    now_utc = datetime.now(timezone.utc)
-    analyze_date = now_utc.date()
+def handle_batch(carsloc_msgs, acknowledge):
+    # Runs on the pull threads of the batch puller, every pull hands over its batch at once
+    for carsloc_msg in carsloc_msgs:
+        accumulator.add_message(json.loads(carsloc_msg.data.decode()))
+    # The batch is acknowledged once its locations are stored
+    accumulator.hold(acknowledge)
 
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(config.PUBSUB_PROJECT_ID, config.PUBSUB_SUBSCRIPTION_NAME)
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback_handle_message)
-    logging.info(f"Listening for messages on {subscription_path}...")
+
+class Flusher(object):
+    """Stores the accumulated locations, then acknowledges their messages
+
+    If flush_messages or flush_seconds is set, locations are also stored during the pull, every
+    flush_messages messages or flush_seconds seconds, which keeps the memory of a long pull bounded.
+    """
+
+    def __init__(self, store, flush_messages=None, flush_seconds=None):
+        self.store = store
+        self.flush_messages = flush_messages
+        self.flush_seconds = flush_seconds
+        self.flushing = bool(flush_messages or flush_seconds)
+        self.flushes = 0
+        self._flushed_at = time.monotonic()
+
+    def maybe_flush(self):
+        if (self.flush_messages and accumulator.pending >= self.flush_messages) or \
+                (self.flush_seconds and time.monotonic() - self._flushed_at >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        car_licenses, acks = accumulator.take()
+        if car_licenses:
+            self.store(car_licenses)
+        # Only acknowledge the messages once their locations are stored
+        for ack in acks:
+            ack()
+        self.flushes += 1
+        # Messages that were received during the flush wait for the next one
+        logging.info(f"Flushed locations of {len(car_licenses)} cars and acknowledged their messages, "
+                     f"{accumulator.pending} messages are not flushed yet")
+
+
+class CallbackGate(object):
+    """Lets subscriber callbacks handle messages until it is closed
+
+    Closing waits for the callbacks that are running, callbacks that start later do not handle their message.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._running = 0
+        self._closed = False
+
+    def enter(self):
+        with self._condition:
+            if self._closed:
+                return False
+            self._running += 1
+            return True
+
+    def exit(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def close(self, timeout=None):
+        """Closes the gate, returns False if callbacks are still running after timeout seconds"""
+        with self._condition:
+            self._closed = True
+            return self._condition.wait_for(lambda: self._running == 0, timeout)
+
+
+def drain(wait_pull, idle_seconds, max_seconds, max_messages=None, poll_seconds=1):
+    """Waits until the subscription is drained, returns why it stopped
+
+    It is drained if no message arrived for idle_seconds, or if max_seconds passed
+    or max_messages messages were received since it started. wait_pull waits at most
+    a number of seconds and returns True if the pull ended by itself.
+    """
+    started_at = time.monotonic()
+    while True:
+        if wait_pull(poll_seconds):
+            return "pull ended"
+        if flusher.flushing:
+            flusher.maybe_flush()
+        now = time.monotonic()
+        if max_messages and accumulator.messages >= max_messages:
+            return f"reached {max_messages} messages"
+        if now - started_at >= max_seconds:
+            return f"reached {max_seconds}s"
+        last_message_at = accumulator.last_message_at if accumulator.last_message_at else started_at
+        if now - last_message_at >= idle_seconds:
+            return f"no messages for {idle_seconds}s"
+
+
+def pull_streaming(subscriber, subscription_path, idle_seconds, max_seconds, max_messages):
+    """Receives messages with a streaming pull until the subscription is drained, returns why it stopped"""
+    # Number of messages and bytes that are handled at the same time, and the number of callback threads
+    # Messages that wait for a flush count as handled, so FLUSH_MESSAGES should be below the maximum
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=config.FLOW_CONTROL_MAX_MESSAGES if hasattr(config, 'FLOW_CONTROL_MAX_MESSAGES') else 1000,
+        max_bytes=config.FLOW_CONTROL_MAX_BYTES if hasattr(config, 'FLOW_CONTROL_MAX_BYTES') else 100 * 1024 * 1024
+    )
+    callback_workers = config.CALLBACK_WORKERS if hasattr(config, 'CALLBACK_WORKERS') else 10
+    # Seconds the running callbacks get to finish once the subscription is drained
+    callback_timeout = config.CALLBACK_TIMEOUT_SECONDS if hasattr(config, 'CALLBACK_TIMEOUT_SECONDS') else 60
+    callback_executor = ThreadPoolExecutor(max_workers=callback_workers)
+    scheduler = ThreadScheduler(executor=callback_executor)
+
+    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback_handle_message,
+                                                 flow_control=flow_control, scheduler=scheduler)
+    logging.info(f"Listening for messages on {subscription_path} with {callback_workers} callback threads...")
+
+    def wait_pull(timeout):
+        try:
+            streaming_pull_future.result(timeout=timeout)
+            return True
+        except PullTimeoutError:
+            return False
 
     # Wrap subscriber in a 'with' block to automatically call close() when done.
     with subscriber:
         try:
-            streaming_pull_future.result(timeout=300)
+            stop_reason = drain(wait_pull, idle_seconds, max_seconds, max_messages)
+            # Messages can only be acknowledged while the stream is open, so the last flush waits
+            # for the running callbacks but happens before the stream is cancelled
+            if not gate.close(timeout=callback_timeout):
+                logging.warning(f"Callbacks are still running after {callback_timeout}s, "
+                                f"their messages are redelivered")
+            if flusher.flushing:
+                flusher.flush()
         except Exception as e:
-            streaming_pull_future.cancel()
+            stop_reason = "exception"
             logging.info(f"Listening for messages on {subscription_path} threw an exception: {e}.")
+        streaming_pull_future.cancel()
 
     subscriber.close()
+    # Wait for the callbacks of messages that arrived while the stream closed, they do not handle them
+    callback_executor.shutdown(wait=True)
+    return stop_reason
+
+
+def pull_batches(puller, idle_seconds, max_seconds, max_messages):
+    """Pulls batches of messages until the subscription is drained, returns why it stopped
+
+    The messages are acknowledged by the puller once their locations are stored.
+    """
+    puller.start()
+    logging.info(f"Pulling batches of messages on {puller.subscription_path} "
+                 f"with {puller.pulls_in_flight} pulls in flight...")
+    try:
+        stop_reason = drain(puller.wait, idle_seconds, max_seconds, max_messages)
+    except Exception as e:
+        stop_reason = "exception"
+        logging.info(f"Pulling messages on {puller.subscription_path} threw an exception: {e}.")
+    # Wait for the pulls in flight, so no locations are added while they are stored
+    puller.stop()
+    return stop_reason
+
+
+def retrieve_and_parse_carsloc_msgs(request):
+    global accumulator
+    global flusher
+    global gate
+    # Get analyze date in utc
+    now_utc = datetime.now(timezone.utc)
+    analyze_date = now_utc.date()
+    accumulator = LocationsAccumulator(analyze_date)
+    gate = CallbackGate()
 
     file_name_locations = str(os.environ.get("FILE_NAME"))
     if not file_name_locations:
@@ -51,9 +217,97 @@ def retrieve_and_parse_carsloc_msgs(request):
     if not file_name_locations.endswith(".json"):
         logging.error("Argument FILE_NAME should have json extension")
 
-    try:
+    # Locations are stored as JSON, or in the columnar or compact format if LOCATIONS_FORMAT is 'columnar'
+    # or 'compact'
+    storage_format = config.LOCATIONS_FORMAT if hasattr(config, 'LOCATIONS_FORMAT') else 'json'
+    file_name_locations = locations_file_name(file_name_locations, storage_format)
+    # Locations are stored in one file per day, in shards of licenses if LOCATIONS_LAYOUT is 'sharded',
+    # or in a segment per run if it is 'segments'
+    layout = config.LOCATIONS_LAYOUT if hasattr(config, 'LOCATIONS_LAYOUT') else 'day'
+
+    def store(car_licenses):
         # Put locations in storage
-        locations_to_stg(analyze_date, car_licenses, storage_client, storage_bucket, file_name_locations)
+        locations_to_stg(analyze_date, car_licenses, storage_client, storage_bucket, file_name_locations,
+                         storage_format, layout)
+
+    # Locations are stored at the end of the pull, and also every FLUSH_MESSAGES messages
+    # or FLUSH_SECONDS seconds if one of them is set
+    flusher = Flusher(
+        store,
+        flush_messages=config.FLUSH_MESSAGES if hasattr(config, 'FLUSH_MESSAGES') else None,
+        flush_seconds=config.FLUSH_SECONDS if hasattr(config, 'FLUSH_SECONDS') else None
+    )
+
+    # Listen until no message arrived for DRAIN_IDLE_SECONDS, or for at most DRAIN_MAX_SECONDS
+    # or DRAIN_MAX_MESSAGES messages
+    idle_seconds = config.DRAIN_IDLE_SECONDS if hasattr(config, 'DRAIN_IDLE_SECONDS') else 30
+    max_seconds = config.DRAIN_MAX_SECONDS if hasattr(config, 'DRAIN_MAX_SECONDS') else 300
+    max_messages = config.DRAIN_MAX_MESSAGES if hasattr(config, 'DRAIN_MAX_MESSAGES') else None
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(config.PUBSUB_PROJECT_ID, config.PUBSUB_SUBSCRIPTION_NAME)
+    started_at = time.monotonic()
+
+    # Messages are received with a streaming pull, or in batches of synchronous pulls if PULL_MODE is 'batch'
+    pull_mode = config.PULL_MODE if hasattr(config, 'PULL_MODE') else 'streaming'
+    puller = None
+    if pull_mode == 'batch':
+        puller = BatchPuller(
+            subscriber, subscription_path, handle_batch,
+            pulls_in_flight=config.PULLS_IN_FLIGHT if hasattr(config, 'PULLS_IN_FLIGHT') else 4
+        )
+        stop_reason = pull_batches(puller, idle_seconds, max_seconds, max_messages)
+    else:
+        stop_reason = pull_streaming(subscriber, subscription_path, idle_seconds, max_seconds, max_messages)
+
+    seconds = time.monotonic() - started_at
+    logging.info(f"Stopped {pull_mode} pull ({stop_reason}), received {accumulator.messages} messages "
+                 f"with {accumulator.locations} new locations in {seconds:.1f}s, "
+                 f"{accumulator.messages / seconds:.1f} messages per second, {flusher.flushes} flushes")
+
+    try:
+        # Store the locations that are not flushed yet
+        flusher.flush()
+    except gcp_exceptions.ServiceUnavailable as e:
+        logging.info("One or more GCP services are unavailable")
+        logging.debug(e)
+        return 400
+    finally:
+        if puller:
+            # Batches that are not acknowledged are redelivered
+            puller.release()
+            subscriber.close()
+
+
+def locations_file_name(file_name_locations, storage_format):
+    if storage_format == 'columnar':
+        return columnar_blob_name(file_name_locations)
+    if storage_format == 'compact':
+        return compact_blob_name(file_name_locations)
+    return file_name_locations
+
+
+def compact_locations(request):
+    """Merges the segments of a day into its locations file, run before the trips of the day are made
+
+    Compacts yesterday, or the day of argument date in format YYYY-MM-DD.
+    """
+    args = request.args if request is not None else {}
+    try:
+        if 'date' in args:
+            compact_date = datetime.strptime(args['date'], "%Y-%m-%d").date()
+        else:
+            compact_date = datetime.now(timezone.utc).date() - timedelta(1)
+    except ValueError:
+        logging.error("Argument date should have format YYYY-MM-DD")
+        return "Bad Request", 400
+
+    file_name_locations = str(os.environ.get("FILE_NAME"))
+    storage_format = config.LOCATIONS_FORMAT if hasattr(config, 'LOCATIONS_FORMAT') else 'json'
+    file_name_locations = locations_file_name(file_name_locations, storage_format)
+
+    try:
+        compact_segments(compact_date, storage_client, storage_bucket, file_name_locations, storage_format)
     except gcp_exceptions.ServiceUnavailable as e:
         logging.info("One or more GCP services are unavailable")
         logging.debug(e)
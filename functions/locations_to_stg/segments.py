@@ -0,0 +1,87 @@
+import datetime
+import logging
+import os
+import posixpath
+import uuid
+from heapq import merge
+from operator import itemgetter
+
+logging.basicConfig(level=logging.INFO)
+
+# Log-structured storage of the locations of one day, shared by locations_to_stg and update_car_trips
+#
+# Every run of locations_to_stg writes the locations it received to a new, immutable segment
+# YYYY/MM/DD/segments/<file name without extension>.<UTC time>.<unique id><extension>.
+# Compaction merges the segments of a day into the locations blob YYYY/MM/DD/<file name> and removes them.
+# Readers merge the locations blob with the segments that are not compacted yet.
+
+SEGMENTS_FOLDER = "segments"
+
+
+def segment_prefix(blob_name):
+    folder, file_name = posixpath.split(blob_name)
+    return f"{folder}/{SEGMENTS_FOLDER}/{os.path.splitext(file_name)[0]}."
+
+
+def segment_blob_name(blob_name, written_at=None):
+    """Returns a new segment name of a locations blob, segments of one blob sort on the time they were written"""
+    written_at = written_at if written_at else datetime.datetime.now(datetime.timezone.utc)
+    extension = os.path.splitext(blob_name)[1]
+    return f"{segment_prefix(blob_name)}{written_at:%Y%m%dT%H%M%S}.{uuid.uuid4().hex[:8]}{extension}"
+
+
+def list_segments(storage_bucket, blob_name):
+    """Returns the segments of a locations blob, in the order they were written"""
+    extension = os.path.splitext(blob_name)[1]
+    segments = [segment for segment in storage_bucket.list_blobs(prefix=segment_prefix(blob_name))
+                if segment.name.endswith(extension)]
+    return sorted(segments, key=lambda segment: segment.name)
+
+
+def merge_cars(parts):
+    """Merges the cars of the locations blob and segments of a day
+
+    Every part yields (license hash, license, locations) with 'when' in epoch seconds. Returns a dict
+    of the license and the locations of every hashed license. Locations are ordered on time and a
+    location that is equal to an earlier location is dropped.
+    """
+    cars = {}
+    for part in parts:
+        for license_hash, car_license, locations in part:
+            car = cars.setdefault(license_hash, {"license": car_license, "locations": []})
+            car["locations"].append(sorted_locations(locations))
+    for car in cars.values():
+        car["locations"] = unique_locations(merge(*car["locations"], key=itemgetter("when")))
+    return cars
+
+
+def sorted_locations(locations):
+    # Locations are sorted, unless they were stored before locations were merged on time
+    if any(locations[i]["when"] > locations[i + 1]["when"] for i in range(len(locations) - 1)):
+        return sorted(locations, key=itemgetter("when"))
+    return locations
+
+
+def unique_locations(locations):
+    """Returns the locations without locations that are equal to an earlier location"""
+    unique = []
+    keys = set()
+    for location in locations:
+        key = location_key(location)
+        if key not in keys:
+            keys.add(key)
+            unique.append(location)
+    return unique
+
+
+def location_key(location):
+    """Returns a hashable key of a location, equal locations have equal keys"""
+    return location["when"], location["what"], freeze(location["geometry"])
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
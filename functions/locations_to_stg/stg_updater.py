@@ -1,113 +1,291 @@
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge
+from google.api_core import exceptions as gcp_exceptions
 from google.cloud import storage
+from columnar import DayColumns, columnar_to_json, json_to_columnar, quantize_location
+from compact import compact_to_json, json_to_compact, read_cars
+from segments import (list_segments, location_key, merge_cars, segment_blob_name, sorted_locations,
+                      unique_locations)
+from shards import SHARD_PREFIX_LENGTH, add_to_manifest, read_manifest, shard_blob_name, shard_of
+from timestamps import SECONDS_PER_DAY, day_start, format_locations, parse_locations, parse_when
 import json
-from datetime import datetime, timezone
 import logging
+import threading
+import time
+from operator import itemgetter
 
 logging.basicConfig(level=logging.INFO)
 
+# Number of locks of the licenses of a LocationsAccumulator
+LOCK_STRIPES = 64
+
 
 def process_carsloc_msg(carsloc_msg, car_licenses, analyze_date):
+    for car_license, license_hash, location in parse_carsloc_msg(carsloc_msg, analyze_date):
+        add_car_location(car_licenses, car_license, license_hash, location)
+
+
+def parse_carsloc_msg(carsloc_msg, analyze_date):
+    """Yields (license, hashed license, location) for every location of today in a message"""
     # List of locations gotten from message
     carsmsglocations_list = carsloc_msg['carlocations']
+    # Locations of today are from its start up to the start of tomorrow, in epoch seconds
+    analyze_start = day_start(analyze_date)
+    analyze_end = analyze_start + SECONDS_PER_DAY
     # For every location in the message
     for loc in carsmsglocations_list:
+        # Set the when of the location to UTC epoch seconds
+        loc['when'] = parse_when(loc['when'])
         # Skip location if it's not today's date
-        when = datetime.strptime(loc['when'], "%Y-%m-%dT%H:%M:%SZ")
-        # Convert 'when' to UTC time
-        when_timestamp = when.timestamp()
-        when_utc = datetime.fromtimestamp(when_timestamp, tz=timezone.utc)
-        when_iso = when_utc.isoformat()
-        # Remove the +... behind the timestamp
-        # and set the when of the location to UTC time
-        loc['when'] = when_iso.split('+')[0]
-        when = datetime.strptime(loc['when'], "%Y-%m-%dT%H:%M:%S")
-        # Check if it's today's date
-        if when.date() != analyze_date:
-            logging.debug(f"Skipping message for {when.date()} while processing {analyze_date}")
+        if not analyze_start <= loc['when'] < analyze_end:
+            logging.debug(f"Skipping message for {loc['when']} while processing {analyze_date}")
             continue
         # Skip location if it does not have a hashed license
         license_hash = loc.get('license_hash', None)
         if not license_hash:
-            logging.debug(f"Skipping message for {when.date()} while processing {analyze_date} \
+            logging.debug(f"Skipping message for {loc['when']} while processing {analyze_date} \
                             because it does not have a hashed license")
             continue
-        # Else check if the car's license is already in car_locations
-        car = car_licenses.get(loc['license'], None)
-        # If it is
-        if car:
-            car_loc = {
-                "when": loc['when'],
-                "geometry": loc['geometry'],
-                "what": loc['what']
-            }
-            # Add car location to the locations key
-            car['locations'].append(car_loc)
-            # Also sort car's locations on time
-            car['locations'] = sorted(car['locations'],
-                                      key=lambda k: k.get('when', 0), reverse=False)
-        # If it is not
+        yield loc['license'], license_hash, {
+            "when": loc['when'],
+            "geometry": loc['geometry'],
+            "what": loc['what']
+        }
+
+
+def add_car_location(car_licenses, car_license, license_hash, location):
+    """Adds a location to the car's locations, returns False if it is a duplicate"""
+    # Get the car's locations, or start them if this is its first location
+    car = car_licenses.get(car_license, None)
+    if not car:
+        car = CarLocations(license_hash)
+        car_licenses[car_license] = car
+    # Add car location, it is kept in order of time and dropped if it is a duplicate
+    return car.add(location)
+
+
+class LocationsAccumulator(object):
+    """Car locations of one pull, safe to add to from the callback threads of the subscriber
+
+    Licenses are spread over a fixed number of stripes, each with its own lock, so callbacks
+    only wait for each other if their locations are of licenses in the same stripe.
+    The locations can be taken to be stored while the pull continues, together with the
+    acknowledgements of their messages.
+    """
+
+    def __init__(self, analyze_date, stripes=LOCK_STRIPES):
+        self.analyze_date = analyze_date
+        self.car_licenses = {}
+        self.messages = 0
+        self.locations = 0
+        self.pending = 0
+        self.last_message_at = None
+        self._acks = []
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._stats_lock = threading.Lock()
+
+    def add_message(self, carsloc_msg, ack=None):
+        """Adds the locations of a decoded message, returns the number of locations that were new
+
+        The ack function is called by whoever takes the locations, once they are stored.
+        """
+        added = 0
+        for car_license, license_hash, location in parse_carsloc_msg(carsloc_msg, self.analyze_date):
+            # Adding a license to car_licenses is a single dict operation, which is atomic
+            with self._stripes[hash(car_license) % len(self._stripes)]:
+                added += add_car_location(self.car_licenses, car_license, license_hash, location)
+        with self._stats_lock:
+            self.messages += 1
+            self.locations += added
+            self.pending += 1
+            self.last_message_at = time.monotonic()
+            if ack:
+                self._acks.append(ack)
+        return added
+
+    def hold(self, ack):
+        """Adds an ack function of messages that were already added"""
+        with self._stats_lock:
+            self._acks.append(ack)
+
+    def take(self):
+        """Returns the car locations and ack functions added since the last take, and starts new ones"""
+        for stripe in self._stripes:
+            stripe.acquire()
+        try:
+            with self._stats_lock:
+                car_licenses, self.car_licenses = self.car_licenses, {}
+                acks, self._acks = self._acks, []
+                self.pending = 0
+        finally:
+            for stripe in self._stripes:
+                stripe.release()
+        return car_licenses, acks
+
+
+class CarLocations(object):
+    """Locations of one car, ordered on time without duplicates
+
+    Locations mostly arrive in order and are appended, a late location is inserted
+    after the locations with the same time, so the order is the same as sorting
+    the locations on time in order of arrival.
+    """
+
+    def __init__(self, license_hash):
+        self.license_hash = license_hash
+        self.locations = []
+        self._whens = []
+        self._keys = set()
+
+    def add(self, location):
+        key = location_key(location)
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        when = location['when']
+        if not self._whens or when >= self._whens[-1]:
+            self._whens.append(when)
+            self.locations.append(location)
         else:
-            # Add the car location with its license to the car_locations
-            car_loc = {
-                "when": loc['when'],
-                "geometry": loc['geometry'],
-                "what": loc['what']
-            }
-            car = {
-                loc['license']: {
-                    "locations": [car_loc],
-                    "license_hash": license_hash
-                }
-            }
-            car_licenses.update(car)
+            i = bisect_right(self._whens, when)
+            self._whens.insert(i, when)
+            self.locations.insert(i, location)
+        return True
+
+
+def merge_locations(blob_locations, car_locations, start, end):
+    """Returns the locations in blob and the new car locations from start up to end, ordered on time
+
+    Both are merged as sorted streams, the locations in blob go first if times are equal.
+    A location that is equal to an earlier location is dropped.
+    """
+    merged = merge(sorted_locations(blob_locations), car_locations, key=itemgetter('when'))
+    return unique_locations(location for location in merged if start <= location['when'] < end)
 
 
-def locations_to_stg(analyze_date, car_licenses, storage_client, storage_bucket, file_name_locations):
+def locations_to_stg(analyze_date, car_licenses, storage_client, storage_bucket, file_name_locations,
+                     storage_format='json', layout='day'):
     # Get date for the storage bucket
     year = analyze_date.year
     month = '{:02d}'.format(analyze_date.month)
     day = '{:02d}'.format(analyze_date.day)
     bucket_folder = '{}/{}/{}'.format(year, month, day)
     blob_name = f"{bucket_folder}/{file_name_locations}"
+    # Locations of today are from its start up to the start of tomorrow, in epoch seconds
+    analyze_start = day_start(analyze_date)
+    analyze_end = analyze_start + SECONDS_PER_DAY
+    if storage_format in ('columnar', 'compact'):
+        # Store coordinates as precise as the columnar and compact formats, so stored locations compare equal
+        for car_license in car_licenses:
+            car_licenses[car_license].locations = [
+                quantize_location(loc) for loc in car_licenses[car_license].locations]
+    # If car licenses is empty, there is nothing to store
+    if not car_licenses:
+        return
+    if layout == 'sharded':
+        # Only update the shards of the licenses that have new locations
+        update_shards(car_licenses, storage_bucket, blob_name, storage_format, analyze_start, analyze_end)
+    elif layout == 'segments':
+        # Only write the new locations, compaction merges them into the locations blob later
+        write_segment(car_licenses, storage_bucket, blob_name, storage_format)
+    else:
+        update_locations_blob(car_licenses, storage_client, storage_bucket, blob_name, storage_format,
+                              analyze_start, analyze_end)
+    logging.info("Locations have been added to storage file")
+
+
+def update_shards(car_licenses, storage_bucket, blob_name, storage_format, analyze_start, analyze_end,
+                  max_workers=8):
+    """Adds the car locations to the shards of their licenses concurrently, and the shards to the manifest"""
+    # The manifest keeps the prefix length of the day, so every run shards licenses the same way
+    manifest = read_manifest(storage_bucket, blob_name)
+    if manifest is None:
+        manifest = {"prefix_length": SHARD_PREFIX_LENGTH, "shards": []}
+    shards = {}
+    for car_license, car in car_licenses.items():
+        shards.setdefault(shard_of(car.license_hash, manifest["prefix_length"]), {})[car_license] = car
+
+    def update(shard):
+        update_shard(shards[shard], storage_bucket, shard_blob_name(blob_name, shard), storage_format,
+                     analyze_start, analyze_end)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Raises the error of the first shard that could not be updated
+        list(executor.map(update, sorted(shards)))
+    # The manifest is written after the shards, so every shard in it exists
+    manifest = add_to_manifest(storage_bucket, blob_name, shards, manifest["prefix_length"])
+    logging.info(f"Updated {len(shards)} of {len(manifest['shards'])} shards of '{blob_name}'")
+
+
+def update_shard(car_licenses, storage_bucket, blob_name, storage_format, analyze_start, analyze_end,
+                 max_attempts=5):
+    """Adds the car locations to a shard, if no other run wrote the shard since it was read
+
+    A shard that another run wrote in the meantime is read and merged again. If it keeps changing,
+    the error is raised and the messages of the locations are not acknowledged.
+    """
+    for attempt in range(1, max_attempts + 1):
+        blob = storage_bucket.get_blob(blob_name)
+        blob_json = read_blob_json(blob, storage_format) if blob is not None else {}
+        add_locations(blob_json, car_licenses, analyze_start, analyze_end)
+        try:
+            # Generation 0 only matches a shard that does not exist yet
+            upload_locations(storage_bucket.blob(blob_name), blob_json, storage_format,
+                             if_generation_match=blob.generation if blob is not None else 0)
+        except gcp_exceptions.PreconditionFailed:
+            if attempt == max_attempts:
+                raise
+            logging.info(f"Shard '{blob_name}' was written by another run, merging the locations again")
+        else:
+            return
+
+
+def update_locations_blob(car_licenses, storage_client, storage_bucket, blob_name, storage_format, analyze_start,
+                          analyze_end):
+    """Adds the car locations to a locations blob"""
     # Check if locations file is already in storage
     if storage.Blob(bucket=storage_bucket, name=blob_name).exists(storage_client):
         # If it is, get it
-        blob = storage_bucket.get_blob(blob_name)
-        # Convert to string
-        blob_json_string = blob.download_as_string()
-        # Convert to json
-        blob_json = json.loads(blob_json_string)
+        blob_json = read_blob_json(storage_bucket.get_blob(blob_name), storage_format)
     else:
         # If it is not, make a new one
         blob_json = {}
+    add_locations(blob_json, car_licenses, analyze_start, analyze_end)
+    # Update the blob_json to storage
+    upload_locations(storage_bucket.blob(blob_name), blob_json, storage_format)
+
+
+def read_blob_json(blob, storage_format):
+    """Returns the cars of a locations blob, with the when of their locations in epoch seconds"""
+    if storage_format == 'columnar':
+        # Convert from columnar format
+        return columnar_to_json(blob.download_as_bytes())
+    if storage_format == 'compact':
+        # Convert from compact format
+        return compact_to_json(blob.download_as_bytes())
+    # Convert to string
+    blob_json_string = blob.download_as_string()
+    # Convert to json
+    blob_json = json.loads(blob_json_string)
+    # Set the when of the locations to epoch seconds
+    for car in blob_json.values():
+        parse_locations(car['locations'])
+    return blob_json
+
+
+def add_locations(blob_json, car_licenses, analyze_start, analyze_end):
+    """Adds the car locations to the cars of a locations blob, the car locations are left unchanged"""
     # For every license
     for car_license in car_licenses:
         # hashed license
-        license_hash = car_licenses[car_license]['license_hash']
+        license_hash = car_licenses[car_license].license_hash
         # Check if hashed license is already in blob_json
         license_in_blob = blob_json.get(license_hash)
         if license_in_blob:
-            # If it is, update the license info
-            # Get locations of license
-            locations = blob_json[license_hash]['locations']
-            # Make new locations
-            new_locations = []
-            # For every location already in blob
-            for blob_loc in locations:
-                # Check if location has today's date and is not already in new locations
-                when_blob_loc = datetime.strptime(blob_loc['when'], "%Y-%m-%dT%H:%M:%S")
-                if when_blob_loc.date() == analyze_date and blob_loc not in new_locations:
-                    # If it does, add it to new locations
-                    new_locations.append(blob_loc)
-            # For every location
-            for loc in car_licenses[car_license]['locations']:
-                # If the location is not yet in new_locations
-                if loc not in new_locations:
-                    # And the location has today as date
-                    when_loc = datetime.strptime(loc['when'], "%Y-%m-%dT%H:%M:%S")
-                    if when_loc.date() == analyze_date:
-                        # Add location
-                        new_locations.append(loc)
+            # If it is, merge the locations already in blob with the new locations of today
+            new_locations = merge_locations(blob_json[license_hash]['locations'],
+                                            car_licenses[car_license].locations, analyze_start, analyze_end)
             # If new locations is not empty
             if new_locations:
                 # Set license locations to new locations
@@ -122,16 +300,83 @@ def locations_to_stg(analyze_date, car_licenses, storage_client, storage_bucket,
             car = {
                 license_hash: {
                     "license": car_license,
-                    "locations": car_licenses[car_license]['locations']
+                    "locations": car_licenses[car_license].locations
                 }
             }
             blob_json.update(car)
-    # If car licenses is not empty
-    if car_licenses:
-        # Update the blob_json to storage
-        new_blob = storage_bucket.blob(blob_name)
+
+
+def upload_locations(new_blob, blob_json, storage_format, if_generation_match=None):
+    if storage_format == 'columnar':
+        new_blob.upload_from_string(
+            data=json_to_columnar(blob_json),
+            content_type='application/octet-stream',
+            if_generation_match=if_generation_match
+        )
+    elif storage_format == 'compact':
+        new_blob.upload_from_string(
+            data=json_to_compact(blob_json),
+            content_type='application/gzip',
+            if_generation_match=if_generation_match
+        )
+    else:
+        # Store the when of the locations in the stored format
+        for car in blob_json.values():
+            car['locations'] = format_locations(car['locations'])
         new_blob.upload_from_string(
             data=json.dumps(blob_json, indent=2),
-            content_type='application/json'
+            content_type='application/json',
+            if_generation_match=if_generation_match
         )
-        logging.info("Locations have been added to storage file")
+
+
+def write_segment(car_licenses, storage_bucket, blob_name, storage_format):
+    """Stores the car locations in a new segment of a locations blob"""
+    segment_name = segment_blob_name(blob_name)
+    blob_json = {
+        car.license_hash: {"license": car_license, "locations": car.locations}
+        for car_license, car in car_licenses.items()
+    }
+    upload_locations(storage_bucket.blob(segment_name), blob_json, storage_format)
+    logging.info(f"Stored locations of {len(blob_json)} cars in segment '{segment_name}'")
+
+
+def compact_segments(analyze_date, storage_client, storage_bucket, file_name_locations, storage_format='json'):
+    """Merges the segments of a day into its locations blob and removes them
+
+    Segments written while compacting are left for the next compaction. Compacting again after a
+    failure is safe, since locations that are already in the locations blob are dropped.
+    """
+    blob_name = '{}/{:02d}/{:02d}/{}'.format(analyze_date.year, analyze_date.month, analyze_date.day,
+                                             file_name_locations)
+    segments = list_segments(storage_bucket, blob_name)
+    if not segments:
+        logging.info(f"No segments to compact for '{blob_name}'")
+        return
+    parts = [read_locations(segment, storage_format) for segment in segments]
+    if storage.Blob(bucket=storage_bucket, name=blob_name).exists(storage_client):
+        # The locations blob goes first, so its locations are kept if times are equal
+        parts.insert(0, read_locations(storage_bucket.get_blob(blob_name), storage_format))
+    # Keep only the locations of the day
+    analyze_start = day_start(analyze_date)
+    analyze_end = analyze_start + SECONDS_PER_DAY
+    blob_json = {}
+    for license_hash, car in merge_cars(parts).items():
+        locations = [loc for loc in car['locations'] if analyze_start <= loc['when'] < analyze_end]
+        if locations:
+            blob_json[license_hash] = {"license": car['license'], "locations": locations}
+    upload_locations(storage_bucket.blob(blob_name), blob_json, storage_format)
+    for segment in segments:
+        segment.delete()
+    logging.info(f"Compacted {len(segments)} segments into '{blob_name}'")
+
+
+def read_locations(blob, storage_format):
+    """Returns (license hash, license, locations) for every car of a locations blob"""
+    if storage_format == 'columnar':
+        return list(DayColumns(blob.download_as_bytes()).read_cars())
+    if storage_format == 'compact':
+        return list(read_cars(blob.download_as_bytes()))
+    blob_json = json.loads(blob.download_as_string())
+    return [(license_hash, car['license'], parse_locations(car['locations']))
+            for license_hash, car in blob_json.items()]
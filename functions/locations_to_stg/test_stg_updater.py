@@ -0,0 +1,146 @@
+import json
+import threading
+import unittest
+
+from google.api_core import exceptions as gcp_exceptions
+from shards import read_manifest, shard_blob_name, shard_of
+from stg_updater import CarLocations, read_blob_json, update_shard, update_shards
+
+START = 1622505600
+END = START + 24 * 60 * 60
+BLOB_NAME = "2021/06/01/locations.json"
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = bucket.generations.get(name, 0)
+
+    def download_as_string(self):
+        return self.bucket.blobs[self.name]
+
+    def download_as_bytes(self):
+        return self.bucket.blobs[self.name]
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if self.bucket.before_upload:
+            # The other run's own uploads go through
+            callback = self.bucket.before_upload.pop(0)
+            pending, self.bucket.before_upload = self.bucket.before_upload, []
+            callback()
+            self.bucket.before_upload = pending
+        with self.bucket.lock:
+            if if_generation_match is not None and if_generation_match != self.bucket.generations.get(self.name, 0):
+                raise gcp_exceptions.PreconditionFailed("Generation does not match")
+            self.bucket.put(self.name, data)
+
+
+class FakeBucket(object):
+    """Bucket with generations, before_upload are called before the next uploads to simulate other runs"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.generations = {}
+        self.before_upload = []
+        self.lock = threading.RLock()
+
+    def put(self, name, data):
+        with self.lock:
+            self.blobs[name] = data.encode("utf-8") if isinstance(data, str) else data
+            self.generations[name] = self.generations.get(name, 0) + 1
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        with self.lock:
+            return FakeBlob(self, name) if name in self.blobs else None
+
+    def list_blobs(self, prefix=None):
+        return [FakeBlob(self, name) for name in sorted(self.blobs) if name.startswith(prefix or "")]
+
+
+def make_cars(licenses, start=START):
+    """Returns the locations of the licenses as they are accumulated, a location every minute"""
+    car_licenses = {}
+    for car_license in licenses:
+        car = CarLocations(f"hash-{car_license}")
+        for i in range(3):
+            car.add({"when": start + 60 * i, "what": "Moving",
+                     "geometry": {"type": "Point", "coordinates": [5.1 + i / 1000, 52.1]}})
+        car_licenses[car_license] = car
+    return car_licenses
+
+
+def stored_cars(bucket, blob_name, storage_format="json"):
+    return read_blob_json(bucket.get_blob(blob_name), storage_format)
+
+
+class TestUpdateShards(unittest.TestCase):
+    def test_writes_shards_and_manifest(self):
+        for storage_format in ("json", "compact"):
+            bucket = FakeBucket()
+            car_licenses = make_cars([f"car-{i}" for i in range(50)])
+            update_shards(car_licenses, bucket, BLOB_NAME, storage_format, START, END, max_workers=4)
+
+            shards = {shard_of(car.license_hash) for car in car_licenses.values()}
+            self.assertEqual(read_manifest(bucket, BLOB_NAME)["shards"], sorted(shards))
+            stored = {}
+            for shard in shards:
+                stored.update(stored_cars(bucket, shard_blob_name(BLOB_NAME, shard), storage_format))
+            self.assertEqual(sorted(stored), sorted(car.license_hash for car in car_licenses.values()))
+            self.assertEqual([location["when"] for location in stored["hash-car-0"]["locations"]],
+                             [START, START + 60, START + 120])
+
+    def test_merges_with_stored_shards(self):
+        bucket = FakeBucket()
+        update_shards(make_cars(["car-1"]), bucket, BLOB_NAME, "json", START, END)
+        update_shards(make_cars(["car-1"], START + 600), bucket, BLOB_NAME, "json", START, END)
+        shard_name = shard_blob_name(BLOB_NAME, shard_of("hash-car-1"))
+        self.assertEqual(len(stored_cars(bucket, shard_name)["hash-car-1"]["locations"]), 6)
+
+    def test_raises_if_a_shard_fails(self):
+        bucket = FakeBucket()
+        # Another run writes the shard before every upload
+        shard_name = shard_blob_name(BLOB_NAME, shard_of("hash-car-1"))
+        bucket.before_upload.extend(lambda: bucket.put(shard_name, json.dumps({})) for _ in range(5))
+        with self.assertRaises(gcp_exceptions.PreconditionFailed):
+            update_shards(make_cars(["car-1"]), bucket, BLOB_NAME, "json", START, END)
+        # The manifest is only written once the shards are
+        self.assertIsNone(read_manifest(bucket, BLOB_NAME))
+
+
+class TestUpdateShard(unittest.TestCase):
+    def test_concurrent_runs_keep_every_location(self):
+        bucket = FakeBucket()
+        shard_name = shard_blob_name(BLOB_NAME, "0a")
+        update_shard(make_cars(["car-1"]), bucket, shard_name, "json", START, END)
+        # Another run adds locations of another car between reading and writing the shard
+        bucket.before_upload.append(lambda: update_shard(make_cars(["car-2"]), bucket, shard_name, "json",
+                                                         START, END))
+        with self.assertLogs(level="INFO"):
+            update_shard(make_cars(["car-1"], START + 600), bucket, shard_name, "json", START, END)
+        stored = stored_cars(bucket, shard_name)
+        self.assertEqual(sorted(stored), ["hash-car-1", "hash-car-2"])
+        self.assertEqual(len(stored["hash-car-1"]["locations"]), 6)
+
+    def test_concurrent_runs_create_shard(self):
+        bucket = FakeBucket()
+        shard_name = shard_blob_name(BLOB_NAME, "0a")
+        bucket.before_upload.append(lambda: update_shard(make_cars(["car-2"]), bucket, shard_name, "compact",
+                                                         START, END))
+        update_shard(make_cars(["car-1"]), bucket, shard_name, "compact", START, END)
+        self.assertEqual(sorted(stored_cars(bucket, shard_name, "compact")), ["hash-car-1", "hash-car-2"])
+
+    def test_car_locations_are_unchanged(self):
+        bucket = FakeBucket()
+        shard_name = shard_blob_name(BLOB_NAME, "0a")
+        car_licenses = make_cars(["car-1"])
+        bucket.before_upload.append(lambda: bucket.put(shard_name, json.dumps({})))
+        update_shard(car_licenses, bucket, shard_name, "json", START, END)
+        self.assertEqual(car_licenses["car-1"].locations[0]["when"], START)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,9 +14,12 @@ from google.auth.transport import requests
 from google.oauth2 import service_account
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from trip_fields import select_trip_fields
 
 logging.basicConfig(level=logging.INFO)
 TOKEN_URI = 'https://accounts.google.com/o/oauth2/token'  # nosec
+# Fields of the trips of which managers are mailed, they are paged on ended_at
+MAIL_FIELDS = ["ended_at", "department.manager_mail"]
 
 
 def get_from_dict(data_dict, map_list):
@@ -95,6 +98,7 @@ class FirestoreProcessor(object):
         while batch_has_new_entities:
             query = self.db_client.collection(config.DB_COLLECTION)
 
+            query = select_trip_fields(query, MAIL_FIELDS)
             query = query.where("ended_at", ">=", self.start_date)
             query = query.where("ended_at", "<", self.end_date)
             query = query.where("outside_time_window", "==", True)
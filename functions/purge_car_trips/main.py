@@ -4,9 +4,13 @@ import operator
 from functools import reduce
 from datetime import datetime, timedelta, timezone
 from google.cloud import firestore
+from trip_fields import select_trip_fields
 
 logging.basicConfig(level=logging.INFO)
 
+# Fields of the trips that are purged, they are paged on ended_at
+PURGE_FIELDS = ["ended_at", "outside_time_window", "exported.exported_at"]
+
 
 class FirestoreProcessor(object):
     def __init__(self, collection, delta):
@@ -29,6 +33,7 @@ class FirestoreProcessor(object):
         while batch_has_new_entities:
             query = self.db_client.collection(self.collection)
 
+            query = select_trip_fields(query, PURGE_FIELDS)
             query = query.where("ended_at", "<", self.date_week_end)
             query = query.order_by("ended_at", "ASCENDING")
             query = query.limit(batch_limit)
@@ -0,0 +1,172 @@
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+from timestamps import format_locations
+
+# Columnar storage of the locations of one day, shared by locations_to_stg and update_car_trips
+#
+# Layout, all little endian:
+#   magic b"CLOC", uint16 version, uint16 reserved, uint32 header length
+#   JSON header: location count, coordinate scale, event labels and per license offset index
+#   padding up to a multiple of 8 bytes
+#   when  int64[count]   epoch seconds, UTC
+#   lon   int32[count]   fixed point longitude, degrees * scale
+#   lat   int32[count]   fixed point latitude, degrees * scale
+#   what  uint8[count]   index into the event labels
+# The locations of a license are a contiguous range of every column.
+
+MAGIC = b"CLOC"
+VERSION = 1
+PREAMBLE = struct.Struct("<4sHHI")
+
+COLUMNAR_EXTENSION = ".loc"
+COORDINATE_SCALE = 10 ** 7
+
+# The first labels have the same codes as the events in trip segmentation, code 0 is unknown
+EVENT_LABELS = ["", "Moving", "Stationary", "ExternalPowerChange"]
+
+
+def columnar_blob_name(file_name_locations):
+    return os.path.splitext(file_name_locations)[0] + COLUMNAR_EXTENSION
+
+
+def quantize(coordinate):
+    """Returns the coordinate as it is stored in the columnar format"""
+    return int(round(coordinate * COORDINATE_SCALE)) / COORDINATE_SCALE
+
+
+def quantize_location(location):
+    """Returns the location with its Point coordinates as they are stored in the columnar format"""
+    geometry = location["geometry"]
+    if geometry.get("type") != "Point":
+        return location
+    return dict(location, geometry=dict(geometry, coordinates=[quantize(c) for c in geometry["coordinates"]]))
+
+
+def write_day(cars):
+    """Returns the columnar file of (license hash, license, locations) tuples
+
+    Location 'when' is in epoch seconds or in the stored format.
+    Only Point geometries can be stored, coordinates are rounded to 7 decimals.
+    """
+    events = list(EVENT_LABELS)
+    event_codes = {label: code for code, label in enumerate(events)}
+
+    index = []
+    whens = []
+    whats = []
+    coordinates = []
+    for license_hash, car_license, locations in cars:
+        index.append([license_hash, car_license, len(whens), len(locations)])
+        for location in locations:
+            geometry = location["geometry"]
+            if geometry.get("type") != "Point":
+                raise ValueError(f"Unable to store geometry of type '{geometry.get('type')}' in columnar format")
+            what = location["what"]
+            if what not in event_codes:
+                event_codes[what] = len(events)
+                events.append(what)
+            whens.append(location["when"])
+            whats.append(event_codes[what])
+            coordinates.append(geometry["coordinates"][:2])
+
+    header = json.dumps({
+        "count": len(whens),
+        "scale": COORDINATE_SCALE,
+        "events": events,
+        "cars": index
+    }).encode("utf-8")
+    header += b" " * (-(PREAMBLE.size + len(header)) % 8)
+
+    coordinates = np.rint(np.array(coordinates, dtype=np.float64).reshape(-1, 2) * COORDINATE_SCALE)
+    return b"".join([
+        PREAMBLE.pack(MAGIC, VERSION, 0, len(header)),
+        header,
+        np.array(whens, dtype="datetime64[s]").astype("<i8").tobytes(),
+        coordinates[:, 0].astype("<i4").tobytes(),
+        coordinates[:, 1].astype("<i4").tobytes(),
+        np.array(whats, dtype=np.uint8).tobytes()
+    ])
+
+
+class DayColumns(object):
+    """Read-only view of a columnar file in a buffer, such as bytes or a numpy.memmap
+
+    The columns are numpy views on the buffer, nothing is copied until locations are requested.
+    """
+
+    def __init__(self, buffer):
+        magic, version, _, header_length = PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported columnar locations file, version {version}")
+        offset = PREAMBLE.size + header_length
+        header = json.loads(bytes(buffer[PREAMBLE.size:offset]))
+
+        count = header["count"]
+        self.scale = header["scale"]
+        self.events = header["events"]
+        self.cars = {license_hash: (car_license, start, length)
+                     for license_hash, car_license, start, length in header["cars"]}
+
+        self.when = np.frombuffer(buffer, dtype="<i8", count=count, offset=offset)
+        offset += 8 * count
+        self.lon = np.frombuffer(buffer, dtype="<i4", count=count, offset=offset)
+        offset += 4 * count
+        self.lat = np.frombuffer(buffer, dtype="<i4", count=count, offset=offset)
+        offset += 4 * count
+        self.what = np.frombuffer(buffer, dtype=np.uint8, count=count, offset=offset)
+
+    def event_codes(self, license_hash):
+        """Returns the event codes of trip segmentation, labels it does not know get code 0"""
+        _, start, length = self.cars[license_hash]
+        what = self.what[start:start + length]
+        return np.where(what < len(EVENT_LABELS), what, 0).astype(np.uint8)
+
+    def locations(self, license_hash, first=0):
+        """Returns the locations of a license from index first onwards, with 'when' in epoch seconds"""
+        _, start, length = self.cars[license_hash]
+        selection = slice(start + first, start + length)
+        whens = self.when[selection].tolist()
+        lons = (self.lon[selection] / self.scale).tolist()
+        lats = (self.lat[selection] / self.scale).tolist()
+        events = self.events
+        return [
+            {"when": when, "geometry": {"type": "Point", "coordinates": [lon, lat]}, "what": events[what]}
+            for when, lon, lat, what in zip(whens, lons, lats, self.what[selection].tolist())
+        ]
+
+    def read_cars(self):
+        """Yields (license hash, license, locations) for every car, with 'when' in epoch seconds"""
+        for license_hash, (car_license, _, _) in self.cars.items():
+            yield license_hash, car_license, self.locations(license_hash)
+
+
+def json_to_columnar(blob_json):
+    return write_day(
+        (license_hash, car["license"], car.get("locations", [])) for license_hash, car in blob_json.items()
+    )
+
+
+def columnar_to_json(buffer):
+    return {
+        license_hash: {"license": car_license, "locations": locations}
+        for license_hash, car_license, locations in DayColumns(buffer).read_cars()
+    }
+
+
+# Converts an existing locations file: python columnar.py <locations.json> <locations.loc>
+# A file with the columnar extension is converted back to JSON
+if __name__ == "__main__":
+    source, target = sys.argv[1:3]
+    if source.endswith(COLUMNAR_EXTENSION):
+        with open(source, "rb") as source_file, open(target, "w") as target_file:
+            blob_json = columnar_to_json(source_file.read())
+            for car in blob_json.values():
+                car["locations"] = format_locations(car["locations"])
+            json.dump(blob_json, target_file, indent=2)
+    else:
+        with open(source, "rb") as source_file, open(target, "wb") as target_file:
+            target_file.write(json_to_columnar(json.load(source_file)))
@@ -0,0 +1,156 @@
+import gzip
+import json
+import os
+import sys
+
+import numpy as np
+from timestamps import format_locations
+
+# Compact storage of the locations of one day, shared by locations_to_stg and update_car_trips
+#
+# A gzip compressed JSON object with the locations of every license as three strings:
+#   when         epoch seconds, UTC, the first one and then the difference with the previous one
+#   coordinates  fixed point longitude and latitude, degrees * scale, as differences like 'when'
+#   what         index into the event labels
+# Integers are written as in the encoded polyline format: zigzag encoded, in chunks of 5 bits
+# from the lowest to the highest, every chunk plus 63 as one character and plus 32 if more follow.
+
+VERSION = 1
+COMPACT_EXTENSION = ".json.gz"
+COORDINATE_SCALE = 10 ** 7
+
+# The first labels have the same codes as the events in trip segmentation, code 0 is unknown
+EVENT_LABELS = ["", "Moving", "Stationary", "ExternalPowerChange"]
+
+# A zigzag encoded 64 bit integer has at most 13 chunks of 5 bits
+MAX_CHUNKS = 13
+
+
+def compact_blob_name(file_name_locations):
+    return os.path.splitext(file_name_locations)[0] + COMPACT_EXTENSION
+
+
+def encode_integers(values):
+    """Returns an int64 array as a string of polyline characters"""
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+    shifts = np.arange(MAX_CHUNKS, dtype=np.uint64) * np.uint64(5)
+    chunks = (zigzag[:, None] >> shifts) & np.uint64(31)
+    # Every value has at least one chunk, and one more for every 5 bits that are left
+    count = np.ones(len(values), dtype=np.int64)
+    for chunk in range(1, MAX_CHUNKS):
+        count += zigzag >= np.uint64(1) << shifts[chunk]
+    used = np.arange(MAX_CHUNKS) < count[:, None]
+    more = np.arange(MAX_CHUNKS) < count[:, None] - 1
+    characters = (chunks + np.uint64(63) + more * np.uint64(32))[used]
+    return characters.astype(np.uint8).tobytes().decode("ascii")
+
+
+def decode_integers(text):
+    """Returns the int64 array of a string of polyline characters"""
+    chunks = np.frombuffer(text.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = (chunks & 32) == 0
+    # Position of every chunk in its value
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    value_of_chunk = np.cumsum(np.concatenate(([0], last[:-1])))
+    position = np.arange(len(chunks)) - starts[value_of_chunk]
+    zigzag = np.add.reduceat((chunks & 31).astype(np.uint64) << (position * 5).astype(np.uint64), starts)
+    return ((zigzag >> np.uint64(1)).view(np.int64)) ^ -(zigzag & np.uint64(1)).view(np.int64)
+
+
+def encode_deltas(values):
+    values = np.asarray(values, dtype=np.int64)
+    return encode_integers(np.diff(values, prepend=np.int64(0)) if len(values) else values)
+
+
+def decode_deltas(text):
+    return np.cumsum(decode_integers(text))
+
+
+def write_day(cars):
+    """Returns the compact file of (license hash, license, locations) tuples
+
+    Location 'when' is in epoch seconds or in the stored format.
+    Only Point geometries can be stored, coordinates are rounded to 7 decimals.
+    """
+    events = list(EVENT_LABELS)
+    event_codes = {label: code for code, label in enumerate(events)}
+
+    encoded = {}
+    for license_hash, car_license, locations in cars:
+        whats = []
+        coordinates = []
+        for location in locations:
+            geometry = location["geometry"]
+            if geometry.get("type") != "Point":
+                raise ValueError(f"Unable to store geometry of type '{geometry.get('type')}' in compact format")
+            what = location["what"]
+            if what not in event_codes:
+                event_codes[what] = len(events)
+                events.append(what)
+            whats.append(event_codes[what])
+            coordinates.append(geometry["coordinates"][:2])
+        whens = np.array([location["when"] for location in locations], dtype="datetime64[s]").astype(np.int64)
+        # Longitude and latitude are interleaved, so every one is encoded as a difference with the previous
+        fixed = np.rint(np.array(coordinates, dtype=np.float64).reshape(-1, 2) * COORDINATE_SCALE).astype(np.int64)
+        deltas = np.diff(fixed, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+        encoded[license_hash] = {
+            "license": car_license,
+            "when": encode_deltas(whens),
+            "coordinates": encode_integers(deltas.reshape(-1)),
+            "what": encode_integers(whats),
+        }
+
+    return gzip.compress(json.dumps({
+        "version": VERSION,
+        "scale": COORDINATE_SCALE,
+        "events": events,
+        "cars": encoded
+    }, separators=(",", ":")).encode("utf-8"))
+
+
+def read_cars(data):
+    """Yields (license hash, license, locations) for every car of a compact file, with 'when' in epoch seconds"""
+    day = json.loads(gzip.decompress(data))
+    if day.get("version") != VERSION:
+        raise ValueError(f"Unsupported compact locations file, version {day.get('version')}")
+    scale = day["scale"]
+    events = day["events"]
+    for license_hash, car in day["cars"].items():
+        whens = decode_deltas(car["when"]).tolist()
+        coordinates = np.cumsum(decode_integers(car["coordinates"]).reshape(-1, 2), axis=0) / scale
+        whats = decode_integers(car["what"]).tolist()
+        yield license_hash, car["license"], [
+            {"when": when, "geometry": {"type": "Point", "coordinates": [lon, lat]}, "what": events[what]}
+            for when, (lon, lat), what in zip(whens, coordinates.tolist(), whats)
+        ]
+
+
+def json_to_compact(blob_json):
+    return write_day(
+        (license_hash, car["license"], car.get("locations", [])) for license_hash, car in blob_json.items()
+    )
+
+
+def compact_to_json(data):
+    return {
+        license_hash: {"license": car_license, "locations": locations}
+        for license_hash, car_license, locations in read_cars(data)
+    }
+
+
+# Converts an existing locations file: python compact.py <locations.json> <locations.json.gz>
+# A file with the compact extension is converted back to JSON
+if __name__ == "__main__":
+    source, target = sys.argv[1:3]
+    if source.endswith(COMPACT_EXTENSION):
+        with open(source, "rb") as source_file, open(target, "w") as target_file:
+            blob_json = compact_to_json(source_file.read())
+            for car in blob_json.values():
+                car["locations"] = format_locations(car["locations"])
+            json.dump(blob_json, target_file, indent=2)
+    else:
+        with open(source, "rb") as source_file, open(target, "wb") as target_file:
+            target_file.write(json_to_compact(json.load(source_file)))
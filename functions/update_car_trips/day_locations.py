@@ -0,0 +1,296 @@
+import codecs
+import io
+import json
+import logging
+import os
+
+import numpy as np
+from columnar import DayColumns
+from compact import read_cars as read_compact_cars
+from google.cloud import storage
+from segmentation import EXTERNAL_POWER_CHANGE, STATIONARY, encode_events
+from segments import list_segments, merge_cars
+from shards import fetch_shards
+from timestamps import format_locations, parse_locations
+
+logging.basicConfig(level=logging.INFO)
+
+STATIONARY_EVENTS = ("Stationary", "ExternalPowerChange")
+READ_SIZE = 1 << 20
+CHECKPOINT_EXTENSION = ".checkpoint.json"
+
+
+def day_blob_name(date, file_name_locations):
+    return "{}/{:02d}/{:02d}/{}".format(date.year, date.month, date.day, file_name_locations)
+
+
+def checkpoint_blob_name(date, file_name_locations):
+    return day_blob_name(date, os.path.splitext(file_name_locations)[0] + CHECKPOINT_EXTENSION)
+
+
+def write_checkpoint(storage_bucket, blob_name, trailing):
+    """Stores the trailing locations of every car of a day, to complete trips that continue the next day"""
+    blob = storage_bucket.blob(blob_name)
+    checkpoint = {license_hash: format_locations(locations) for license_hash, locations in trailing.items()}
+    blob.upload_from_string(data=json.dumps(checkpoint), content_type="application/json")
+    logging.info(f"Stored trailing locations of {len(trailing)} cars in '{blob_name}'")
+
+
+def fetch_day(storage_client, storage_bucket, blob_name, layout="day"):
+    """Downloads a locations blob, every shard of it if the day is sharded, or it and its segments
+
+    Returns a list with the contents of the downloaded blobs, or None if the day does not exist.
+    """
+    if layout == "sharded":
+        return fetch_shards(storage_bucket, blob_name)
+    parts = []
+    if storage.Blob(bucket=storage_bucket, name=blob_name).exists(storage_client):
+        parts.append(storage_bucket.get_blob(blob_name).download_as_bytes())
+    if layout == "segments":
+        # Segments that are not compacted yet
+        parts.extend(segment.download_as_bytes() for segment in list_segments(storage_bucket, blob_name))
+    return parts if parts else None
+
+
+def read_day(blob, storage_format="json"):
+    """Yields (license hash, license, locations, event codes) for every car of a locations blob
+
+    Location 'when' is in epoch seconds.
+    """
+    if storage_format == "columnar":
+        yield from read_columnar_cars(DayColumns(blob.download_as_bytes()))
+    elif storage_format == "compact":
+        yield from read_decoded_cars(read_compact_cars(blob.download_as_bytes()))
+    else:
+        with blob.open("rb") as stream:
+            yield from read_json_cars(stream)
+
+
+def read_day_data(data, storage_format="json"):
+    """Yields (license hash, license, locations, event codes) for every car of downloaded locations"""
+    if storage_format == "columnar":
+        return read_columnar_cars(DayColumns(data))
+    if storage_format == "compact":
+        return read_decoded_cars(read_compact_cars(data))
+    return read_json_cars(io.BytesIO(data))
+
+
+def read_day_parts(parts, storage_format="json", layout="day"):
+    """Yields (license hash, license, locations, event codes) for every car of the blobs of fetch_day"""
+    if layout == "segments":
+        # A car can be in more than one segment, so its locations are merged first
+        cars = merge_cars(read_part_cars(data, storage_format) for data in parts)
+        for license_hash, car in cars.items():
+            yield license_hash, car["license"], car["locations"], encode_events(car["locations"])
+    else:
+        for data in parts:
+            yield from read_day_data(data, storage_format)
+
+
+def read_part_cars(data, storage_format="json"):
+    """Yields (license hash, license, locations) for every car of downloaded locations"""
+    if storage_format == "columnar":
+        return DayColumns(data).read_cars()
+    if storage_format == "compact":
+        return read_compact_cars(data)
+    return ((license_hash, car_license, parse_locations(locations))
+            for license_hash, car_license, locations in read_cars(io.BytesIO(data)))
+
+
+def read_columnar_cars(day):
+    for license_hash, (car_license, _, _) in day.cars.items():
+        yield license_hash, car_license, day.locations(license_hash), day.event_codes(license_hash)
+
+
+def read_decoded_cars(cars):
+    for license_hash, car_license, locations in cars:
+        yield license_hash, car_license, locations, encode_events(locations)
+
+
+def read_json_cars(stream):
+    for license_hash, car_license, locations in read_cars(stream):
+        yield license_hash, car_license, parse_locations(locations), encode_events(locations)
+
+
+def collect_trailing_locations(cars, trailing):
+    """Passes through the cars of read_day, storing copies of their trailing locations in trailing
+
+    Copies are needed since making trips changes the locations.
+    """
+    for car in cars:
+        trailing[car[0]] = [dict(location) for location in trailing_locations(car[2])]
+        yield car
+
+
+def read_cars(stream, read_size=READ_SIZE):
+    """Yields (license hash, license, locations) for every car of a locations file
+
+    The file is read incrementally from a binary stream, so only one car is decoded at a time.
+    """
+    reader = CarsReader(stream, read_size)
+    reader.expect("{")
+    while not reader.skip("}"):
+        reader.skip(",")
+        license_hash = reader.value()
+        reader.expect(":")
+        car = reader.value()
+        yield license_hash, car["license"], car.get("locations", [])
+
+
+class CarsReader(object):
+    """Decodes consecutive JSON values from a binary stream"""
+
+    def __init__(self, stream, read_size):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size):
+        # Drop what is already decoded, then append at least size characters
+        parts = [self.buffer[self.pos:]]
+        length = len(parts[0])
+        while not self.eof and length < size:
+            data = self.stream.read(self.read_size)
+            self.eof = not data
+            parts.append(self.text_decoder.decode(data, final=self.eof))
+            length += len(parts[-1])
+        self.buffer = "".join(parts)
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.read(self.read_size)
+
+    def skip(self, character):
+        if self.peek() == character:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, character):
+        if not self.skip(character):
+            raise ValueError(f"Expected '{character}' in locations file, found '{self.peek()}'")
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                # The value is incomplete, at least double what is buffered so retries stay linear
+                self.read(2 * (len(self.buffer) - self.pos) + self.read_size)
+
+
+def trailing_locations(locations):
+    """Returns the locations from the last stationary or power change location onwards"""
+    for i in range(len(locations) - 1, -1, -1):
+        if locations[i]["what"] in STATIONARY_EVENTS:
+            return locations[i:]
+    return locations
+
+
+def trailing_columnar_locations(day):
+    """Returns the trailing locations of every car of a columnar file, only these are decoded"""
+    cars = {}
+    for license_hash in day.cars:
+        codes = day.event_codes(license_hash)
+        stationary = np.flatnonzero((codes == STATIONARY) | (codes == EXTERNAL_POWER_CHANGE))
+        cars[license_hash] = day.locations(license_hash, stationary[-1] if len(stationary) else 0)
+    return cars
+
+
+class DayLocations(object):
+    """Lazily loaded view of the locations file of one day, indexed on hashed license
+
+    The file, its shards or its segments are fetched at most once, on first access, and shared by every car of the run.
+    Only the trailing locations of every car are kept, which is all a trip that continues
+    the next day needs. If the run that made the trips of the day stored a checkpoint with
+    these locations, the checkpoint is read instead of the file.
+    """
+
+    def __init__(self, storage_client, storage_bucket, blob_name, storage_format="json", checkpoint_name=None,
+                 layout="day"):
+        self.storage_client = storage_client
+        self.storage_bucket = storage_bucket
+        self.blob_name = blob_name
+        self.storage_format = storage_format
+        self.checkpoint_name = checkpoint_name
+        self.layout = layout
+
+        self.blob_fetches = 0
+        self.checkpoint_fetches = 0
+        self._exists = False
+        self._cars = None
+
+    @classmethod
+    def preloaded(cls, blob_name, trailing, storage_format="json"):
+        """Returns the view of a day that was already read, trailing is None if it does not exist"""
+        day = cls(None, None, blob_name, storage_format)
+        day._exists = trailing is not None
+        day._cars = trailing if trailing is not None else {}
+        return day
+
+    def load(self):
+        if self._cars is None:
+            self._cars = {}
+            if self.checkpoint_name and storage.Blob(
+                    bucket=self.storage_bucket, name=self.checkpoint_name).exists(self.storage_client):
+                blob = self.storage_bucket.get_blob(self.checkpoint_name)
+                self.checkpoint_fetches += 1
+                self._cars = {license_hash: parse_locations(locations) for license_hash, locations
+                              in json.loads(blob.download_as_string()).items()}
+                self._exists = True
+                logging.info(f"Loaded trailing locations of {len(self._cars)} cars from '{self.checkpoint_name}'")
+            elif self.layout == "segments":
+                parts = fetch_day(self.storage_client, self.storage_bucket, self.blob_name, self.layout)
+                if parts is not None:
+                    self.blob_fetches += 1
+                    for license_hash, _, locations, _ in read_day_parts(parts, self.storage_format, self.layout):
+                        self._cars[license_hash] = trailing_locations(locations)
+                    self._exists = True
+                    logging.info(f"Loaded locations of {len(self._cars)} cars from '{self.blob_name}' "
+                                 f"and its segments")
+            elif self.layout == "sharded":
+                parts = fetch_shards(self.storage_bucket, self.blob_name)
+                if parts is not None:
+                    self.blob_fetches += 1
+                    for data in parts:
+                        self._cars.update(self.read_trailing(io.BytesIO(data)))
+                    self._exists = True
+                    logging.info(f"Loaded locations of {len(self._cars)} cars from shards of '{self.blob_name}'")
+            elif storage.Blob(bucket=self.storage_bucket, name=self.blob_name).exists(self.storage_client):
+                blob = self.storage_bucket.get_blob(self.blob_name)
+                self.blob_fetches += 1
+                with blob.open("rb") as stream:
+                    self._cars = self.read_trailing(stream)
+                self._exists = True
+                logging.info(f"Loaded locations of {len(self._cars)} cars from '{self.blob_name}'")
+        return self._cars
+
+    def read_trailing(self, stream):
+        """Returns the trailing locations of every car of a locations blob"""
+        if self.storage_format == "columnar":
+            return trailing_columnar_locations(DayColumns(stream.read()))
+        if self.storage_format == "compact":
+            return {license_hash: trailing_locations(locations)
+                    for license_hash, _, locations in read_compact_cars(stream.read())}
+        return {license_hash: parse_locations(trailing_locations(locations))
+                for license_hash, _, locations in read_cars(stream)}
+
+    def exists(self):
+        self.load()
+        return self._exists
+
+    def trailing_locations(self, license_hash):
+        return self.load().get(license_hash, [])
@@ -1,16 +1,162 @@
-from google.cloud import firestore
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud import firestore
+from timestamps import when_datetime
 
 logging.basicConfig(level=logging.INFO)
 
+# Firestore allows at most 500 writes in one batch
+BATCH_SIZE = 500
+# Keep a batch well below the 10 MiB request limit, trips can hold thousands of locations
+BATCH_MAX_LOCATIONS = 20000
+
+TRANSIENT_ERRORS = (
+    gcp_exceptions.Aborted,
+    gcp_exceptions.DeadlineExceeded,
+    gcp_exceptions.InternalServerError,
+    gcp_exceptions.ServiceUnavailable,
+    gcp_exceptions.TooManyRequests,
+)
+
+
+class RampUpLimiter(object):
+    """Limits the write rate following the 500/50/5 rule
+
+    Starts at 500 operations per second and increases the rate by 50% every 5 minutes.
+    """
+
+    def __init__(self, initial_rate=500, growth=1.5, interval=300, clock=time.monotonic, sleep=time.sleep):
+        self.initial_rate = initial_rate
+        self.growth = growth
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._started_at = None
+        self._next_slot = None
+
+    def rate(self, now):
+        return self.initial_rate * self.growth ** int((now - self._started_at) // self.interval)
+
+    def acquire(self, operations):
+        with self._lock:
+            now = self.clock()
+            if self._started_at is None:
+                self._started_at = now
+                self._next_slot = now
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + operations / self.rate(slot)
+        if slot > now:
+            self.sleep(slot - now)
+
+
+class BulkWriter(object):
+    """Writes documents in batches that are committed by a bounded pool of threads
+
+    A batch that fails with an error that is not transient is split in halves that are committed
+    on their own, until only the writes that make it fail are left.
+    """
+
+    def __init__(self, db_client, max_workers=8, max_attempts=5, backoff_base=1.0, backoff_max=30.0,
+                 limiter=None):
+        self.db_client = db_client
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = limiter if limiter else RampUpLimiter()
+
+    def write(self, writes):
+        """Writes a list of (document reference, data, locations count) tuples
+
+        Returns a list with for every write the exception that made it fail, or None.
+        """
+        batches = list(make_batches(writes))
+        errors = [None] * len(writes)
 
-def upload_to_firestore(car_trips):
-    db = firestore.Client()
-    # Make a new trips variable so that actual trips is not changed
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self.commit, [[writes[i] for i in batch] for batch in batches])
+            for batch, batch_errors in zip(batches, results):
+                for i, error in zip(batch, batch_errors):
+                    errors[i] = error
+                failed = [error for error in batch_errors if error]
+                if failed:
+                    logging.error(f"Unable to commit {len(failed)} of {len(batch)} writes of a batch "
+                                  f"because of {failed[0]}")
+
+        return errors
+
+    def commit(self, batch_writes):
+        """Returns for every write of a batch the exception that made it fail, or None"""
+        error = self.commit_batch(batch_writes)
+        if error is None:
+            return [None] * len(batch_writes)
+        if isinstance(error, TRANSIENT_ERRORS) or len(batch_writes) == 1:
+            return [error] * len(batch_writes)
+        # A batch is committed as a whole or not at all, so its halves can be committed again
+        middle = len(batch_writes) // 2
+        return self.commit(batch_writes[:middle]) + self.commit(batch_writes[middle:])
+
+    def commit_batch(self, batch_writes):
+        """Commits writes in one batch, retrying transient errors, returns the exception that made it fail or None"""
+        for attempt in range(1, self.max_attempts + 1):
+            self.limiter.acquire(len(batch_writes))
+            batch = self.db_client.batch()
+            for doc_ref, data, _ in batch_writes:
+                batch.set(doc_ref, data)
+            try:
+                batch.commit()
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.max_attempts:
+                    return e
+                # Exponential backoff with full jitter
+                backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))  # nosec
+                logging.info(f"Retrying batch of {len(batch_writes)} writes in {backoff:.1f}s because of {e}")
+                time.sleep(backoff)
+            except Exception as e:
+                return e
+            else:
+                return None
+
+
+def make_batches(writes):
+    """Yields lists of indexes of writes that fit in one batch"""
+    batch = []
+    batch_locations = 0
+    for i, (_, _, locations_count) in enumerate(writes):
+        if batch and (len(batch) == BATCH_SIZE or batch_locations + locations_count > BATCH_MAX_LOCATIONS):
+            yield batch
+            batch = []
+            batch_locations = 0
+        batch.append(i)
+        batch_locations += locations_count
+    if batch:
+        yield batch
+
+
+def upload_to_firestore(car_trips, db_client=None, max_workers=8, limiter=None):
+    """Uploads the trips of every car
+
+    Returns a report with for every trip its document id and the error if the upload failed.
+    Uploads of consecutive days share a limiter, so the write rate keeps ramping up.
+    """
+    db = db_client if db_client else firestore.Client()
+    collection = db.collection("Trips")
+
+    report = []
+    writes = []
     for car in car_trips:
         car_license = car['license']
         car_license_hash = car['license_hash']
         for trip in car['trips']:
+            # Location 'when' is uploaded as a datetime instead of epoch seconds
+            trip = [dict(location, when=when_datetime(location['when'])) for location in trip]
             # Get start and end time
             # Since there can be a lot of time between the first
             # stationary location and the first moving location
@@ -30,12 +176,19 @@ def upload_to_firestore(car_trips):
                 },
                 "outside_time_window": None
             }
-            # Upload to firestore
-            try:
-                doc_ref = db.collection("Trips").document()
-                doc_ref.set(firestore_entity)
-            except Exception as e:
-                logging.exception(f"Unable to upload trip of car {trip['license']} "
-                                  f"because of {e}")
-                return False
-    return True
+            # Document ids are generated locally, so retrying a batch does not duplicate trips
+            doc_ref = collection.document()
+            writes.append((doc_ref, firestore_entity, len(trip)))
+            report.append({
+                "license": car_license,
+                "license_hash": car_license_hash,
+                "started_at": started_at,
+                "document_id": doc_ref.id,
+                "error": None
+            })
+
+    errors = BulkWriter(db, max_workers=max_workers, limiter=limiter).write(writes)
+    for trip_report, error in zip(report, errors):
+        if error:
+            trip_report["error"] = str(error)
+    return report
@@ -1,13 +1,17 @@
-import copy
 import datetime
-import json
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import config
-from firestore import upload_to_firestore
+from columnar import columnar_blob_name
+from compact import compact_blob_name
+from day_locations import (DayLocations, checkpoint_blob_name, collect_trailing_locations, day_blob_name,
+                           fetch_day, read_day, read_day_parts, write_checkpoint)
+from firestore import RampUpLimiter, upload_to_firestore
 from google.cloud import storage
+from trips import make_trips, patch_trips
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,279 +19,89 @@ storage_client = storage.Client()
 storage_bucket = storage_client.get_bucket(config.GCP_BUCKET_CAR_LOCATIONS)
 
 
-def make_trips(file_name_locations):  # noqa: C901
-    # Make trips from yesterday's locations
-    yesterday = datetime.datetime.today() - datetime.timedelta(1)
-    year = yesterday.year
-    month = "{:02d}".format(yesterday.month)
-    day = "{:02d}".format(yesterday.day)
-    bucket_folder = "{}/{}/{}".format(year, month, day)
-    cars_with_trips = []
-    # Check if the file with yesterday's locations exists
-    blob_name = f"{bucket_folder}/{file_name_locations}"
-    if storage.Blob(bucket=storage_bucket, name=blob_name).exists(storage_client):
-        # If it does, get it
-        blob = storage_bucket.get_blob(blob_name)
-        # Convert to string
-        blob_json_string = blob.download_as_string()
-        # Convert to json
-        blob_json = json.loads(blob_json_string)
-        # Loop over every car license in the file
-        for hashed_car_license in blob_json:
-            # Get the locations of the car_license
-            locations = blob_json[hashed_car_license]["locations"]
-            # Make new trips list
-            trips = []
-            # Make a new trip
-            trip = []
-            # Loop over every location of the current car
-            for i in range(len(locations)):
-                # Location_checked variable is initialized
-                # It checks if a location has already been added to the trip
-                location_checked = False
-                location = locations[i]
-                # Set location's when to a datetime instead of a timestamp
-                when = location["when"]
-                when_datetime = datetime.datetime.strptime(when, "%Y-%m-%dT%H:%M:%S")
-                location["when"] = when_datetime
-                # Check if the car is stationary and after and before that moving
-                # That's the end of the trip and beginning a new trip
-                if i + 1 < len(locations) - 1 and location_checked is False:
-                    if (
-                        location["what"] in ["Stationary", "ExternalPowerChange"]
-                        and locations[i - 1]["what"] == "Moving"
-                        and locations[i + 1]["what"] == "Moving"
-                    ):
-                        # Add it to the trip
-                        if location not in trip:
-                            trip.append(location)
-                        # Add trip to trips
-                        trips.append(trip)
-                        # And start a new trip
-                        trip = [copy.deepcopy(location)]
-                        location_checked = True
-                # Check if the car is stationary and after that moving
-                # That's the beginning of the trip
-                if i + 1 < len(locations) - 1 and location_checked is False:
-                    if (
-                        location["what"] == "Stationary"
-                        and locations[i + 1]["what"] == "Moving"
-                    ) or (
-                        location["what"] == "ExternalPowerChange"
-                        and locations[i + 1]["what"] == "Moving"
-                    ):
-                        # A new trip has started
-                        trip = [location]
-                        location_checked = True
-                # Check if the car is stationary and was moving before
-                # That's the end of the trip
-                if i - 1 >= 0 and location_checked is False:
-                    if (
-                        location["what"] == "Stationary"
-                        and locations[i - 1]["what"] == "Moving"
-                    ) or (
-                        location["what"] == "ExternalPowerChange"
-                        and locations[i - 1]["what"] == "Moving"
-                    ):
-                        # Add it to the trip
-                        if location not in trip:
-                            trip.append(location)
-                        # Add trip to trips
-                        trips.append(trip)
-                        # And make trip empty again
-                        trip = []
-                        location_checked = True
-                # Check if the car is moving
-                if location["what"] == "Moving" and location_checked is False:
-                    # Add it to the trip
-                    if location not in trip:
-                        trip.append(location)
-                    # If it is the last location in the list
-                    # The trip will finish somewhere the next day
-                    # Just add it
-                    if i == len(locations) - 1:
-                        # Add trip to trips
-                        trips.append(trip)
-                        # Make trip empty again
-                        trip = []
-                    location_checked = True
-                # Check if the car is stationary
-                elif (
-                    location["what"] == "Stationary" and location_checked is False
-                ) or (
-                    location["what"] == "ExternalPowerChange"
-                    and location_checked is False
-                ):
-                    # Add it to the trip
-                    if location not in trip:
-                        trip.append(location)
-                    # If it is the last location in the list
-                    # This could be the start of a new trip
-                    # Just add it
-                    if i == len(locations) - 1:
-                        # Add trip to trips
-                        trips.append(trip)
-                        # Make trip empty again
-                        trip = []
-                    location_checked = True
-            car_with_trips = {
-                "license": blob_json[hashed_car_license]["license"],
-                "license_hash": hashed_car_license,
-                "trips": trips,
-            }
-            cars_with_trips.append(car_with_trips)
-        return cars_with_trips
-
-
-def patch_trip(trip, car_license_hash, file_name_locations):  # noqa: C901
-    # Get the locations from the day before yesterday
-    day_before_yesterday = datetime.datetime.today() - datetime.timedelta(days=2)
-    year = day_before_yesterday.year
-    month = "{:02d}".format(day_before_yesterday.month)
-    day = "{:02d}".format(day_before_yesterday.day)
-    bucket_folder = "{}/{}/{}".format(year, month, day)
-    # Check if the file with the day before yesterday's locations exists
-    blob_name = f"{bucket_folder}/{file_name_locations}"
-    if storage.Blob(bucket=storage_bucket, name=blob_name).exists(storage_client):
-        # If it does, get it
-        blob = storage_bucket.get_blob(blob_name)
-        # Convert to string
-        blob_json_string = blob.download_as_string()
-        # Convert to json
-        blob_json = json.loads(blob_json_string)
-        # Get locations of car
-        locations = (
-            blob_json[car_license_hash].get("locations", [])
-            if car_license_hash in blob_json
-            else []
-        )
-        # Keep adding locations in front of this trip until a Stationary location is found
-        add_to_trip = []
-        i = len(locations) - 1
-        while i >= 0:
-            location = locations[i]
-            # Set location's when to a datetime instead of a timestamp
-            when = location["when"]
-            when_datetime = datetime.datetime.strptime(when, "%Y-%m-%dT%H:%M:%S")
-            location["when"] = when_datetime
-            # While location is not stationary and is not an external power change
-            while (
-                location["what"] != "Stationary"
-                and location["what"] != "ExternalPowerChange"
-            ):
-                # Keep adding the location to a trip
-                add_to_trip.append(location)
-                if i - 1 < 0:
-                    # If i - 1 is smaller than zero
-                    # No stationary location is found in yesterday's locations
-                    # Return empty
-                    return []
-                i = i - 1
-            # Stationary location is found
-            add_to_trip.append(location)
-            i = -1
-        # Now the locations to be added need to be reversed in order to add them to the trip
-        add_to_trip = add_to_trip[::-1]
-        # Now add the locations in front of the trip
-        trip[0:0] = add_to_trip
-        return trip
-    # If there are no locations the day before yesterday, remove this trip
-    return []
-
-
-def patch_trips(car_trips, file_name_locations):  # noqa: C901
-    # For every car in car_trips
-    for car in car_trips:
-        car_license_hash = car["license_hash"]
+def upload_trips(car_trips, limiter=None):
+    max_workers = config.FIRESTORE_MAX_WORKERS if hasattr(config, 'FIRESTORE_MAX_WORKERS') else 8
+    upload_report = upload_to_firestore(car_trips, max_workers=max_workers, limiter=limiter)
+    failed_uploads = [trip for trip in upload_report if trip["error"]]
+    logging.info(f"Uploaded {len(upload_report) - len(failed_uploads)} of {len(upload_report)} "
+                 f"trips to firestore")
+    for trip in failed_uploads:
+        logging.error(f"Unable to upload trip of car {trip['license']} started at {trip['started_at']} "
+                      f"because of {trip['error']}")
+    return not failed_uploads
+
+
+def process_days(days, file_name_locations, workers=1, storage_format="json", layout="day"):
+    """Makes and uploads the trips of consecutive days in order, returns False if an upload failed
+
+    Every blob is fetched once: the trailing locations of a day are kept as the previous day
+    of the next one, and the next day is downloaded while the current day is processed.
+    The trailing locations are also stored as a checkpoint for the run of the next day.
+    """
+    # The previous day of the first day is only loaded if one of its trips started the day before
+    # Its checkpoint is used if it exists, otherwise its locations file
+    day_before = days[0] - datetime.timedelta(1)
+    previous_day = DayLocations(
+        storage_client, storage_bucket, day_blob_name(day_before, file_name_locations), storage_format,
+        checkpoint_name=checkpoint_blob_name(day_before, file_name_locations), layout=layout
+    )
+    # The prefetch thread gets its own client, so downloads do not share a connection pool
+    prefetch_client = storage.Client() if len(days) > 1 else None
+    prefetch_bucket = prefetch_client.bucket(config.GCP_BUCKET_CAR_LOCATIONS) if prefetch_client else None
+
+    # The write rate ramps up once per run, not once per day
+    limiter = RampUpLimiter()
+
+    success = True
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        prefetch = None
+        for i, day in enumerate(days):
+            blob_name = day_blob_name(day, file_name_locations)
+            cars = None
+            parts = None
+            if prefetch:
+                parts = prefetch.result()
+            elif layout != "day":
+                # The shards or segments of the first day are fetched at once
+                parts = fetch_day(storage_client, storage_bucket, blob_name, layout)
+            elif storage.Blob(bucket=storage_bucket, name=blob_name).exists(storage_client):
+                # Read the first day one car at a time
+                cars = read_day(storage_bucket.get_blob(blob_name), storage_format)
+            if parts is not None:
+                cars = read_day_parts(parts, storage_format, layout)
+
+            if i + 1 < len(days):
+                prefetch = prefetcher.submit(
+                    fetch_day, prefetch_client, prefetch_bucket, day_blob_name(days[i + 1], file_name_locations), layout
+                )
+
+            trailing = None
+            if cars is not None:
+                # Keep the trailing locations of every car for the trips that continue the next day
+                trailing = {}
+                cars = collect_trailing_locations(cars, trailing)
+
+            # Make trips, segmentation runs on worker processes if workers is larger than 1
+            car_trips = make_trips(cars, workers) if cars is not None else None
+            if trailing is not None:
+                try:
+                    write_checkpoint(storage_bucket, checkpoint_blob_name(day, file_name_locations), trailing)
+                except Exception as e:
+                    # The next run falls back to the locations file of this day
+                    logging.exception(f"Unable to store checkpoint of {day} because of {e}")
+            if car_trips:
+                # Patch trips
+                car_trips = patch_trips(car_trips, previous_day)
+
+                # Upload to firestore
+                success = upload_trips(car_trips, limiter) and success
+                logging.info(f"Finished uploading trips of {day} to firestore")
+            else:
+                logging.info(f"No new car trips found for {day}")
 
-        if not len(car["trips"]) > 0:
-            logging.info(
-                f"Not enough trips for license '{car_license_hash}', skipping this"
-            )
-            continue
+            previous_day = DayLocations.preloaded(blob_name, trailing, storage_format)
 
-        # Check if first trip of the car starts with moving
-        # Because if it does, the trip has started yesterday and was only finished today
-        trip = car["trips"][0]
-        if trip[0]["what"] == "Moving":
-            trip = patch_trip(trip, car_license_hash, file_name_locations)
-            # If trip is now empty
-            if not trip:
-                # There were no locations yesterday, trip can be removed
-                car["trips"].pop(0)
-            else:
-                # Else set the unfinished car trip to the finished car trip
-                car["trips"][0] = trip
-        # Check if the last trip of the car ends with moving
-        # Because if it does, the trip starts today but ends tomorrow and can be removed
-        # First check if trip is not empty since other check
-        if car["trips"]:
-            trip = car["trips"][-1]
-            if trip[-1]["what"] == "Moving":
-                car["trips"] = car["trips"][:-1]
-        # Remove double stationary
-        # First check if trip is not empty since other checks
-        if car["trips"]:
-            to_rem_trip = []
-            new_trips = []
-            # For every trip of the car
-            for t in range(len(car["trips"])):
-                to_rem_loc = []
-                new_trip = []
-                # For every location in a trip
-                for loc in range(len(car["trips"][t])):
-                    # Check if a previous location get is possible
-                    if loc - 1 >= 0:
-                        # If the current location is stationary and the last location
-                        # is stationary as well
-                        if (
-                            (
-                                car["trips"][t][loc - 1]["what"] == "Stationary"
-                                and car["trips"][t][loc]["what"] == "Stationary"
-                            )
-                            or (
-                                car["trips"][t][loc - 1]["what"] == "Stationary"
-                                and car["trips"][t][loc]["what"]
-                                == "ExternalPowerChange"
-                            )
-                            or (
-                                car["trips"][t][loc - 1]["what"]
-                                == "ExternalPowerChange"
-                                and car["trips"][t][loc]["what"] == "Stationary"
-                            )
-                            or (
-                                car["trips"][t][loc - 1]["what"]
-                                == "ExternalPowerChange"
-                                and car["trips"][t][loc]["what"]
-                                == "ExternalPowerChange"
-                            )
-                        ):
-                            # Remove the last stationary location
-                            to_rem_loc.append(loc - 1)
-                # Only add locations that did not have to be removed
-                for loc in range(len(car["trips"][t])):
-                    if loc not in to_rem_loc:
-                        new_trip.append(car["trips"][t][loc])
-                car["trips"][t] = new_trip
-                # Now check if the current trip only has one value
-                if len(car["trips"][t]) == 1:
-                    # If it does, remove the trip
-                    to_rem_trip.append(t)
-            for t in range(len(car["trips"])):
-                if t not in to_rem_trip:
-                    new_trips.append(car["trips"][t])
-            car["trips"] = new_trips
-    # Remove car licenses that have empty trips
-    new_car_trips = []
-    to_rem_car_trip = []
-    for c in range(len(car_trips)):
-        if not car_trips[c]["trips"]:
-            to_rem_car_trip.append(c)
-    for c in range(len(car_trips)):
-        if c not in to_rem_car_trip:
-            new_car_trips.append(car_trips[c])
-    car_trips = new_car_trips
-    return car_trips
+    return success
 
 
 def entrypoint(request):
@@ -298,20 +112,42 @@ def entrypoint(request):
     if not file_name_locations.endswith(".json"):
         logging.error("Argument FILE_NAME should have json extension")
 
-    # Make trips
-    car_trips = make_trips(file_name_locations)
-
-    if car_trips:
-        # Patch trips
-        car_trips = patch_trips(car_trips, file_name_locations)
-
-        # Upload to firestore
-        upload_to_firestore_success = upload_to_firestore(car_trips)
-        if not upload_to_firestore_success:
-            sys.exit(1)
-        logging.info("Finished uploading trips to firestore")
-    else:
-        logging.info("No new car trips found")
+    # Process yesterday, or for a backfill every day from start_date up to and including end_date
+    yesterday = datetime.date.today() - datetime.timedelta(1)
+    args = request.args if request is not None else {}
+    try:
+        start_date = parse_date(args["start_date"]) if "start_date" in args else yesterday
+        end_date = parse_date(args["end_date"]) if "end_date" in args else yesterday
+    except ValueError:
+        logging.error("Arguments start_date and end_date should have format YYYY-MM-DD")
+        return "Bad Request", 400
+    if start_date > end_date:
+        logging.error(f"Argument start_date {start_date} is after end_date {end_date}")
+        return "Bad Request", 400
+    days = [start_date + datetime.timedelta(i) for i in range((end_date - start_date).days + 1)]
+    if len(days) > 1:
+        logging.info(f"Backfilling trips of {len(days)} days, from {start_date} up to and including {end_date}")
+
+    # Locations are stored as JSON, or in the columnar or compact format if LOCATIONS_FORMAT is 'columnar'
+    # or 'compact'
+    storage_format = config.LOCATIONS_FORMAT if hasattr(config, 'LOCATIONS_FORMAT') else "json"
+    if storage_format == "columnar":
+        file_name_locations = columnar_blob_name(file_name_locations)
+    elif storage_format == "compact":
+        file_name_locations = compact_blob_name(file_name_locations)
+
+    # Locations are stored in one file per day, in shards of licenses if LOCATIONS_LAYOUT is 'sharded',
+    # or in a segment per run of locations_to_stg if it is 'segments'
+    layout = config.LOCATIONS_LAYOUT if hasattr(config, 'LOCATIONS_LAYOUT') else "day"
+
+    # Segmentation runs on worker processes if TRIPS_WORKERS is larger than 1
+    workers = config.TRIPS_WORKERS if hasattr(config, 'TRIPS_WORKERS') else 1
+    if not process_days(days, file_name_locations, workers, storage_format, layout):
+        sys.exit(1)
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
 
 
 if __name__ == "__main__":
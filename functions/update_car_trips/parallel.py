@@ -0,0 +1,50 @@
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+logging.basicConfig(level=logging.INFO)
+
+# Number of cars in one work unit of a worker process
+CHUNK_SIZE = 64
+
+
+def map_cars(function, cars, compact, workers=1, chunk_size=CHUNK_SIZE):
+    """Yields (car, function(compact(car))) for every car, in the order of the cars
+
+    With more than one worker the cars are sharded in chunks over a pool of processes.
+    Only the compact input of a car is sent to a worker, so it should be cheap to pickle.
+    Inputs with fewer than two chunks per worker are processed serially, since starting
+    the pool would cost more than it saves. The function has to be a module level function.
+    """
+    cars = iter(cars)
+    head = list(islice(cars, 2 * chunk_size * workers))
+    if workers <= 1 or len(head) < 2 * chunk_size * workers:
+        for car in chain(head, cars):
+            yield car, function(compact(car))
+        return
+
+    logging.info(f"Processing cars in chunks of {chunk_size} on {workers} worker processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Chunks are finished in the order they were submitted, so the output is deterministic
+        # At most two chunks per worker are in flight, to keep the memory of the run bounded
+        pending = deque()
+        for chunk in chunks(chain(head, cars), chunk_size):
+            pending.append((chunk, executor.submit(map_chunk, function, [compact(car) for car in chunk])))
+            if len(pending) > 2 * workers:
+                yield from finish_chunk(*pending.popleft())
+        while pending:
+            yield from finish_chunk(*pending.popleft())
+
+
+def map_chunk(function, inputs):
+    return [function(compact_car) for compact_car in inputs]
+
+
+def finish_chunk(chunk, future):
+    return zip(chunk, future.result())
+
+
+def chunks(iterable, n):
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, n)), [])
@@ -0,0 +1,76 @@
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+STATIONARY_EVENTS = ("Stationary", "ExternalPowerChange")
+
+# Every stage takes an iterable of cars with trips and lazily yields the processed cars.
+# Stages change the trips of a car in place and only copy a trip if it has to be shortened.
+
+
+def stitch_overnight_trips(car_trips, patch):
+    """Completes the first trip of a car if it started the day before
+
+    The patch function gets the trip and the hashed license and returns the completed trip,
+    or an empty list if the trip cannot be completed and has to be removed.
+    """
+    for car in car_trips:
+        trips = car["trips"]
+        if not trips:
+            logging.info(f"Not enough trips for license '{car['license_hash']}', skipping this")
+        # If the first trip starts with moving, it has started yesterday and was only finished today
+        elif trips[0][0]["what"] == "Moving":
+            trip = patch(trips[0], car["license_hash"])
+            if trip:
+                trips[0] = trip
+            else:
+                del trips[0]
+        yield car
+
+
+def trim_open_trips(car_trips):
+    """Removes the last trip of a car if it is not finished yet"""
+    for car in car_trips:
+        trips = car["trips"]
+        # If the last trip ends with moving, it starts today but ends tomorrow
+        if trips and trips[-1][-1]["what"] == "Moving":
+            trips.pop()
+        yield car
+
+
+def collapse_stationary(car_trips):
+    """Keeps only the last location of consecutive stationary and power change locations"""
+    for car in car_trips:
+        trips = car["trips"]
+        for t, trip in enumerate(trips):
+            trips[t] = collapse_trip(trip)
+        yield car
+
+
+def drop_short_trips(car_trips):
+    """Removes trips with a single location, and cars without trips"""
+    for car in car_trips:
+        trips = car["trips"]
+        if any(len(trip) == 1 for trip in trips):
+            car["trips"] = trips = [trip for trip in trips if len(trip) != 1]
+        if trips:
+            yield car
+
+
+def collapse_trip(trip):
+    collapsed = None
+    for i in range(len(trip) - 1):
+        if trip[i]["what"] in STATIONARY_EVENTS and trip[i + 1]["what"] in STATIONARY_EVENTS:
+            if collapsed is None:
+                collapsed = trip[:i]
+        elif collapsed is not None:
+            collapsed.append(trip[i])
+    if collapsed is None:
+        return trip
+    collapsed.append(trip[-1])
+    return collapsed
+
+
+def postprocess_trips(car_trips, patch):
+    """Chains all stages, returns the cars that have complete trips"""
+    return list(drop_short_trips(collapse_stationary(trim_open_trips(stitch_overnight_trips(car_trips, patch)))))
@@ -0,0 +1,122 @@
+import numpy as np
+
+# Integer codes of the location events, locations with any other 'what' get code 0
+MOVING = 1
+STATIONARY = 2
+EXTERNAL_POWER_CHANGE = 3
+
+EVENT_CODES = {
+    "Moving": MOVING,
+    "Stationary": STATIONARY,
+    "ExternalPowerChange": EXTERNAL_POWER_CHANGE,
+}
+
+
+def encode_events(locations):
+    """Returns the 'what' labels of the locations as an integer code array"""
+    return np.fromiter(
+        (EVENT_CODES.get(location["what"], 0) for location in locations),
+        dtype=np.uint8,
+        count=len(locations),
+    )
+
+
+def segment(codes):
+    """Returns the trips in an event code array as (start, stop) index slices"""
+    n = len(codes)
+    if n == 0:
+        return []
+
+    index = np.arange(n)
+    moving = codes == MOVING
+    stationary = (codes == STATIONARY) | (codes == EXTERNAL_POWER_CHANGE)
+
+    next_moving = np.zeros(n, dtype=bool)
+    next_moving[:-1] = moving[1:]
+    # The previous location of the first location is the last location of the day
+    prev_moving = np.roll(moving, 1)
+    look_ahead = index < n - 2
+
+    # Stationary between two moving locations: end of a trip and start of a new one
+    split = look_ahead & stationary & prev_moving & next_moving
+    # Stationary before a moving location: start of a trip
+    start = look_ahead & stationary & next_moving & ~split
+    # Stationary after a moving location: end of a trip
+    end = (index >= 1) & stationary & prev_moving & ~split & ~start
+
+    split_at = np.flatnonzero(split)
+    end_at = np.flatnonzero(end)
+
+    # Every trip begins at the last start marker before its end
+    markers = np.sort(np.concatenate(([0], np.flatnonzero(start), split_at, end_at + 1)))
+    # A split location ends the trip before it and starts a new one itself
+    split_from = markers[np.maximum(np.searchsorted(markers, split_at, side="left") - 1, 0)]
+    end_from = markers[np.searchsorted(markers, end_at, side="right") - 1]
+
+    trip_from = [split_from, end_from]
+    trip_to = [split_at, end_at]
+
+    # The last location of the day closes the trip that is still open
+    if (moving[-1] or stationary[-1]) and not end[-1]:
+        trip_from.append(markers[[np.searchsorted(markers, n - 1, side="right") - 1]])
+        trip_to.append(np.array([n - 1]))
+
+    trip_from = np.concatenate(trip_from)
+    trip_to = np.concatenate(trip_to)
+    order = np.argsort(trip_to, kind="stable")
+
+    return [
+        slice(int(trip_start), int(trip_end) + 1)
+        for trip_start, trip_end in zip(trip_from[order], trip_to[order])
+    ]
+
+
+def build_trips(locations, codes, slices):
+    """Returns the trips of the index slices"""
+    # Locations with an unknown event are never part of a trip
+    included = np.flatnonzero(codes)
+    all_included = len(included) == len(locations)
+
+    whens = [locations[i]["when"] for i in included.tolist()]
+    # Equal locations can only occur when a 'when' occurs more than once
+    has_duplicates = len(set(whens)) != len(whens)
+
+    starts = np.searchsorted(included, [trip_slice.start for trip_slice in slices]).tolist()
+    stops = np.searchsorted(included, [trip_slice.stop for trip_slice in slices]).tolist()
+    included = included.tolist()
+
+    trips = []
+    last_stop = 0
+    for trip_slice, start, stop in zip(slices, starts, stops):
+        if all_included:
+            trip = locations[trip_slice]
+        else:
+            trip = [locations[i] for i in included[start:stop]]
+        # Only the first location of a trip can already be part of the previous trip
+        # Copy it so that trips never share a location
+        if trip_slice.start < last_stop:
+            trip[0] = dict(trip[0])
+        last_stop = trip_slice.stop
+
+        if has_duplicates:
+            trip = unique_locations(trip)
+        trips.append(trip)
+    return trips
+
+
+def unique_locations(trip):
+    """Returns the trip without locations that are equal to an earlier location"""
+    seen = {}
+    unique = []
+    for location in trip:
+        same_when = seen.setdefault(location["when"], [])
+        if location not in same_when:
+            same_when.append(location)
+            unique.append(location)
+    return unique
+
+
+def segment_locations(locations):
+    """Returns the trips of one car's locations of a day"""
+    codes = encode_events(locations)
+    return build_trips(locations, codes, segment(codes))
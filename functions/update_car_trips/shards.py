@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as gcp_exceptions
+
+logging.basicConfig(level=logging.INFO)
+
+# Sharded storage of the locations of one day, shared by locations_to_stg and update_car_trips
+#
+# Instead of one locations blob YYYY/MM/DD/<file name> a day has one blob per shard,
+# YYYY/MM/DD/shard=<prefix>/<file name>, with the cars whose hashed license hashes to the prefix.
+# The manifest YYYY/MM/DD/<file name without extension>.manifest.json lists the shards of the day.
+# A run of locations_to_stg only rewrites the shards of the cars it received locations of.
+# Runs can overlap, so the manifest is only written if it did not change since it was read.
+# Readers list the shards of the day, the manifest is only a hint of which shards to expect.
+
+SHARD_PREFIX_LENGTH = 2
+MANIFEST_EXTENSION = ".manifest.json"
+
+
+def shard_of(license_hash, prefix_length=SHARD_PREFIX_LENGTH):
+    """Returns the shard of a hashed license, the first hex digits of its hash"""
+    return hashlib.sha256(license_hash.encode("utf-8")).hexdigest()[:prefix_length]
+
+
+def shard_blob_name(blob_name, shard):
+    folder, file_name = posixpath.split(blob_name)
+    return f"{folder}/shard={shard}/{file_name}"
+
+
+def manifest_blob_name(blob_name):
+    return os.path.splitext(blob_name)[0] + MANIFEST_EXTENSION
+
+
+def read_manifest(storage_bucket, blob_name):
+    """Returns the manifest of the sharded day of a locations blob, or None if it does not exist"""
+    blob = storage_bucket.get_blob(manifest_blob_name(blob_name))
+    if blob is None:
+        return None
+    return json.loads(blob.download_as_string())
+
+
+def write_manifest(storage_bucket, blob_name, manifest, generation=0):
+    """Writes the manifest if its blob is still at generation, 0 if it did not exist
+
+    Raises PreconditionFailed if another run wrote the manifest in the meantime.
+    """
+    storage_bucket.blob(manifest_blob_name(blob_name)).upload_from_string(
+        data=json.dumps(manifest), content_type="application/json", if_generation_match=generation
+    )
+
+
+def add_to_manifest(storage_bucket, blob_name, shards, prefix_length=SHARD_PREFIX_LENGTH, max_attempts=5):
+    """Adds shards to the manifest of the sharded day of a locations blob, returns the manifest
+
+    The manifest is read again and the shards added again if another run wrote it in the meantime.
+    """
+    for attempt in range(1, max_attempts + 1):
+        blob = storage_bucket.get_blob(manifest_blob_name(blob_name))
+        if blob is None:
+            manifest = {"prefix_length": prefix_length, "shards": []}
+            generation = 0
+        else:
+            manifest = json.loads(blob.download_as_string())
+            generation = blob.generation
+        if set(shards) <= set(manifest["shards"]):
+            return manifest
+        manifest["shards"] = sorted(set(manifest["shards"]) | set(shards))
+        try:
+            write_manifest(storage_bucket, blob_name, manifest, generation)
+        except gcp_exceptions.PreconditionFailed:
+            if attempt == max_attempts:
+                # The shards are written, readers find them without the manifest
+                logging.warning(f"Unable to add shards {sorted(shards)} to the manifest of '{blob_name}' "
+                                f"after {max_attempts} attempts")
+                return manifest
+            logging.info(f"Manifest of '{blob_name}' was written by another run, adding shards again")
+        else:
+            return manifest
+
+
+def list_shards(storage_bucket, blob_name):
+    """Returns the shards of the sharded day of a locations blob that exist"""
+    folder, file_name = posixpath.split(blob_name)
+    prefix = f"{folder}/shard="
+    shards = []
+    for blob in storage_bucket.list_blobs(prefix=prefix):
+        shard, _, name = blob.name[len(prefix):].partition("/")
+        if name == file_name:
+            shards.append(shard)
+    return sorted(shards)
+
+
+def fetch_shards(storage_bucket, blob_name, max_workers=8):
+    """Downloads the shards of the sharded day of a locations blob concurrently
+
+    Returns a list with the contents of every shard, or None if the day has no manifest and no shards.
+    """
+    manifest = read_manifest(storage_bucket, blob_name)
+    # Listing finds the shards of runs that did not get to add them to the manifest
+    shards = list_shards(storage_bucket, blob_name)
+    if manifest is None and not shards:
+        return None
+    if manifest is not None:
+        for shard in sorted(set(manifest["shards"]) - set(shards)):
+            logging.warning(f"Shard '{shard}' of '{blob_name}' is in its manifest but does not exist")
+        unlisted = set(shards) - set(manifest["shards"])
+        if unlisted:
+            logging.info(f"Shards {sorted(unlisted)} of '{blob_name}' are not in its manifest")
+
+    def download(shard):
+        blob = storage_bucket.get_blob(shard_blob_name(blob_name, shard))
+        if blob is None:
+            logging.warning(f"Shard '{shard}' of '{blob_name}' was removed while fetching the shards")
+            return None
+        return blob.download_as_bytes()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        contents = [data for data in executor.map(download, shards) if data is not None]
+    logging.info(f"Fetched {len(contents)} shards of '{blob_name}'")
+    return contents
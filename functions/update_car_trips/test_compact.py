@@ -0,0 +1,130 @@
+import gzip
+import json
+import random
+import unittest
+
+import numpy as np
+from columnar import quantize_location
+from compact import (COMPACT_EXTENSION, EVENT_LABELS, compact_blob_name, compact_to_json, decode_deltas,
+                     decode_integers, encode_deltas, encode_integers, json_to_compact, read_cars, write_day)
+from timestamps import format_when, parse_locations
+
+START = 1622505600
+INT64 = np.iinfo(np.int64)
+
+
+def make_location(when, lon, lat, what="Moving"):
+    """Returns a location as it is stored in JSON, when is in epoch seconds"""
+    return {"when": format_when(when), "geometry": {"type": "Point", "coordinates": [lon, lat]}, "what": what}
+
+
+def make_day(cars, points, seed=0):
+    """Returns a day of locations of the cars, as it is stored in JSON"""
+    rng = random.Random(seed)
+    day = {}
+    for c in range(cars):
+        when = START + rng.randrange(600)
+        lon, lat = rng.uniform(3.3, 7.2), rng.uniform(50.7, 53.6)
+        locations = []
+        for _ in range(points):
+            when += rng.choice([1, 30, 60, 3600])
+            lon += rng.gauss(0, 0.001)
+            lat += rng.gauss(0, 0.001)
+            what = rng.choices(["Moving", "Stationary", "ExternalPowerChange"], weights=[6, 3, 1])[0]
+            locations.append(make_location(when, lon, lat, what))
+        day[f"hash-{c}"] = {"license": f"car-{c}", "locations": locations}
+    return day
+
+
+class TestIntegers(unittest.TestCase):
+    def test_round_trip(self):
+        values = np.array([0, 1, -1, 15, 16, -16, -17, 31, 32, 2 ** 31, -2 ** 31, 2 ** 40, INT64.max, INT64.min],
+                          dtype=np.int64)
+        self.assertEqual(decode_integers(encode_integers(values)).tolist(), values.tolist())
+
+    def test_polyline_characters(self):
+        # Values of 5 bits are one character, larger values one more for every 5 bits
+        self.assertEqual(encode_integers([0, -1, 15]), "?@]")
+        self.assertEqual(len(encode_integers([16])), 2)
+        self.assertEqual(len(encode_integers([INT64.max])), 13)
+        self.assertTrue(all(63 <= ord(character) <= 126 for character in encode_integers([INT64.min])))
+
+    def test_empty(self):
+        self.assertEqual(encode_integers([]), "")
+        self.assertEqual(decode_integers("").tolist(), [])
+        self.assertEqual(decode_deltas(encode_deltas([])).tolist(), [])
+
+    def test_extreme_deltas(self):
+        # Epoch seconds that jump decades forwards and back, and repeat
+        whens = [0, START, START, 4102444800, 1, 2 ** 40, -2 ** 40, START]
+        self.assertEqual(decode_deltas(encode_deltas(whens)).tolist(), whens)
+
+
+class TestCompactDay(unittest.TestCase):
+    def assert_round_trip(self, day):
+        """Checks the compact file decodes to the locations of the day, as precise as they are stored"""
+        decoded = compact_to_json(json_to_compact(day))
+        self.assertEqual(set(decoded), set(day))
+        for license_hash, car in day.items():
+            expected = parse_locations([quantize_location(location) for location in car["locations"]])
+            self.assertEqual(decoded[license_hash]["license"], car["license"])
+            self.assertEqual(decoded[license_hash]["locations"], expected, license_hash)
+
+    def test_round_trip(self):
+        self.assert_round_trip(make_day(20, 500))
+
+    def test_stored_when_format(self):
+        # Location 'when' is in epoch seconds or in the stored format
+        location = dict(make_location(START, 5.1, 52.1), when=START)
+        day = {"hash-1": {"license": "car-1", "locations": [location, make_location(START + 1, 5.1, 52.1)]}}
+        whens = [location["when"] for location in compact_to_json(json_to_compact(day))["hash-1"]["locations"]]
+        self.assertEqual(whens, [START, START + 1])
+
+    def test_empty_cars(self):
+        self.assertEqual(compact_to_json(json_to_compact({})), {})
+        day = make_day(3, 10)
+        day["hash-empty"] = {"license": "car-empty", "locations": []}
+        # A car without the locations key is stored without locations
+        day["hash-missing"] = {"license": "car-missing"}
+        decoded = compact_to_json(json_to_compact(day))
+        self.assertEqual(decoded["hash-empty"], {"license": "car-empty", "locations": []})
+        self.assertEqual(decoded["hash-missing"], {"license": "car-missing", "locations": []})
+        del day["hash-missing"]
+        self.assert_round_trip(day)
+
+    def test_negative_coordinates(self):
+        locations = [make_location(START + i, lon, lat) for i, (lon, lat) in enumerate(
+            [(-0.1, 51.5), (-0.1000001, -51.5), (-179.9999999, -89.9999999), (179.9999999, 89.9999999),
+             (0.0, -0.0000001), (-73.9857, 40.7484)])]
+        self.assert_round_trip({"hash-1": {"license": "car-1", "locations": locations}})
+
+    def test_unknown_labels(self):
+        # Labels that are not events are added to the labels of the file, the empty label is code 0
+        locations = [make_location(START + i, 5.1, 52.1, what) for i, what in enumerate(
+            ["Moving", "Unknown", "", "Stationary", "Unknown", "Towed"])]
+        data = json_to_compact({"hash-1": {"license": "car-1", "locations": locations}})
+        stored = json.loads(gzip.decompress(data))
+        self.assertEqual(stored["events"], EVENT_LABELS + ["Unknown", "Towed"])
+        self.assertEqual(decode_integers(stored["cars"]["hash-1"]["what"]).tolist(), [1, 4, 0, 2, 4, 5])
+        self.assert_round_trip({"hash-1": {"license": "car-1", "locations": locations}})
+
+    def test_extreme_whens(self):
+        locations = [make_location(when, 5.1, 52.1) for when in [0, START, START, 4102444800, 1, START]]
+        self.assert_round_trip({"hash-1": {"license": "car-1", "locations": locations}})
+
+    def test_rejects_other_geometries(self):
+        location = {"when": START, "what": "Moving", "geometry": {"type": "LineString", "coordinates": [[5, 52]]}}
+        with self.assertRaises(ValueError):
+            write_day([("hash-1", "car-1", [location])])
+
+    def test_rejects_other_versions(self):
+        data = gzip.compress(json.dumps({"version": 0, "cars": {}}).encode("utf-8"))
+        with self.assertRaises(ValueError):
+            list(read_cars(data))
+
+    def test_blob_name(self):
+        self.assertEqual(compact_blob_name("locations.json"), "locations" + COMPACT_EXTENSION)
+
+
+if __name__ == '__main__':
+    unittest.main()
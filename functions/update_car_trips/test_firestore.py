@@ -0,0 +1,142 @@
+import itertools
+import unittest
+
+from firestore import TRANSIENT_ERRORS, BulkWriter, RampUpLimiter, upload_to_firestore
+from google.api_core import exceptions as gcp_exceptions
+
+START = 1622505600
+
+
+class FakeDocument(object):
+    def __init__(self, document_id):
+        self.id = document_id
+
+
+class FakeCollection(object):
+    def __init__(self, ids):
+        self.ids = ids
+
+    def document(self):
+        return FakeDocument(f"trip-{next(self.ids)}")
+
+
+class FakeBatch(object):
+    """Fails as a whole if one of its documents is invalid, or with the next of the client's errors"""
+
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, doc_ref, data):
+        self.writes.append((doc_ref, data))
+
+    def commit(self):
+        self.client.commits += 1
+        if self.client.errors:
+            raise self.client.errors.pop(0)
+        if any(data.get("invalid") for _, data in self.writes):
+            raise gcp_exceptions.InvalidArgument("Document is invalid")
+        for doc_ref, data in self.writes:
+            self.client.documents[doc_ref.id] = data
+
+
+class FakeFirestore(object):
+    def __init__(self, errors=None):
+        self.errors = list(errors) if errors else []
+        self.commits = 0
+        self.documents = {}
+        self.ids = itertools.count()
+
+    def collection(self, name):
+        return FakeCollection(self.ids)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeLimiter(object):
+    def __init__(self):
+        self.operations = 0
+
+    def acquire(self, operations):
+        self.operations += operations
+
+
+def make_writes(count, invalid=()):
+    return [(FakeDocument(f"trip-{i}"), {"invalid": i in invalid}, 1) for i in range(count)]
+
+
+def make_car_trips(cars, trips):
+    location = {"when": START, "what": "Moving", "geometry": {"type": "Point", "coordinates": [5.0, 52.0]}}
+    return [
+        {"license": f"car-{car}", "license_hash": f"hash-{car}", "trips": [[dict(location)] * 2] * trips}
+        for car in range(cars)
+    ]
+
+
+class TestBulkWriter(unittest.TestCase):
+    def test_writes_every_batch(self):
+        client = FakeFirestore()
+        errors = BulkWriter(client, limiter=FakeLimiter()).write(make_writes(1200))
+        self.assertEqual(errors, [None] * 1200)
+        self.assertEqual(len(client.documents), 1200)
+        self.assertEqual(client.commits, 3)
+
+    def test_only_invalid_writes_fail(self):
+        client = FakeFirestore()
+        with self.assertLogs(level="ERROR") as logs:
+            errors = BulkWriter(client, limiter=FakeLimiter()).write(make_writes(1000, invalid={7, 700}))
+        self.assertEqual([i for i, error in enumerate(errors) if error], [7, 700])
+        self.assertIsInstance(errors[7], gcp_exceptions.InvalidArgument)
+        self.assertEqual(len(client.documents), 998)
+        # One line for every batch with a failed write
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("1 of 500 writes", logs.output[0])
+
+    def test_transient_errors_are_retried(self):
+        client = FakeFirestore(errors=[gcp_exceptions.ServiceUnavailable("Unavailable")])
+        writer = BulkWriter(client, backoff_base=0, limiter=FakeLimiter())
+        self.assertEqual(writer.write(make_writes(10)), [None] * 10)
+        self.assertEqual(client.commits, 2)
+
+    def test_batch_fails_after_transient_errors(self):
+        client = FakeFirestore(errors=[gcp_exceptions.ServiceUnavailable("Unavailable")] * 3)
+        writer = BulkWriter(client, max_attempts=3, backoff_base=0, limiter=FakeLimiter())
+        with self.assertLogs(level="ERROR"):
+            errors = writer.write(make_writes(10))
+        # The batch is not split, since its halves would fail for the same reason
+        self.assertTrue(all(isinstance(error, TRANSIENT_ERRORS) for error in errors))
+        self.assertEqual(client.commits, 3)
+
+
+class TestRampUpLimiter(unittest.TestCase):
+    def test_rate_grows_every_interval(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RampUpLimiter(clock=lambda: now[0], sleep=sleep)
+        limiter.acquire(500)
+        limiter.acquire(500)
+        self.assertEqual(sleeps, [1.0])
+        now[0] = 300.0
+        self.assertEqual(limiter.rate(now[0]), 750)
+
+
+class TestUploadToFirestore(unittest.TestCase):
+    def test_uploads_share_limiter(self):
+        client = FakeFirestore()
+        limiter = FakeLimiter()
+        for _ in range(2):
+            report = upload_to_firestore(make_car_trips(3, 2), db_client=client, limiter=limiter)
+            self.assertEqual(len(report), 6)
+            self.assertTrue(all(trip["error"] is None for trip in report))
+        self.assertEqual(limiter.operations, 12)
+        self.assertEqual(len(client.documents), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
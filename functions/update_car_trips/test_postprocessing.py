@@ -0,0 +1,238 @@
+import copy
+import random
+import unittest
+
+from day_locations import DayLocations, trailing_locations
+from postprocessing import (collapse_stationary, drop_short_trips, postprocess_trips, stitch_overnight_trips,
+                            trim_open_trips)
+from segmentation import segment_locations
+from trips import patch_trip, patch_trips
+
+START = 1622505600
+LABELS = ["Moving", "Stationary", "ExternalPowerChange"]
+
+
+def reference_patch_trip(trip, car_license_hash, previous_locations):  # noqa: C901
+    """Patching of a trip as it was before postprocessing was split in stages, kept as the reference
+
+    The previous day is given as the locations of every car, or None if its file does not exist.
+    """
+    if previous_locations is not None:
+        locations = copy.deepcopy(previous_locations.get(car_license_hash, []))
+        add_to_trip = []
+        i = len(locations) - 1
+        while i >= 0:
+            location = locations[i]
+            while (
+                location["what"] != "Stationary"
+                and location["what"] != "ExternalPowerChange"
+            ):
+                add_to_trip.append(location)
+                if i - 1 < 0:
+                    return []
+                i = i - 1
+            add_to_trip.append(location)
+            i = -1
+        add_to_trip = add_to_trip[::-1]
+        trip[0:0] = add_to_trip
+        return trip
+    return []
+
+
+def reference_patch_trips(car_trips, previous_locations):  # noqa: C901
+    """Postprocessing as it was before it was split in stages, kept as the reference"""
+    car_trips = copy.deepcopy(car_trips)
+    for car in car_trips:
+        car_license_hash = car["license_hash"]
+        if not len(car["trips"]) > 0:
+            continue
+        trip = car["trips"][0]
+        if trip[0]["what"] == "Moving":
+            trip = reference_patch_trip(trip, car_license_hash, previous_locations)
+            if not trip:
+                car["trips"].pop(0)
+            else:
+                car["trips"][0] = trip
+        if car["trips"]:
+            trip = car["trips"][-1]
+            if trip[-1]["what"] == "Moving":
+                car["trips"] = car["trips"][:-1]
+        if car["trips"]:
+            to_rem_trip = []
+            new_trips = []
+            for t in range(len(car["trips"])):
+                to_rem_loc = []
+                new_trip = []
+                for loc in range(len(car["trips"][t])):
+                    if loc - 1 >= 0:
+                        if (
+                            car["trips"][t][loc - 1]["what"] in ["Stationary", "ExternalPowerChange"]
+                            and car["trips"][t][loc]["what"] in ["Stationary", "ExternalPowerChange"]
+                        ):
+                            to_rem_loc.append(loc - 1)
+                for loc in range(len(car["trips"][t])):
+                    if loc not in to_rem_loc:
+                        new_trip.append(car["trips"][t][loc])
+                car["trips"][t] = new_trip
+                if len(car["trips"][t]) == 1:
+                    to_rem_trip.append(t)
+            for t in range(len(car["trips"])):
+                if t not in to_rem_trip:
+                    new_trips.append(car["trips"][t])
+            car["trips"] = new_trips
+    return [car for car in car_trips if car["trips"]]
+
+
+def make_trip(whats, start=START):
+    """Returns a trip with the events, a minute apart"""
+    return [
+        {"when": start + 60 * i, "what": what, "geometry": {"type": "Point", "coordinates": [5.0 + i / 1000, 52.0]}}
+        for i, what in enumerate(whats)
+    ]
+
+
+def make_car(trips, license_hash="hash-1"):
+    return {"license": f"car-{license_hash}", "license_hash": license_hash, "trips": trips}
+
+
+def whats(trip):
+    return [location["what"] for location in trip]
+
+
+def previous_day(previous_locations):
+    """Returns the view of a previous day with the locations of every car, None if it does not exist"""
+    trailing = {license_hash: trailing_locations(locations) for license_hash, locations
+                in previous_locations.items()} if previous_locations is not None else None
+    return DayLocations.preloaded("2021/06/01/locations.json", trailing)
+
+
+class TestStitchOvernightTrips(unittest.TestCase):
+    def stitch(self, car, previous_locations):
+        day = previous_day(previous_locations)
+
+        def patch(trip, license_hash):
+            return patch_trip(trip, license_hash, day)
+
+        return list(stitch_overnight_trips([car], patch))
+
+    def test_completes_trip_from_previous_day(self):
+        car = make_car([make_trip(["Moving", "Stationary"])])
+        previous = {"hash-1": make_trip(["Moving", "Stationary"], START - 3600)}
+        trips = self.stitch(car, previous)[0]["trips"]
+        self.assertEqual(whats(trips[0]), ["Stationary", "Moving", "Stationary"])
+        self.assertEqual(trips[0][0]["when"], START - 3600 + 60)
+
+    def test_missing_previous_day(self):
+        # Without the previous day's file, the trip cannot be completed and is removed
+        car = make_car([make_trip(["Moving", "Stationary"]), make_trip(["Stationary", "Moving", "Stationary"])])
+        trips = self.stitch(car, None)[0]["trips"]
+        self.assertEqual([whats(trip) for trip in trips], [["Stationary", "Moving", "Stationary"]])
+
+    def test_empty_previous_day(self):
+        # A previous day without locations of the car leaves the trip as it is
+        car = make_car([make_trip(["Moving", "Stationary"])])
+        self.assertEqual(whats(self.stitch(car, {})[0]["trips"][0]), ["Moving", "Stationary"])
+        car = make_car([make_trip(["Moving", "Stationary"])])
+        self.assertEqual(whats(self.stitch(car, {"hash-1": []})[0]["trips"][0]), ["Moving", "Stationary"])
+
+    def test_previous_day_ends_moving(self):
+        # The car was still moving at the end of the previous day, so the trip is removed
+        car = make_car([make_trip(["Moving", "Stationary"])])
+        previous = {"hash-1": make_trip(["Stationary", "Moving", "Moving"], START - 3600)}
+        self.assertEqual(self.stitch(car, previous)[0]["trips"], [])
+
+    def test_previous_day_is_unchanged(self):
+        car = make_car([make_trip(["Moving", "Stationary"])])
+        previous = {"hash-1": make_trip(["Moving", "Stationary"], START - 3600)}
+        day = previous_day(previous)
+        trip = patch_trip(car["trips"][0], "hash-1", day)
+        trip[0]["what"] = "Changed"
+        self.assertEqual(day.trailing_locations("hash-1")[0]["what"], "Stationary")
+
+    def test_car_without_trips(self):
+        car = make_car([])
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(self.stitch(car, {})[0]["trips"], [])
+
+
+class TestTrimOpenTrips(unittest.TestCase):
+    def test_removes_last_trip_ending_moving(self):
+        car = make_car([make_trip(["Stationary", "Moving", "Stationary"]), make_trip(["Stationary", "Moving"])])
+        trips = list(trim_open_trips([car]))[0]["trips"]
+        self.assertEqual([whats(trip) for trip in trips], [["Stationary", "Moving", "Stationary"]])
+
+    def test_keeps_finished_trips(self):
+        car = make_car([make_trip(["Stationary", "Moving"]), make_trip(["Stationary", "Moving", "Stationary"])])
+        self.assertEqual(len(list(trim_open_trips([car]))[0]["trips"]), 2)
+
+    def test_car_without_trips(self):
+        self.assertEqual(list(trim_open_trips([make_car([])]))[0]["trips"], [])
+
+
+class TestCollapseStationary(unittest.TestCase):
+    def test_keeps_last_of_mixed_runs(self):
+        trip = make_trip(["Stationary", "ExternalPowerChange", "Stationary", "Moving", "ExternalPowerChange",
+                          "Moving", "ExternalPowerChange", "Stationary", "ExternalPowerChange"])
+        collapsed = list(collapse_stationary([make_car([trip])]))[0]["trips"][0]
+        self.assertEqual(collapsed, [trip[2], trip[3], trip[4], trip[5], trip[8]])
+
+    def test_trip_without_runs_is_not_copied(self):
+        trip = make_trip(["Stationary", "Moving", "Stationary"])
+        self.assertIs(list(collapse_stationary([make_car([trip])]))[0]["trips"][0], trip)
+
+    def test_only_stationary(self):
+        trip = make_trip(["Stationary", "ExternalPowerChange", "Stationary"])
+        self.assertEqual(list(collapse_stationary([make_car([trip])]))[0]["trips"][0], [trip[2]])
+
+
+class TestDropShortTrips(unittest.TestCase):
+    def test_drops_single_location_trips(self):
+        trips = [make_trip(["Stationary"]), make_trip(["Stationary", "Moving", "Stationary"]), make_trip(["Moving"])]
+        cars = list(drop_short_trips([make_car(trips)]))
+        self.assertEqual(cars[0]["trips"], [trips[1]])
+
+    def test_drops_cars_without_trips(self):
+        cars = [make_car([], "hash-1"), make_car([make_trip(["Stationary"])], "hash-2"),
+                make_car([make_trip(["Stationary", "Moving", "Stationary"])], "hash-3")]
+        self.assertEqual([car["license_hash"] for car in drop_short_trips(cars)], ["hash-3"])
+
+
+class TestPostprocessTrips(unittest.TestCase):
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            cars = []
+            previous_locations = {}
+            for c in range(rng.randrange(1, 5)):
+                license_hash = f"hash-{c}"
+                day = make_trip(rng.choices(LABELS, weights=[6, 3, 1], k=rng.randrange(0, 30)))
+                cars.append(make_car(segment_locations(day), license_hash))
+                # Some cars have no locations the previous day
+                if rng.random() < 0.8:
+                    previous_locations[license_hash] = make_trip(
+                        rng.choices(LABELS, weights=[6, 3, 1], k=rng.randrange(0, 10)), START - 86400)
+            # Sometimes the previous day's file does not exist
+            if rng.random() < 0.1:
+                previous_locations = None
+
+            expected = reference_patch_trips(cars, previous_locations)
+            self.assertEqual(patch_trips(copy.deepcopy(cars), previous_day(previous_locations)), expected)
+
+    def test_chains_every_stage(self):
+        cars = [
+            make_car([make_trip(["Moving", "Stationary"]), make_trip(["Stationary", "Stationary", "Moving",
+                                                                      "ExternalPowerChange"]),
+                      make_trip(["Stationary"]), make_trip(["Stationary", "Moving"])], "hash-1"),
+            make_car([make_trip(["Moving", "Stationary"])], "hash-2"),
+        ]
+
+        def patch(trip, license_hash):
+            return []
+
+        cars = postprocess_trips(cars, patch)
+        self.assertEqual([car["license_hash"] for car in cars], ["hash-1"])
+        self.assertEqual([whats(trip) for trip in cars[0]["trips"]], [["Stationary", "Moving", "ExternalPowerChange"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import copy
+import itertools
+import random
+import unittest
+
+from segmentation import encode_events, segment_locations
+
+START = 1622505600
+LABELS = ["Moving", "Stationary", "ExternalPowerChange", "Unknown"]
+
+
+def reference_trips(locations):  # noqa: C901
+    """Trip detection as it was before segmentation was vectorized, kept as the reference
+
+    Only the parsing of 'when' is left out, locations are copied so the input is left unchanged.
+    """
+    locations = copy.deepcopy(locations)
+    trips = []
+    trip = []
+    for i in range(len(locations)):
+        location_checked = False
+        location = locations[i]
+        if i + 1 < len(locations) - 1 and location_checked is False:
+            if (
+                location["what"] in ["Stationary", "ExternalPowerChange"]
+                and locations[i - 1]["what"] == "Moving"
+                and locations[i + 1]["what"] == "Moving"
+            ):
+                if location not in trip:
+                    trip.append(location)
+                trips.append(trip)
+                trip = [copy.deepcopy(location)]
+                location_checked = True
+        if i + 1 < len(locations) - 1 and location_checked is False:
+            if (
+                location["what"] == "Stationary"
+                and locations[i + 1]["what"] == "Moving"
+            ) or (
+                location["what"] == "ExternalPowerChange"
+                and locations[i + 1]["what"] == "Moving"
+            ):
+                trip = [location]
+                location_checked = True
+        if i - 1 >= 0 and location_checked is False:
+            if (
+                location["what"] == "Stationary"
+                and locations[i - 1]["what"] == "Moving"
+            ) or (
+                location["what"] == "ExternalPowerChange"
+                and locations[i - 1]["what"] == "Moving"
+            ):
+                if location not in trip:
+                    trip.append(location)
+                trips.append(trip)
+                trip = []
+                location_checked = True
+        if location["what"] == "Moving" and location_checked is False:
+            if location not in trip:
+                trip.append(location)
+            if i == len(locations) - 1:
+                trips.append(trip)
+                trip = []
+            location_checked = True
+        elif (
+            location["what"] == "Stationary" and location_checked is False
+        ) or (
+            location["what"] == "ExternalPowerChange"
+            and location_checked is False
+        ):
+            if location not in trip:
+                trip.append(location)
+            if i == len(locations) - 1:
+                trips.append(trip)
+                trip = []
+            location_checked = True
+    return trips
+
+
+def make_day(whats, whens=None):
+    """Returns locations with the events, a minute apart unless whens are given"""
+    whens = whens if whens is not None else [START + 60 * i for i in range(len(whats))]
+    return [
+        {"when": when, "what": what, "geometry": {"type": "Point", "coordinates": [5.0 + i / 1000, 52.0]}}
+        for i, (when, what) in enumerate(zip(whens, whats))
+    ]
+
+
+class TestSegmentation(unittest.TestCase):
+    def assert_trips(self, locations, expected):
+        """Checks the trips of the vectorized engine and the reference, expected are location indexes"""
+        expected_trips = [[locations[i] for i in trip] for trip in expected]
+        self.assertEqual(reference_trips(locations), expected_trips)
+        self.assertEqual(segment_locations(copy.deepcopy(locations)), expected_trips)
+
+    def test_empty_day(self):
+        self.assert_trips([], [])
+
+    def test_single_trip(self):
+        # The last stationary location of the day is a trip of its own, postprocessing drops it
+        day = make_day(["Stationary", "Moving", "Moving", "Stationary", "Stationary"])
+        self.assert_trips(day, [[0, 1, 2, 3], [4]])
+
+    def test_leading_moving(self):
+        # The trip started the day before, it is completed by stitching
+        day = make_day(["Moving", "Moving", "Stationary", "Stationary", "Moving", "Stationary"])
+        self.assert_trips(day, [[0, 1, 2], [3, 4, 5]])
+
+    def test_trailing_moving(self):
+        # The trip ends the next day, the last location closes it. The location before the first one
+        # is the last one of the day, so the first stationary location also ends a trip of its own
+        day = make_day(["Stationary", "Moving", "Stationary", "Stationary", "Moving", "Moving"])
+        self.assert_trips(day, [[0], [0, 1, 2], [3, 4, 5]])
+
+    def test_unknown_events(self):
+        # Locations with an unknown event are never part of a trip
+        day = make_day(["Stationary", "Unknown", "Moving", "Unknown", "Moving", "Stationary", "Unknown"])
+        self.assertEqual(encode_events(day).tolist(), [2, 0, 1, 0, 1, 2, 0])
+        self.assert_trips(day, [[0, 2, 4, 5]])
+
+    def test_split_point(self):
+        # A stationary location between moving locations ends a trip and starts the next one
+        day = make_day(["Stationary", "Moving", "ExternalPowerChange", "Moving", "Stationary", "Stationary"])
+        self.assert_trips(day, [[0, 1, 2], [2, 3, 4], [5]])
+
+    def test_split_point_location_is_copied(self):
+        day = make_day(["Stationary", "Moving", "Stationary", "Moving", "Stationary", "Stationary"])
+        trips = segment_locations(day)
+        self.assertEqual(trips[0][-1], trips[1][0])
+        self.assertIsNot(trips[0][-1], trips[1][0])
+
+    def test_duplicate_whens(self):
+        # A location that is delivered twice is only part of its trip once
+        day = make_day(["Stationary", "Moving", "Moving", "Moving", "Stationary", "Stationary"],
+                       [START, START + 60, START + 120, START + 120, START + 180, START + 240])
+        day[3] = dict(day[2])
+        self.assert_trips(day, [[0, 1, 2, 4], [5]])
+
+    def test_duplicate_whens_with_other_events(self):
+        # Locations at the same time that differ are both kept
+        day = make_day(["Stationary", "Moving", "Moving", "Moving", "Stationary", "Stationary"],
+                       [START, START + 60, START + 120, START + 120, START + 180, START + 240])
+        self.assert_trips(day, [[0, 1, 2, 3, 4], [5]])
+
+    def test_every_short_sequence(self):
+        for length in range(1, 7):
+            for whats in itertools.product(LABELS, repeat=length):
+                day = make_day(whats)
+                self.assertEqual(segment_locations(copy.deepcopy(day)), reference_trips(day), whats)
+
+    def test_random_days(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            length = rng.randrange(1, 60)
+            whats = rng.choices(LABELS, weights=[6, 3, 1, 1], k=length)
+            whens = sorted(START + 60 * rng.randrange(length) for _ in range(length))
+            day = make_day(whats, whens)
+            # Some locations are delivered twice
+            for i in range(1, length):
+                if rng.random() < 0.1:
+                    day[i] = dict(day[i - 1])
+            self.assertEqual(segment_locations(copy.deepcopy(day)), reference_trips(day), whats)
+
+
+if __name__ == '__main__':
+    unittest.main()
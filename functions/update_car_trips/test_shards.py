@@ -0,0 +1,136 @@
+import json
+import unittest
+
+from google.api_core import exceptions as gcp_exceptions
+from shards import add_to_manifest, fetch_shards, list_shards, manifest_blob_name, read_manifest, shard_blob_name
+
+BLOB_NAME = "2021/06/01/locations.json"
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def generation(self):
+        return self.bucket.generations[self.name]
+
+    def download_as_string(self):
+        return self.bucket.blobs[self.name]
+
+    def download_as_bytes(self):
+        return self.bucket.blobs[self.name]
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if self.bucket.before_upload:
+            # The other run's own uploads go through
+            callback = self.bucket.before_upload.pop(0)
+            pending, self.bucket.before_upload = self.bucket.before_upload, []
+            callback()
+            self.bucket.before_upload = pending
+        if if_generation_match is not None and if_generation_match != self.bucket.generations.get(self.name, 0):
+            raise gcp_exceptions.PreconditionFailed("Generation does not match")
+        self.bucket.put(self.name, data)
+
+
+class FakeBucket(object):
+    """Bucket with generations, before_upload are called before the next uploads to simulate other runs"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.generations = {}
+        self.before_upload = []
+
+    def put(self, name, data):
+        self.blobs[name] = data.encode("utf-8") if isinstance(data, str) else data
+        self.generations[name] = self.generations.get(name, 0) + 1
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.blobs else None
+
+    def list_blobs(self, prefix=None):
+        return [FakeBlob(self, name) for name in sorted(self.blobs) if name.startswith(prefix or "")]
+
+
+def write_shard(bucket, shard, data=b"{}"):
+    bucket.put(shard_blob_name(BLOB_NAME, shard), data)
+
+
+class TestManifest(unittest.TestCase):
+    def test_creates_manifest(self):
+        bucket = FakeBucket()
+        manifest = add_to_manifest(bucket, BLOB_NAME, {"0a", "1b"})
+        self.assertEqual(manifest, {"prefix_length": 2, "shards": ["0a", "1b"]})
+        self.assertEqual(read_manifest(bucket, BLOB_NAME), manifest)
+
+    def test_known_shards_are_not_written(self):
+        bucket = FakeBucket()
+        add_to_manifest(bucket, BLOB_NAME, {"0a", "1b"})
+        add_to_manifest(bucket, BLOB_NAME, {"0a"})
+        self.assertEqual(bucket.generations[manifest_blob_name(BLOB_NAME)], 1)
+
+    def test_concurrent_runs_keep_every_shard(self):
+        bucket = FakeBucket()
+        add_to_manifest(bucket, BLOB_NAME, {"0a"})
+        # Another run adds its shard between reading and writing the manifest
+        bucket.before_upload.append(lambda: add_to_manifest(bucket, BLOB_NAME, {"2c"}))
+        with self.assertLogs(level="INFO"):
+            add_to_manifest(bucket, BLOB_NAME, {"1b"})
+        self.assertEqual(read_manifest(bucket, BLOB_NAME)["shards"], ["0a", "1b", "2c"])
+
+    def test_concurrent_runs_create_manifest(self):
+        bucket = FakeBucket()
+        bucket.before_upload.append(lambda: add_to_manifest(bucket, BLOB_NAME, {"2c"}))
+        add_to_manifest(bucket, BLOB_NAME, {"1b"})
+        self.assertEqual(read_manifest(bucket, BLOB_NAME)["shards"], ["1b", "2c"])
+
+    def test_gives_up_after_attempts(self):
+        bucket = FakeBucket()
+        add_to_manifest(bucket, BLOB_NAME, {"0a"})
+        bucket.before_upload.extend(lambda i=i: add_to_manifest(bucket, BLOB_NAME, {f"f{i}"}) for i in range(3))
+        with self.assertLogs(level="WARNING"):
+            add_to_manifest(bucket, BLOB_NAME, {"1b"}, max_attempts=3)
+        self.assertNotIn("1b", read_manifest(bucket, BLOB_NAME)["shards"])
+
+
+class TestFetchShards(unittest.TestCase):
+    def test_missing_day(self):
+        self.assertIsNone(fetch_shards(FakeBucket(), BLOB_NAME))
+
+    def test_lists_shards(self):
+        bucket = FakeBucket()
+        write_shard(bucket, "0a", b"a")
+        write_shard(bucket, "1b", b"b")
+        # Blobs of other files and days are not shards of the day
+        bucket.put("2021/06/01/shard=2c/other.json", b"c")
+        bucket.put("2021/06/02/shard=3d/locations.json", b"d")
+        self.assertEqual(list_shards(bucket, BLOB_NAME), ["0a", "1b"])
+
+    def test_shards_missing_from_manifest(self):
+        # A run that lost the race on the manifest still wrote its shard
+        bucket = FakeBucket()
+        write_shard(bucket, "0a", b"a")
+        write_shard(bucket, "1b", b"b")
+        add_to_manifest(bucket, BLOB_NAME, {"0a"})
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(fetch_shards(bucket, BLOB_NAME), [b"a", b"b"])
+
+    def test_shards_without_manifest(self):
+        bucket = FakeBucket()
+        write_shard(bucket, "0a", b"a")
+        self.assertEqual(fetch_shards(bucket, BLOB_NAME), [b"a"])
+
+    def test_manifest_lists_missing_shard(self):
+        bucket = FakeBucket()
+        write_shard(bucket, "0a", b"a")
+        bucket.put(manifest_blob_name(BLOB_NAME), json.dumps({"prefix_length": 2, "shards": ["0a", "1b"]}))
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(fetch_shards(bucket, BLOB_NAME), [b"a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import datetime
+
+# Location times are UTC epoch seconds from reading to uploading, shared by locations_to_stg and update_car_trips
+#
+# Stored locations have the fixed format '%Y-%m-%dT%H:%M:%S', messages add a 'Z'.
+# They are only parsed and formatted where locations are read, stored or uploaded.
+
+SECONDS_PER_DAY = 86400
+# Days from 0000-03-01 to 1970-01-01 in the proleptic Gregorian calendar
+EPOCH_DAYS = 719468
+
+
+def days_from_civil(year, month, day):
+    """Returns the number of days since 1970-01-01 of a date"""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - EPOCH_DAYS
+
+
+def civil_from_days(days):
+    """Returns the (year, month, day) of a number of days since 1970-01-01"""
+    days += EPOCH_DAYS
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + (3 if month_index < 10 else -9)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def parse_when(when):
+    """Returns the epoch seconds of a UTC time in the format '%Y-%m-%dT%H:%M:%S', with or without 'Z'"""
+    if (len(when) != 19 and not (len(when) == 20 and when[19] == "Z")) or \
+            when[4] != "-" or when[7] != "-" or when[10] != "T" or when[13] != ":" or when[16] != ":":
+        raise ValueError(f"Time '{when}' does not match format '%Y-%m-%dT%H:%M:%S'")
+    days = days_from_civil(int(when[0:4]), int(when[5:7]), int(when[8:10]))
+    return days * SECONDS_PER_DAY + int(when[11:13]) * 3600 + int(when[14:16]) * 60 + int(when[17:19])
+
+
+def format_when(epoch):
+    """Returns epoch seconds in the stored format '%Y-%m-%dT%H:%M:%S'"""
+    days, seconds = divmod(epoch, SECONDS_PER_DAY)
+    year, month, day = civil_from_days(days)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{second:02d}"
+
+
+def when_datetime(epoch):
+    """Returns epoch seconds as a UTC datetime, as uploaded to Firestore"""
+    return datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc)
+
+
+def day_start(date):
+    """Returns the epoch seconds of the start of a date in UTC"""
+    return days_from_civil(date.year, date.month, date.day) * SECONDS_PER_DAY
+
+
+def parse_locations(locations):
+    """Sets the 'when' of read locations to epoch seconds, returns the locations"""
+    for location in locations:
+        location["when"] = parse_when(location["when"])
+    return locations
+
+
+def format_locations(locations):
+    """Returns copies of the locations with their 'when' in the stored format"""
+    return [dict(location, when=format_when(location["when"])) for location in locations]
@@ -0,0 +1,69 @@
+import logging
+from operator import itemgetter
+
+from parallel import CHUNK_SIZE, map_cars
+from postprocessing import postprocess_trips
+from segmentation import build_trips, segment
+
+logging.basicConfig(level=logging.INFO)
+
+
+def make_trips(cars, workers=1, chunk_size=CHUNK_SIZE):
+    # Split the locations of every car into trips
+    # Only the event codes go to the worker processes, the trips are made here
+    return [
+        {
+            "license": car_license,
+            "license_hash": hashed_car_license,
+            "trips": build_trips(locations, codes, slices),
+        }
+        for (hashed_car_license, car_license, locations, codes), slices in map_cars(
+            segment, cars, compact=itemgetter(3), workers=workers, chunk_size=chunk_size
+        )
+    ]
+
+
+def patch_trip(trip, car_license_hash, previous_day):  # noqa: C901
+    # Check if the file with the previous day's locations exists
+    if previous_day.exists():
+        # Get the locations of the car from its last stationary location onwards
+        locations = previous_day.trailing_locations(car_license_hash)
+        # Keep adding locations in front of this trip until a Stationary location is found
+        add_to_trip = []
+        i = len(locations) - 1
+        while i >= 0:
+            # The previous day is shared by all cars, so leave its locations unchanged
+            location = dict(locations[i])
+            # While location is not stationary and is not an external power change
+            while (
+                location["what"] != "Stationary"
+                and location["what"] != "ExternalPowerChange"
+            ):
+                # Keep adding the location to a trip
+                add_to_trip.append(location)
+                if i - 1 < 0:
+                    # If i - 1 is smaller than zero
+                    # No stationary location is found in yesterday's locations
+                    # Return empty
+                    return []
+                i = i - 1
+            # Stationary location is found
+            add_to_trip.append(location)
+            i = -1
+        # Now the locations to be added need to be reversed in order to add them to the trip
+        add_to_trip = add_to_trip[::-1]
+        # Now add the locations in front of the trip
+        trip[0:0] = add_to_trip
+        return trip
+    # If there are no locations the previous day, remove this trip
+    return []
+
+
+def patch_trips(car_trips, previous_day):
+    def patch(trip, car_license_hash):
+        return patch_trip(trip, car_license_hash, previous_day)
+
+    car_trips = postprocess_trips(car_trips, patch)
+    logging.info(f"Fetched the previous day's locations {previous_day.blob_fetches} time(s) "
+                 f"and its checkpoint {previous_day.checkpoint_fetches} time(s)")
+    return car_trips
@@ -3,11 +3,17 @@ import config
 import json
 import random
 import math
+from bisect import bisect_right
 
 from google.cloud import firestore
 from google.cloud import storage
-from datetime import datetime, timedelta, timezone, time as dt_time
-from pytz import timezone as py_timezone
+from datetime import datetime, timedelta, timezone
+from pipeline import BackgroundCommitter, prefetch_pages
+from time_window import TimeWindow
+from trip_fields import select_trip_fields
+
+# Fields of the trips that are marked, they are paged on ended_at
+MARK_FIELDS = ["ended_at", "started_at", "license", "outside_time_window"]
 
 logging.basicConfig(level=logging.INFO)
 
@@ -23,6 +29,11 @@ class AddFieldsToFirestoreEntities(object):
         self.end_date = datetime(today.year, today.month, today.day)
 
         self.trip_information = self.init_trip_information()  # Retrieve all driver and business unit information
+        self.time_window = TimeWindow.from_config(config.time_window)  # Time window is in Europe/Amsterdam time
+
+        # Pages of trips are prefetched, and at most COMMITS_IN_FLIGHT batches wait to be committed
+        self.prefetch_pages = config.PREFETCH_PAGES if hasattr(config, 'PREFETCH_PAGES') else True
+        self.commits_in_flight = config.COMMITS_IN_FLIGHT if hasattr(config, 'COMMITS_IN_FLIGHT') else 2
 
     def init_trip_information(self):
         trip_info = {'drivers': None, 'business_units': None}
@@ -33,21 +44,24 @@ class AddFieldsToFirestoreEntities(object):
                     self.storage_client):
                 driver_information_blob_json_string = storage_bucket.get_blob(
                     config.DRIVERS_INFORMATION_PATH).download_as_string()
-                trip_info['drivers'] = json.loads(driver_information_blob_json_string)
+                # Index the driver assignments of every license on their period, once per run
+                trip_info['drivers'] = {
+                    car_license: DriverIntervals(drivers_list) for car_license, drivers_list
+                    in json.loads(driver_information_blob_json_string).items() if drivers_list
+                }
 
         if hasattr(config, 'BUSINESSUNITS_INFORMATION_PATH'):  # Retrieve business units from storage
             if storage.Blob(bucket=storage_bucket, name=config.BUSINESSUNITS_INFORMATION_PATH).exists(
                     self.storage_client):
                 bu_information_blob_json_string = storage_bucket.get_blob(
                     config.BUSINESSUNITS_INFORMATION_PATH).download_as_string()
-                trip_info['business_units'] = json.loads(bu_information_blob_json_string)
+                # Resolve the manager of every department of the organigram, once per run
+                trip_info['business_units'] = DepartmentIndex(json.loads(bu_information_blob_json_string))
 
         return trip_info
 
     def mark_trips_time_window(self):
         batch_limit = 500
-        batch_has_new_entities = True
-        batch_last_reference = None
 
         count_out_time_window = 0
         count_in_time_window = 0
@@ -55,9 +69,10 @@ class AddFieldsToFirestoreEntities(object):
 
         trips_in_time_window = []
 
-        while batch_has_new_entities:
+        def fetch_page(batch_last_reference):
             query = self.db_client.collection(config.collection)
 
+            query = select_trip_fields(query, MARK_FIELDS)
             query = query.where("ended_at", ">=", self.start_date)
             query = query.where("ended_at", "<", self.end_date)
             query = query.order_by("ended_at", direction="ASCENDING")
@@ -66,46 +81,47 @@ class AddFieldsToFirestoreEntities(object):
                 query = query.start_after(batch_last_reference)
 
             query = query.limit(batch_limit)
-            docs = query.stream()
+            return list(query.stream())
 
-            if docs:
+        # The next page is fetched while a page is handled, and batches are committed in the background
+        committer = BackgroundCommitter(self.commits_in_flight)
+        try:
+            for docs_list in prefetch_pages(fetch_page, batch_limit, self.prefetch_pages):
                 batch = self.db_client.batch()  # Creating new batch
-                docs_list = list(docs)
-
-                if len(docs_list) < batch_limit:
-                    batch_has_new_entities = False
 
-                for doc in docs_list:
-                    batch_last_reference = doc
-                    doc_dict = doc.to_dict()
+                # Only trips that are not marked yet, classified on time window at once
+                new_docs = [(doc, doc.to_dict()) for doc in docs_list]
+                new_docs = [(doc, doc_dict) for doc, doc_dict in new_docs
+                            if doc_dict.get('outside_time_window') is None]
+                outside_time_window = self.time_window.outside([doc_dict['started_at'] for _, doc_dict in new_docs])
 
-                    if doc_dict.get('outside_time_window') is None:
-                        new_fields = {}
+                for (doc, doc_dict), outside in zip(new_docs, outside_time_window):
+                    new_fields = {}
 
-                        if entity_outside_time_window(doc_dict['started_at']):
-                            new_fields["outside_time_window"] = True
-                            count_out_time_window += 1
-                        else:
-                            new_fields["outside_time_window"] = False
-                            trips_in_time_window.append(doc.reference)
-                            count_in_time_window += 1
+                    if outside:
+                        new_fields["outside_time_window"] = True
+                        count_out_time_window += 1
+                    else:
+                        new_fields["outside_time_window"] = False
+                        trips_in_time_window.append(doc.reference)
+                        count_in_time_window += 1
 
-                        drivers_list = self.trip_information['drivers'].get(doc_dict['license'])
-                        driver = self.process_driver(drivers_list, doc_dict['started_at'], doc_dict['ended_at'])
+                    driver_intervals = self.trip_information['drivers'].get(doc_dict['license'])
+                    driver = self.process_driver(driver_intervals, doc_dict['started_at'], doc_dict['ended_at'])
 
-                        if driver:  # Add driver information to trip
-                            new_fields["driver_info"] = driver
-                            new_fields["department"] = self.process_department(driver.get("department_id"))
-                            count_driver += 1
-                        else:
-                            new_fields["driver_info"] = None
-                            new_fields["department"] = None
+                    if driver:  # Add driver information to trip
+                        new_fields["driver_info"] = driver
+                        new_fields["department"] = self.process_department(driver.get("department_id"))
+                        count_driver += 1
+                    else:
+                        new_fields["driver_info"] = None
+                        new_fields["department"] = None
 
-                        batch.update(doc.reference, new_fields)  # Add new fields to batch
+                    batch.update(doc.reference, new_fields)  # Add new fields to batch
 
-                batch.commit()  # Committing changes within batch
-            else:
-                batch_has_new_entities = False
+                committer.submit(batch)  # Committing changes within batch
+        finally:
+            committer.close()  # Waiting for the batches that are not committed yet
 
         logging.info(
             f"Marked {count_out_time_window} trips as 'outside time window' and {count_in_time_window} as "
@@ -146,61 +162,150 @@ class AddFieldsToFirestoreEntities(object):
             self.mark_trips_sample(trips_in_time_window, sample_amount)
 
     @staticmethod
-    def process_driver(drivers_list, trip_start, trip_end):
-        if not drivers_list:
+    def process_driver(driver_intervals, trip_start, trip_end):
+        if not driver_intervals:
             return None
-        if len(drivers_list) == 1:
-            return drivers_list[0]
-
-        cur_driver = None
-        trip_start = convert_to_datetime(str(trip_start), 'google')
-        trip_end = convert_to_datetime(str(trip_end), 'google')
-
-        for driver in sorted(drivers_list, key=lambda i: i['driver_start_date'], reverse=True):
-            driver_start = convert_to_datetime(driver['driver_start_date'])
-            driver_end = convert_to_datetime(driver['driver_end_date']) if \
-                driver['driver_end_date'] is not None else trip_end
 
-            if driver_start <= trip_start and driver_end >= trip_end:
-                cur_driver = driver
-
-        return cur_driver
+        # Trip times are compared in whole seconds, as the driver periods are
+        return driver_intervals.driver_at(math.floor(trip_start.timestamp()), math.floor(trip_end.timestamp()))
 
     def process_department(self, department):
         if department:
             department_id = int(department['id']) if isinstance(department, dict) else int(department)
-            if self.trip_information['business_units'] and \
-                    self.trip_information['business_units'].get(str(department_id)):
-                return self.trip_information['business_units'].get(str(department_id))
+            if self.trip_information['business_units']:
+                return self.trip_information['business_units'].get(department_id)
 
         return None
 
 
-def entity_outside_time_window(value):
-    hour_before = config.time_window['start_time_hour']
-    minutes_before = config.time_window['start_time_minutes']
-    hour_after = config.time_window['end_time_hour']
-    minutes_after = config.time_window['end_time_minutes']
-
-    # time window is in Europe/Amsterdam time
-    time_before = dt_time(hour_before, minutes_before, tzinfo=py_timezone('Europe/Amsterdam'))
-    time_after = dt_time(hour_after, minutes_after, tzinfo=py_timezone('Europe/Amsterdam'))
-
-    # Convert started_at and ended_at of trip to Europe/Amsterdam timezone
-    started_at = value.astimezone(py_timezone('Europe/Amsterdam')).time()
-
-    if started_at < time_before or started_at > time_after:
-        return True
+class DepartmentIndex(object):
+    """Departments of the organigram, indexed on id, with the manager that is responsible for them
+
+    A department without manager mail gets the manager of the nearest department up its chain of
+    parents that has one. If there is none, or the chain runs into a cycle, it keeps no manager.
+    """
+
+    def __init__(self, business_units):
+        units = {}
+        for key, unit in business_units.items():
+            if unit.get('department_id') is None:  # Departments without valid id can not be found
+                continue
+            units[unit['department_id']] = unit
+
+        # Id of the department whose manager is responsible for every department, None if there is none
+        managers = {}
+        for department_id in units:
+            path = []
+            current = department_id
+            while True:
+                if current in managers:
+                    manager = managers[current]
+                    break
+                if current is None or current not in units:  # Chain ends at the top or at an unknown department
+                    manager = None
+                    break
+                if current in path:
+                    logging.warning(f"Departments {path[path.index(current):]} form a cycle of parents, "
+                                    f"they have no manager")
+                    manager = None
+                    break
+                if units[current].get('manager_mail'):
+                    manager = current
+                    break
+                path.append(current)
+                current = units[current].get('department_parent_id')
+
+            for path_id in path:
+                managers[path_id] = manager
+            managers.setdefault(department_id, manager)
+
+        self.departments = {}
+        for department_id, unit in units.items():
+            manager = managers[department_id]
+            if manager is not None and manager != department_id:
+                unit = dict(unit, manager_name=units[manager].get('manager_name'),
+                            manager_mail=units[manager].get('manager_mail'))
+            self.departments[department_id] = unit
+
+        inherited = sum(1 for department_id in units if managers[department_id] not in (None, department_id))
+        without = sum(1 for department_id in units if managers[department_id] is None)
+        logging.info(f"Indexed {len(units)} departments, {inherited} get the manager of a parent department "
+                     f"and {without} have no manager")
+
+    def get(self, department_id):
+        return self.departments.get(department_id)
+
+    def __len__(self):
+        return len(self.departments)
+
+
+class DriverIntervals(object):
+    """Driver assignments of one license, indexed on the start of their period
+
+    A trip belongs to the driver whose period covers it, of the drivers whose periods overlap
+    the one that started latest. A license with a single driver always belongs to that driver.
+    """
+
+    def __init__(self, drivers_list):
+        assignments = []
+        for driver in drivers_list:
+            driver_start = convert_to_epoch(driver['driver_start_date'])
+            if driver_start is None:
+                logging.warning(f"Driver of '{driver.get('license')}' has an invalid start date, skipping it")
+                continue
+            # A period without end date is open
+            driver_end = convert_to_epoch(driver['driver_end_date']) if \
+                driver['driver_end_date'] is not None else math.inf
+            if driver_end is None:
+                logging.warning(f"Driver of '{driver.get('license')}' has an invalid end date, skipping it")
+                continue
+            assignments.append((driver_start, driver_end, driver))
+
+        # Sorting is stable, of drivers with the same start the last one listed is found first
+        assignments.sort(key=lambda assignment: assignment[0])
+        self.starts = [assignment[0] for assignment in assignments]
+        self.drivers = [assignment[2] for assignment in assignments]
+        self.single_driver = drivers_list[0] if len(drivers_list) == 1 else None
+
+        # Latest end of every range of 2 ** level assignments from an index, for every level
+        self.max_ends = [[assignment[1] for assignment in assignments]]
+        while 2 ** len(self.max_ends) <= len(assignments):
+            previous = self.max_ends[-1]
+            half = 2 ** (len(self.max_ends) - 1)
+            self.max_ends.append([max(previous[i], previous[i + half])
+                                  for i in range(len(assignments) - 2 * half + 1)])
+
+    def max_end(self, first, last):
+        """Returns the latest end of the assignments from first up to and including last"""
+        level = (last - first + 1).bit_length() - 1
+        return max(self.max_ends[level][first], self.max_ends[level][last - 2 ** level + 1])
+
+    def driver_at(self, trip_start, trip_end):
+        """Returns the driver of a trip from trip_start up to trip_end in epoch seconds, or None"""
+        if self.single_driver:
+            return self.single_driver
+
+        # Drivers that started before the trip, none of them covers it if none ends after it
+        last = bisect_right(self.starts, trip_start) - 1
+        if last < 0 or self.max_end(0, last) < trip_end:
+            return None
 
-    return False
+        # The latest start that covers the trip, the latest end from an index onwards only drops
+        low, high = 0, last
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.max_end(middle, last) >= trip_end:
+                low = middle
+            else:
+                high = middle - 1
+        return self.drivers[low]
 
 
-def convert_to_datetime(string, type=None):
-    format = '%Y-%m-%d %H:%M:%S%z' if type == 'google' else '%Y-%m-%dT%H:%M:%SZ'
+def convert_to_epoch(string):
     try:
-        value = datetime.strptime(string, format)
+        value = datetime.strptime(string, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
     except (ValueError, TypeError, AttributeError):
         pass
         return None
     else:
-        return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return int(value.timestamp())
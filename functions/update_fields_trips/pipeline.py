@@ -0,0 +1,67 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO)
+
+
+def prefetch_pages(fetch_page, page_size, prefetch=True):
+    """Yields pages of documents, fetching the next page while the current one is handled
+
+    fetch_page gets the last document of the previous page, None for the first page, and returns
+    a list of at most page_size documents. A page with less documents is the last one.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = fetch_page(None)
+        while page:
+            next_page = executor.submit(fetch_page, page[-1]) if prefetch and len(page) == page_size else None
+            yield page
+            if len(page) < page_size:
+                return
+            page = next_page.result() if next_page else fetch_page(page[-1])
+
+
+class BackgroundCommitter(object):
+    """Commits batches on a background thread, with at most max_pending batches waiting to be committed
+
+    submit blocks while max_pending batches are waiting, so pages are not fetched faster than they are
+    stored. With max_pending 0 every batch is committed before submit returns. The first failed commit
+    is raised by the next submit or by close, batches that were waiting are still committed.
+    """
+
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.commits = 0
+        self._errors = []
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self._executor = ThreadPoolExecutor(max_workers=1) if max_pending else None
+
+    def submit(self, batch):
+        self.raise_error()
+        if not self._executor:
+            self.commit(batch)
+            self.raise_error()
+            return
+        self._slots.acquire()
+        self._executor.submit(self.commit, batch)
+
+    def commit(self, batch):
+        try:
+            batch.commit()
+            self.commits += 1
+        except Exception as e:
+            logging.error(f"Committing batch failed: {e}")
+            self._errors.append(e)
+        finally:
+            if self._slots:
+                self._slots.release()
+
+    def close(self):
+        """Waits for the batches that are waiting to be committed, raises the first failed commit"""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self.raise_error()
+
+    def raise_error(self):
+        if self._errors:
+            raise self._errors[0]
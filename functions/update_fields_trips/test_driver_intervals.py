@@ -0,0 +1,82 @@
+import math
+import random
+import unittest
+from datetime import datetime, timezone
+
+from add_fields_firestore_entities import DriverIntervals, convert_to_epoch
+
+START = 1609459200
+
+
+def make_driver(name, start, end=None):
+    """Returns a driver assignment with its period in epoch seconds, an open period if end is None"""
+    def date(value):
+        return datetime.fromtimestamp(value, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    return {"license": "car-1", "name": name, "driver_start_date": date(start),
+            "driver_end_date": date(end) if end is not None else None, "department_id": None}
+
+
+def reference_driver_at(drivers_list, trip_start, trip_end):
+    """Walks back from the latest start over every assignment, as the lookup did before it was indexed"""
+    assignments = []
+    for driver in drivers_list:
+        driver_end = convert_to_epoch(driver['driver_end_date']) if driver['driver_end_date'] else math.inf
+        assignments.append((convert_to_epoch(driver['driver_start_date']), driver_end, driver))
+    assignments.sort(key=lambda assignment: assignment[0])
+    for driver_start, driver_end, driver in reversed(assignments):
+        if driver_start <= trip_start and driver_end >= trip_end:
+            return driver
+    return None
+
+
+class TestDriverIntervals(unittest.TestCase):
+    def test_latest_start_wins(self):
+        drivers = DriverIntervals([make_driver("a", START), make_driver("b", START + 100, START + 200)])
+        self.assertEqual(drivers.driver_at(START + 150, START + 160)["name"], "b")
+        self.assertEqual(drivers.driver_at(START + 50, START + 60)["name"], "a")
+        self.assertEqual(drivers.driver_at(START + 250, START + 260)["name"], "a")
+
+    def test_earlier_driver_covers_longer_trip(self):
+        # The latest driver ends during the trip, an earlier driver covers all of it
+        drivers = DriverIntervals([make_driver("a", START, START + 1000), make_driver("b", START + 100, START + 200),
+                                   make_driver("c", START + 120, START + 180)])
+        self.assertEqual(drivers.driver_at(START + 150, START + 300)["name"], "a")
+        self.assertEqual(drivers.driver_at(START + 150, START + 190)["name"], "b")
+        self.assertEqual(drivers.driver_at(START + 150, START + 170)["name"], "c")
+
+    def test_no_driver(self):
+        drivers = DriverIntervals([make_driver("a", START + 100, START + 200), make_driver("b", START + 300)])
+        self.assertIsNone(drivers.driver_at(START, START + 10))
+        self.assertIsNone(drivers.driver_at(START + 150, START + 250))
+        self.assertIsNone(DriverIntervals([make_driver("a", START), {"license": "car-1", "driver_start_date": "x",
+                                                                     "driver_end_date": None}]).driver_at(0, 1))
+
+    def test_single_driver(self):
+        # A license with one driver always belongs to it
+        driver = make_driver("a", START + 100, START + 200)
+        self.assertIs(DriverIntervals([driver]).driver_at(START, START + 300), driver)
+
+    def test_same_start(self):
+        # Of drivers with the same start the last one listed wins
+        drivers = DriverIntervals([make_driver("a", START), make_driver("b", START)])
+        self.assertEqual(drivers.driver_at(START + 10, START + 20)["name"], "b")
+
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            drivers_list = []
+            for i in range(rng.randrange(2, 40)):
+                start = START + rng.randrange(0, 10000, 10)
+                end = start + rng.randrange(0, 5000, 10) if rng.random() < 0.8 else None
+                drivers_list.append(make_driver(str(i), start, end))
+            drivers = DriverIntervals(drivers_list)
+            for _ in range(50):
+                trip_start = START + rng.randrange(-1000, 12000, 5)
+                trip_end = trip_start + rng.randrange(0, 3000, 5)
+                self.assertIs(drivers.driver_at(trip_start, trip_end),
+                              reference_driver_at(drivers_list, trip_start, trip_end))
+
+
+if __name__ == '__main__':
+    unittest.main()
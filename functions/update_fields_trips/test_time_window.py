@@ -0,0 +1,91 @@
+import datetime
+import unittest
+
+from pytz import timezone as py_timezone
+from time_window import TimeWindow
+
+AMSTERDAM = py_timezone("Europe/Amsterdam")
+# Weekends daylight saving time starts and ends in Europe/Amsterdam
+DST_WEEKENDS = [datetime.date(2021, 3, 27), datetime.date(2021, 10, 30), datetime.date(2022, 3, 26),
+                datetime.date(2022, 10, 29)]
+# Windows of a working day, and windows that start or end in the hour that is skipped or repeated
+WINDOWS = [(7, 0, 18, 0), (6, 30, 19, 45), (2, 30, 17, 0), (0, 0, 2, 30), (2, 0, 3, 0)]
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+def outside_per_trip(value, start_hour, start_minutes, end_hour, end_minutes):
+    """Classifies one trip by converting it to local time with pytz"""
+    started_at = value.astimezone(AMSTERDAM).time()
+    return started_at < datetime.time(start_hour, start_minutes) or started_at > datetime.time(end_hour, end_minutes)
+
+
+def weekend_times(saturday):
+    """Returns every half minute of a weekend in UTC, with a margin of a day on both ends"""
+    start = utc(saturday.year, saturday.month, saturday.day)
+    return [start + datetime.timedelta(seconds=30 * i) for i in range(-2 * 24 * 60, 2 * 4 * 24 * 60)]
+
+
+class TestTimeWindow(unittest.TestCase):
+    def test_dst_weekends(self):
+        for window in WINDOWS:
+            time_window = TimeWindow(*window)
+            for saturday in DST_WEEKENDS:
+                values = weekend_times(saturday)
+                expected = [outside_per_trip(value, *window) for value in values]
+                self.assertEqual(time_window.outside(values).tolist(), expected, (window, saturday))
+
+    def test_window_starts_in_skipped_hour(self):
+        # On 28 March 2021 local time jumps from 02:00 to 03:00, at 01:00 UTC
+        time_window = TimeWindow(2, 30, 17, 0)
+        values = [utc(2021, 3, 28, 0, 59, 59), utc(2021, 3, 28, 1, 0), utc(2021, 3, 28, 15, 0),
+                  utc(2021, 3, 28, 15, 0, 1)]
+        self.assertEqual(time_window.outside(values).tolist(), [True, False, False, True])
+
+    def test_window_ends_in_repeated_hour(self):
+        # On 31 October 2021 local time goes back from 03:00 to 02:00, at 01:00 UTC
+        time_window = TimeWindow(0, 0, 2, 30)
+        # 02:30 summer time, 02:45 summer time, 02:15 winter time, 02:30 winter time, 02:31 winter time
+        values = [utc(2021, 10, 31, 0, 30), utc(2021, 10, 31, 0, 45), utc(2021, 10, 31, 1, 15),
+                  utc(2021, 10, 31, 1, 30), utc(2021, 10, 31, 1, 31)]
+        self.assertEqual(time_window.outside(values).tolist(), [False, True, False, False, True])
+
+    def test_end_of_window_is_inside(self):
+        time_window = TimeWindow(7, 0, 18, 0)
+        # 18:00 and 07:00 summer time
+        values = [utc(2021, 6, 1, 16, 0), utc(2021, 6, 1, 16, 0, 1), utc(2021, 6, 1, 5, 0),
+                  utc(2021, 6, 1, 4, 59, 59)]
+        self.assertEqual(time_window.outside(values).tolist(), [False, True, False, True])
+
+    def test_local_times(self):
+        # Trips can start in any time zone, they are compared in local time
+        time_window = TimeWindow(7, 0, 18, 0)
+        values = [AMSTERDAM.localize(datetime.datetime(2021, 6, 1, 12, 30)), utc(2021, 1, 1, 23, 30)]
+        self.assertEqual(time_window.local_seconds(values).tolist(), [12.5 * 3600, 0.5 * 3600])
+
+    def test_after_last_transition(self):
+        # The table of pytz ends in 2037, later times get the offset of its last transition as pytz does
+        time_window = TimeWindow(7, 0, 18, 0)
+        values = [utc(2040, 1, 15, 12, 0), utc(2040, 7, 15, 12, 0), utc(2040, 7, 15, 17, 0)]
+        expected = [outside_per_trip(value, 7, 0, 18, 0) for value in values]
+        self.assertEqual(time_window.outside(values).tolist(), expected)
+        self.assertEqual(time_window.local_seconds(values[:1]).tolist(), [13 * 3600])
+
+    def test_fixed_offset_time_zone(self):
+        time_window = TimeWindow(7, 0, 18, 0, time_zone="UTC")
+        values = [utc(2021, 3, 28, 6, 59), utc(2021, 3, 28, 7, 0), utc(2021, 10, 31, 18, 0, 1)]
+        self.assertEqual(time_window.outside(values).tolist(), [True, False, True])
+
+    def test_empty_page(self):
+        self.assertEqual(TimeWindow(7, 0, 18, 0).outside([]).tolist(), [])
+
+    def test_from_config(self):
+        time_window = TimeWindow.from_config({'start_time_hour': 6, 'start_time_minutes': 30,
+                                              'end_time_hour': 19, 'end_time_minutes': 45})
+        self.assertEqual((time_window.start, time_window.end), (6.5 * 3600, 19.75 * 3600))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import calendar
+
+import numpy as np
+from pytz import timezone as py_timezone
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class TimeWindow(object):
+    """Classifies trips on whether they started outside a daily time window in local time
+
+    The UTC offsets of the time zone are looked up in its table of transitions, so the start
+    times of a page of trips are converted to local time of day at once, including on the
+    days daylight saving time starts or ends.
+    """
+
+    def __init__(self, start_hour, start_minutes, end_hour, end_minutes, time_zone="Europe/Amsterdam"):
+        # Time of day in seconds, a trip that starts at the end of the window is inside it
+        self.start = start_hour * 3600 + start_minutes * 60
+        self.end = end_hour * 3600 + end_minutes * 60
+
+        # Transitions in epoch seconds and the UTC offset in seconds from every transition onwards
+        # The table of pytz ends in 2037, times after its last transition get the last offset
+        tz = py_timezone(time_zone)
+        transitions = getattr(tz, "_utc_transition_times", None)
+        transition_info = getattr(tz, "_transition_info", None)
+        if transitions and transition_info:
+            self.transitions = np.array([calendar.timegm(t.timetuple()) for t in transitions], dtype=np.float64)
+            self.offsets = np.array([info[0].total_seconds() for info in transition_info], dtype=np.float64)
+        else:
+            # A time zone with a fixed offset
+            self.transitions = np.zeros(1, dtype=np.float64)
+            self.offsets = np.array([tz.utcoffset(None).total_seconds()], dtype=np.float64)
+
+    @classmethod
+    def from_config(cls, time_window):
+        return cls(time_window['start_time_hour'], time_window['start_time_minutes'],
+                   time_window['end_time_hour'], time_window['end_time_minutes'])
+
+    def local_seconds(self, values):
+        """Returns the local times of day in seconds of aware datetimes"""
+        epochs = np.array([value.timestamp() for value in values], dtype=np.float64)
+        # The transition in effect is the last one at or before the time
+        index = np.searchsorted(self.transitions, epochs, side="right") - 1
+        return np.mod(epochs + self.offsets[np.maximum(index, 0)], SECONDS_PER_DAY)
+
+    def outside(self, values):
+        """Returns a boolean array that is True for every datetime that is outside the time window"""
+        local = self.local_seconds(values)
+        return (local < self.start) | (local > self.end)
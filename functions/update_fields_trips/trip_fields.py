@@ -0,0 +1,24 @@
+# Projections of scans over the Trips collection, shared by the functions and the API server
+#
+# A trip holds its locations, up to thousands of them, and most scans only need a few other fields.
+# Every scan declares the fields it reads and only gets those, the locations are only read by a
+# scan that declares it needs them. A scan that continues after the last document of a page also
+# needs the fields it is ordered on.
+
+LOCATIONS_FIELD = "locations"
+
+
+def trip_fields(field_paths, locations=False):
+    """Returns the field paths of a scan over trips, raises a ValueError if it reads the locations unasked"""
+    fields = list(dict.fromkeys(field_paths))
+    reads_locations = any(field.split(".")[0] == LOCATIONS_FIELD for field in fields)
+    if reads_locations and not locations:
+        raise ValueError(f"Scan over trips reads '{LOCATIONS_FIELD}' without declaring it needs them")
+    if locations and not reads_locations:
+        fields.append(LOCATIONS_FIELD)
+    return fields
+
+
+def select_trip_fields(query, field_paths, locations=False):
+    """Returns the query with a projection on the field paths of trip_fields"""
+    return query.select(trip_fields(field_paths, locations))